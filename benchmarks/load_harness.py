@@ -0,0 +1,560 @@
+"""
+Нагрузочный стенд: бот под нагрузкой без обращения к настоящим API.
+
+Поднимает локальные заглушки Bot API, TMDB, Spotify и Google Books (задержки
+с логнормальным распределением, доля ошибок 5xx и ответов 429 настраиваются)
+и моделирует пользователей, которые проходят сценарий
+START_ROUTES -> GENRE_SELECTION -> *_ACTIONS, нажимая кнопки из полученных
+сообщений. Обновления передаются в Application.process_update, поэтому
+работают все обработчики, ConversationHandler, хранилище и кэши бота.
+Для каждого сценария выводятся пропускная способность, перцентили задержек
+шагов и число запросов к провайдерам. Запуск из корня репозитория:
+
+    python benchmarks/load_harness.py --users 1000 --concurrency 200
+    python benchmarks/load_harness.py --scenario music --latency spotify=400:0.8 --errors spotify=0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+from telegram import Update
+
+# Настоящие ключи не нужны и не должны попасть в заглушки: load_dotenv не перезаписывает
+# уже заданные переменные среды
+for variable in ('TMDB_API_KEY', 'SPOTIFY_CLIENT_ID', 'SPOTIFY_CLIENT_SECRET', 'GOOGLE_BOOKS_API_KEY'):
+    os.environ[variable] = 'loadtest'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+BOT_TOKEN = "123456:LOADTEST"
+PROVIDERS = ('tmdb', 'spotify', 'google_books', 'telegram')
+# Медиана задержки (мс) и разброс логнормального распределения по умолчанию
+DEFAULT_LATENCY = {'tmdb': (120, 0.5), 'spotify': (150, 0.6), 'google_books': (250, 0.6), 'telegram': (40, 0.4)}
+SCENARIOS = {'movie': ('movie',), 'music': ('music',), 'book': ('book',), 'mixed': ('movie', 'music', 'book')}
+HTTP_REASONS = {200: 'OK', 404: 'Not Found', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+class ProviderProfile:
+    """Поведение заглушки провайдера: задержка, доля ошибок 5xx и ответов 429."""
+
+    __slots__ = ('median', 'sigma', 'error_rate', 'rate_limit_rate')
+
+    def __init__(self, median_ms, sigma, error_rate=0.0, rate_limit_rate=0.0):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+    def delay(self):
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+    def outcome(self):
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500
+        return 200
+
+
+class StubServer:
+    """Минимальный HTTP/1.1-сервер с keep-alive; handler возвращает (статус, JSON, заголовки)."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0, limit=1 << 20)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload, extra_headers = await self.handler(method, headers.get('host', ''), target, body)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                head = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+                        "Content-Type: application/json", f"Content-Length: {len(data)}"]
+                head += [f"{name}: {value}" for name, value in extra_headers.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class StubRoutingTransport(httpx.AsyncBaseTransport):
+    """Отправляет запросы бота к провайдерам на заглушку; заголовок Host остается прежним."""
+
+    def __init__(self, port):
+        self.port = port
+        self.inner = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=200, max_keepalive_connections=100))
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(scheme='http', host='127.0.0.1', port=self.port)
+        return await self.inner.handle_async_request(request)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+class UpstreamStub:
+    """Ответы TMDB, Spotify и Google Books в формате, который разбирает main.py."""
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.calls = Counter()  # (провайдер, эндпоинт, статус) -> запросов
+
+    async def handle(self, method, host, target, body):
+        provider = main.PROVIDER_HOSTS.get(host.split(':')[0])
+        url = urlsplit(target)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = dict(main.endpoint_labels(provider or 'unknown', url.path))['endpoint']
+        profile = self.profiles[provider] if provider else None
+        if profile is not None:
+            await asyncio.sleep(profile.delay())
+            status = profile.outcome()
+        else:
+            status = 404
+        self.calls[(provider or host, endpoint, status)] += 1
+
+        if status == 429:
+            return 429, {'error': 'rate limited'}, {'Retry-After': '1'}
+        if status != 200:
+            return status, {'error': 'stub failure'}, {}
+        return 200, self.payload(provider, url.path, query), {}
+
+    def payload(self, provider, path, query):
+        if provider == 'tmdb':
+            if path.endswith('/genre/movie/list'):
+                return {'genres': [{'id': genre_id, 'name': f"жанр {genre_id}"} for genre_id in TMDB_GENRE_IDS]}
+            seed = query.get('with_genres') or query.get('query') or 'popular'
+            return {'results': [tmdb_movie(movie_id) for movie_id in sample_ids(seed, 5000, 20)]}
+        if provider == 'spotify':
+            if path.endswith('/api/token'):
+                return {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600}
+            if path.endswith('/search'):
+                if query.get('type') == 'playlist':
+                    return {'playlists': {'items': [{'id': f"pl{i}", 'name': f"Плейлист {i}"}
+                                                    for i in sample_ids(query.get('q', ''), 500, 10)]}}
+                return {'tracks': {'items': [spotify_track(i) for i in sample_ids(query.get('q', ''), 20000, 50)]}}
+            if '/playlists/' in path:
+                return {'items': [{'track': spotify_track(i)} for i in sample_ids(path, 20000, 20)]}
+            if path.endswith('/browse/new-releases'):
+                return {'albums': {'items': [spotify_album(i, tracks=False) for i in sample_ids('new', 2000, 20)]}}
+            if path.endswith('/albums'):
+                return {'albums': [spotify_album(int(item_id[2:])) for item_id in query.get('ids', '').split(',')]}
+            if path.endswith('/tracks'):
+                return {'tracks': [spotify_track(int(item_id[2:])) for item_id in query.get('ids', '').split(',')]}
+        if provider == 'google_books':
+            return {'items': [google_volume(i) for i in sample_ids(query.get('q', ''), 10000, 40)]}
+        return {}
+
+
+TMDB_GENRE_IDS = (28, 12, 16, 35, 80, 99, 18, 10751, 14, 36, 27, 10402, 9648, 10749, 878, 53, 10752, 37)
+
+
+def sample_ids(seed, pool, count):
+    """Одни и те же ID для одного запроса, как у настоящего провайдера."""
+    return random.Random(seed).sample(range(pool), count)
+
+
+def tmdb_movie(movie_id):
+    return {
+        'id': movie_id + 1, 'title': f"Фильм {movie_id}", 'original_title': f"Movie {movie_id}",
+        'release_date': f"{1970 + movie_id % 55}-05-01", 'vote_average': round(5 + movie_id % 50 / 10, 1),
+        'overview': "Описание фильма для нагрузочного теста. " * 6, 'poster_path': f"/poster{movie_id}.jpg",
+        'genre_ids': [TMDB_GENRE_IDS[movie_id % len(TMDB_GENRE_IDS)]],
+    }
+
+
+def spotify_album(album_id, tracks=True):
+    album = {
+        'id': f"al{album_id}", 'name': f"Альбом {album_id}",
+        'images': [{'url': f"https://i.scdn.co/image/{album_id:032d}"}],
+    }
+    if tracks:
+        album['tracks'] = {'items': [{
+            'id': f"tr{album_id * 10 + i}", 'name': f"Трек {album_id * 10 + i}",
+            'artists': [{'name': f"Исполнитель {album_id % 300}"}],
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{album_id * 10 + i}"},
+        } for i in range(8)]}
+    return album
+
+
+def spotify_track(track_id):
+    return {
+        'id': f"tr{track_id}", 'name': f"Трек {track_id}",
+        'artists': [{'name': f"Исполнитель {track_id % 300}"}],
+        'album': spotify_album(track_id // 10, tracks=False),
+        'preview_url': None,
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+    }
+
+
+def google_volume(volume_id):
+    return {'id': f"vol{volume_id:08d}", 'volumeInfo': {
+        'title': f"Книга {volume_id}", 'authors': [f"Автор {volume_id % 700}"],
+        'publishedDate': f"{1950 + volume_id % 70}", 'description': "Описание книги. " * 20,
+        'categories': ['Fiction'], 'language': 'ru',
+        'imageLinks': {'thumbnail': f"https://books.google.com/thumb?id={volume_id}"},
+        'previewLink': f"https://books.google.com/preview?id={volume_id}",
+    }}
+
+
+class BotApiStub:
+    """
+    Заглушка Bot API: отвечает на методы отправки и редактирования сообщений
+    и складывает показанные пользователю экраны в очередь его чата.
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+        self.inboxes = defaultdict(asyncio.Queue)
+
+    async def handle(self, method, host, target, body):
+        api_method = target.rsplit('/', 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        await asyncio.sleep(self.profile.delay())
+        self.calls[api_method] += 1
+
+        if api_method == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': int(BOT_TOKEN.split(':')[0]), 'is_bot': True, 'first_name': "Stub", 'username': "stub_bot",
+            }}, {}
+        if api_method in ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption'):
+            message = self.message(api_method, params)
+            self.inboxes[message['chat']['id']].put_nowait(message)
+            return 200, {'ok': True, 'result': message}, {}
+        return 200, {'ok': True, 'result': True}, {}
+
+    def message(self, api_method, params):
+        chat_id = int(params['chat_id'])
+        message_id = int(params['message_id']) if 'message_id' in params else next(self.message_ids)
+        message = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if api_method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'stub', 'file_unique_id': 'stub', 'width': 300, 'height': 450}]
+            message['caption'] = params.get('caption', '')
+        else:
+            message['text'] = params.get('text', '')
+        if 'reply_markup' in params:
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        return message
+
+
+def callbacks(message):
+    """Кнопки сообщения: список (разобранный callback, callback_data)."""
+    rows = (message.get('reply_markup') or {}).get('inline_keyboard', [])
+    result = []
+    for row in rows:
+        for button in row:
+            callback = main.decode_callback(button.get('callback_data'))
+            if callback is not None:
+                result.append((callback, button['callback_data']))
+    return result
+
+
+def find_callback(message, action, category=None):
+    options = [data for callback, data in callbacks(message)
+               if callback.action == action and (category is None or callback.category == category)]
+    return random.choice(options) if options else None
+
+
+class StepFailed(Exception):
+    """Пользователь не получил ожидаемый экран вовремя."""
+
+
+class SimulatedUser:
+    """Пользователь в личном чате: отправляет обновления и ждет экраны от бота."""
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.user_id = user_id
+        self.inbox = harness.bot.inboxes[user_id]
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f"Пользователь {user_id}"}
+        self.chat = {'id': user_id, 'type': 'private'}
+
+    async def send(self, payload, step, expect):
+        """Отправляет обновление и ждет сообщение, для которого expect(message) истинно."""
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+        update = Update.de_json({'update_id': next(self.update_ids), **payload}, self.harness.application.bot)
+        started = time.perf_counter()
+        await self.harness.application.process_update(update)
+        deadline = started + self.harness.timeout
+        while True:
+            try:
+                message = await asyncio.wait_for(self.inbox.get(), max(deadline - time.perf_counter(), 0.001))
+            except asyncio.TimeoutError:
+                self.harness.record(step, None)
+                raise StepFailed(step) from None
+            if expect(message):
+                self.harness.record(step, time.perf_counter() - started)
+                return message
+
+    async def command(self, text, step, expect):
+        return await self.send({'message': {
+            'message_id': next(self.harness.bot.message_ids), 'date': int(time.time()),
+            'chat': self.chat, 'from': self.user, 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        }}, step, expect)
+
+    async def click(self, message, data, step, expect):
+        return await self.send({'callback_query': {
+            'id': str(next(self.update_ids)), 'from': self.user, 'chat_instance': str(self.user_id),
+            'message': message, 'data': data,
+        }}, step, expect)
+
+    async def think(self):
+        if self.harness.think_time:
+            await asyncio.sleep(random.expovariate(1 / self.harness.think_time))
+
+    async def run(self, categories, rounds):
+        def has(action):
+            return lambda message: find_callback(message, action) is not None
+
+        def card_or_failure(category):
+            failures = {main.SCREENS[('not_found', category)].text, main.SCREENS[('fetch_error', category)].text}
+
+            def expect(message):
+                if message.get('text') in failures:
+                    self.harness.record('recommendation_failed', 0)
+                    return True
+                return find_callback(message, 'rate') is not None
+            return expect
+
+        menu = await self.command('/start', 'start', has('category'))
+        for _ in range(rounds):
+            category = random.choice(categories)
+            await self.think()
+            genres = await self.click(menu, find_callback(menu, 'category', category), 'open_category', has('genre'))
+            await self.think()
+            card = await self.click(genres, find_callback(genres, 'genre'), 'recommendation', card_or_failure(category))
+            if find_callback(card, 'rate') is None:
+                menu = await self.click(card, find_callback(card, 'menu'), 'back_to_menu', has('category'))
+                continue
+
+            await self.think()
+            rating = random.choice(('1', '5', '5'))
+            rate_data = next(data for callback, data in callbacks(card)
+                             if callback.action == 'rate' and str(callback.rating) == rating)
+            actions = await self.click(card, rate_data, 'rate', has('random'))
+            await self.think()
+            if category != 'music':
+                # «Еще» у фильмов и книг сразу присылает новую карточку
+                card = await self.click(actions, find_callback(actions, 'random'), 'more', card_or_failure(category))
+                actions = card if find_callback(card, 'menu') else actions
+            menu = await self.click(actions, find_callback(actions, 'menu'), 'back_to_menu', has('category'))
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.timeout = args.timeout
+        self.think_time = args.think_ms / 1000
+        profiles = {provider: ProviderProfile(*DEFAULT_LATENCY[provider]) for provider in PROVIDERS}
+        for spec in args.latency:
+            provider, _, value = spec.partition('=')
+            median, _, sigma = value.partition(':')
+            profiles[provider].median = float(median) / 1000
+            if sigma:
+                profiles[provider].sigma = float(sigma)
+        for option, attribute in ((args.errors, 'error_rate'), (args.rate_limits, 'rate_limit_rate')):
+            for spec in option:
+                provider, _, value = spec.partition('=')
+                setattr(profiles[provider], attribute, float(value))
+        self.upstream = UpstreamStub(profiles)
+        self.bot = BotApiStub(profiles['telegram'])
+        self.server = StubServer(self.route)
+        self.application = None
+        self.timings = defaultdict(list)
+        self.failures = Counter()
+
+    async def route(self, method, host, target, body):
+        if target.startswith('/bot'):
+            return await self.bot.handle(method, host, target, body)
+        return await self.upstream.handle(method, host, target, body)
+
+    def record(self, step, seconds):
+        if seconds is None:
+            self.failures[step] += 1
+        else:
+            self.timings[step].append(seconds)
+
+    async def start(self):
+        await self.server.start()
+        main._http_client = httpx.AsyncClient(timeout=10, transport=StubRoutingTransport(self.server.port))
+        main.init_db()
+        self.application = main.build_application(
+            BOT_TOKEN, base_url=f"http://127.0.0.1:{self.server.port}/bot",
+            concurrent_updates=self.args.concurrent_updates if self.args.concurrent_updates > 1 else False,
+        )
+        await self.application.initialize()
+        await self.application.start()
+        await main.on_startup(self.application)
+        print("прогрев кэшей, запросы к провайдерам:")
+        self.print_upstream_calls()
+
+    async def stop(self):
+        await self.application.stop()
+        await main.on_shutdown(self.application)
+        await self.application.shutdown()
+        await self.server.stop()
+
+    def begin_run(self):
+        """Сбрасывает замеры прогона; возвращает счетчики бота на начало прогона для report."""
+        self.timings.clear()
+        self.failures.clear()
+        self.upstream.calls.clear()
+        self.bot.calls.clear()
+        return {
+            'quotas': main.get_quota_metrics(),
+            'counters': Counter(main.metrics.counters),
+            'cache': Counter(main.provider_cache.stats),
+        }
+
+    async def run_scenario(self, name, first_user_id):
+        before = self.begin_run()
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        aborted = Counter()
+
+        async def user_session(user_id):
+            async with semaphore:
+                try:
+                    await SimulatedUser(self, user_id).run(SCENARIOS[name], self.args.rounds)
+                except StepFailed as e:
+                    aborted[str(e)] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_session(first_user_id + i) for i in range(self.args.users)))
+        elapsed = time.perf_counter() - started
+        self.report(f"сценарий {name}: пользователей {self.args.users}", elapsed, aborted, before)
+
+    def print_upstream_calls(self):
+        by_endpoint = defaultdict(list)
+        for (provider, endpoint, status), count in sorted(self.upstream.calls.items()):
+            by_endpoint[(provider, endpoint)].append(f"{status} x{count}")
+        for (provider, endpoint), statuses in by_endpoint.items():
+            print(f"    {provider} {endpoint}: {', '.join(statuses)}")
+        if not by_endpoint:
+            print("    нет (ответы взяты из кэша)")
+
+    def report(self, title, elapsed, aborted, before):
+        steps = sum(len(values) for values in self.timings.values())
+        print(f"\n{title}, шагов {steps} за {elapsed:.1f} с "
+              f"({steps / elapsed:.0f} шагов/с), прервано сессий {sum(aborted.values())}")
+        print(f"  {'шаг':<22}{'n':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'таймаутов':>11}")
+        for step in sorted(set(self.timings) | set(self.failures)):
+            values = sorted(self.timings.get(step, []))
+            if values and step != 'recommendation_failed':
+                p50, p95, p99 = (values[min(int(len(values) * q), len(values) - 1)] * 1000 for q in (0.5, 0.95, 0.99))
+                print(f"  {step:<22}{len(values):>7}{p50:>10.0f}{p95:>10.0f}{p99:>10.0f}{self.failures[step]:>11}")
+            else:
+                print(f"  {step:<22}{len(values):>7}{'':>30}{self.failures[step]:>11}")
+
+        print("  запросы к провайдерам:")
+        self.print_upstream_calls()
+        print(f"  Bot API: {', '.join(f'{method} {count}' for method, count in self.bot.calls.most_common())}")
+
+        cache = Counter(main.provider_cache.stats) - before['cache']
+        lookups = cache['hit'] + cache['stale'] + cache['negative'] + cache['miss']
+        if lookups:
+            print(f"  кэш провайдеров: попаданий {(lookups - cache['miss']) / lookups:.1%} из {lookups} "
+                  f"(свежих {cache['hit']}, устаревших {cache['stale']}, пустых {cache['negative']}, "
+                  f"объединено запросов {cache['coalesced']})")
+        counters = Counter(main.metrics.counters) - before['counters']
+        catalog = {dict(labels)['result']: count for (name, labels), count in counters.items()
+                   if name == 'bot_item_catalog_lookups_total'}
+        if catalog:
+            print(f"  каталог в памяти: попаданий {catalog.get('hit', 0)}, промахов {catalog.get('miss', 0)}")
+
+        quotas = main.get_quota_metrics()
+        shed = {provider: quotas[provider]['shed'] - before['quotas'][provider]['shed'] for provider in quotas}
+        if any(shed.values()):
+            print(f"  отклонено по квоте: {', '.join(f'{p} {n}' for p, n in shed.items() if n)}")
+        fallbacks = {key: count for key, count in counters.items() if key[0] == 'bot_fallbacks_total'}
+        if fallbacks:
+            print("  запасные рекомендации: " + ', '.join(
+                f"{dict(labels)['category']}/{dict(labels)['source']} {count}"
+                for (_, labels), count in sorted(fallbacks.items())))
+
+
+async def run(args):
+    harness = Harness(args)
+    await harness.start()
+    try:
+        scenarios = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+        for index, name in enumerate(scenarios):
+            # Пользователи разных сценариев не пересекаются: у каждого своя история и состояние диалога
+            await harness.run_scenario(name, first_user_id=1_000_000 * (index + 1))
+    finally:
+        await harness.stop()
+
+
+def add_stub_arguments(parser):
+    """Параметры заглушек и бота, общие для нагрузочного стенда и воспроизведения трафика."""
+    parser.add_argument('--timeout', type=float, default=15, help="ожидание экрана, секунды")
+    parser.add_argument('--latency', action='append', default=[], metavar='ПРОВАЙДЕР=МЕДИАНА_МС[:РАЗБРОС]',
+                        help=f"задержка заглушки ({', '.join(PROVIDERS)})")
+    parser.add_argument('--errors', action='append', default=[], metavar='ПРОВАЙДЕР=ДОЛЯ', help="доля ответов 500")
+    parser.add_argument('--rate-limits', action='append', default=[], metavar='ПРОВАЙДЕР=ДОЛЯ', help="доля ответов 429")
+    parser.add_argument('--concurrent-updates', type=int, default=1,
+                        help="обновлений, обрабатываемых одновременно (1 - как в main(), по очереди)")
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['all'], default='all', help="набор категорий")
+    parser.add_argument('--users', type=int, default=500, help="пользователей в сценарии")
+    parser.add_argument('--concurrency', type=int, default=100, help="одновременно активных пользователей")
+    parser.add_argument('--rounds', type=int, default=3, help="рекомендаций на пользователя")
+    parser.add_argument('--think-ms', type=float, default=0, help="средняя пауза пользователя между нажатиями")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    # БД бота создается во временном каталоге, рабочая не затрагивается
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,197 @@
+"""
+Бенчмарк: объем загружаемых данных и время разбора JSON на одну рекомендацию.
+
+Фиктивный Google Books отвечает полными томами (как настоящий API) и, как и
+настоящий, применяет проекцию полей из параметра fields. Сравниваются запросы
+без проекции и с GOOGLE_BOOKS_SEARCH_FIELDS. Для TMDB выводится объем ответа
+discover, который уже не требует дополнительных запросов.
+Запуск из корня репозитория:
+
+    python benchmarks/payload_size.py --cards 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+DESCRIPTION = "Длинное описание книги с подробным пересказом сюжета. " * 30
+
+
+def make_volume(index):
+    volume_id = f"vol{index:05d}"
+    return {
+        'kind': 'books#volume',
+        'id': volume_id,
+        'etag': f"etag{index}",
+        'selfLink': f"https://www.googleapis.com/books/v1/volumes/{volume_id}",
+        'volumeInfo': {
+            'title': f"Книга {index}",
+            'subtitle': "Подзаголовок",
+            'authors': ['Автор Первый', 'Автор Второй'],
+            'publisher': "Издательство",
+            'publishedDate': '2018-09-01',
+            'description': DESCRIPTION,
+            'industryIdentifiers': [
+                {'type': 'ISBN_13', 'identifier': f"978500000{index:04d}"},
+                {'type': 'ISBN_10', 'identifier': f"500000{index:04d}"},
+            ],
+            'readingModes': {'text': True, 'image': True},
+            'pageCount': 384,
+            'printType': 'BOOK',
+            'categories': ['Fiction'],
+            'maturityRating': 'NOT_MATURE',
+            'allowAnonLogging': True,
+            'contentVersion': '1.2.3.0.preview.3',
+            'panelizationSummary': {'containsEpubBubbles': False, 'containsImageBubbles': False},
+            'imageLinks': {
+                'smallThumbnail': f"http://books.google.com/books/content?id={volume_id}&zoom=5",
+                'thumbnail': f"http://books.google.com/books/content?id={volume_id}&zoom=1",
+            },
+            'language': 'ru',
+            'previewLink': f"http://books.google.ru/books?id={volume_id}&printsec=frontcover",
+            'infoLink': f"http://books.google.ru/books?id={volume_id}&source=gbs_api",
+            'canonicalVolumeLink': f"https://books.google.com/books/about/?id={volume_id}",
+        },
+        'saleInfo': {
+            'country': 'RU', 'saleability': 'FOR_SALE', 'isEbook': True,
+            'listPrice': {'amount': 349.0, 'currencyCode': 'RUB'},
+            'retailPrice': {'amount': 299.0, 'currencyCode': 'RUB'},
+            'buyLink': f"https://play.google.com/store/books/details?id={volume_id}",
+            'offers': [{'finskyOfferType': 1, 'listPrice': {'amountInMicros': 349000000, 'currencyCode': 'RUB'}}],
+        },
+        'accessInfo': {
+            'country': 'RU', 'viewability': 'PARTIAL', 'embeddable': True, 'publicDomain': False,
+            'textToSpeechPermission': 'ALLOWED',
+            'epub': {'isAvailable': True, 'acsTokenLink': f"http://books.google.ru/books/download/{volume_id}.epub"},
+            'pdf': {'isAvailable': True, 'acsTokenLink': f"http://books.google.ru/books/download/{volume_id}.pdf"},
+            'webReaderLink': f"http://play.google.com/books/reader?id={volume_id}",
+            'accessViewStatus': 'SAMPLE', 'quoteSharingAllowed': False,
+        },
+        'searchInfo': {'textSnippet': "Фрагмент текста, найденный поиском по запросу пользователя."},
+    }
+
+
+def parse_fields(spec, start=0):
+    """Разбирает выражение fields Google API в дерево {поле: поддерево или None}."""
+    tree = {}
+    i = start
+    while i < len(spec):
+        j = i
+        while j < len(spec) and spec[j] not in ',()':
+            j += 1
+        path = spec[i:j].split('/')
+        subtree = None
+        if j < len(spec) and spec[j] == '(':
+            subtree, j = parse_fields(spec, j + 1)
+            j += 1
+        node = tree
+        for name in path[:-1]:
+            node = node.setdefault(name, {})
+        node[path[-1]] = subtree
+        if j < len(spec) and spec[j] == ')':
+            return tree, j
+        i = j + 1
+    return tree, i
+
+
+def project(data, tree):
+    if tree is None:
+        return data
+    if isinstance(data, list):
+        return [project(item, tree) for item in data]
+    return {name: project(data[name], subtree) for name, subtree in tree.items() if name in data}
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.bodies = []
+
+    def __call__(self, request):
+        path = request.url.path
+        if path.endswith('/discover/movie'):
+            payload = {'page': 1, 'total_pages': 500, 'total_results': 10000, 'results': [
+                {
+                    'adult': False, 'backdrop_path': f"/backdrop{i}.jpg", 'genre_ids': [28, 12],
+                    'id': i, 'original_language': 'en', 'original_title': f"Movie {i}",
+                    'overview': "Описание фильма. " * 15, 'popularity': 100.0 + i,
+                    'poster_path': f"/poster{i}.jpg", 'release_date': '2022-03-04',
+                    'title': f"Фильм {i}", 'video': False, 'vote_average': 7.3, 'vote_count': 1200,
+                } for i in range(1, 21)
+            ]}
+        elif path.endswith('/genre/movie/list'):
+            payload = {'genres': [{'id': 28, 'name': 'боевик'}, {'id': 12, 'name': 'приключения'}]}
+        elif path == '/books/v1/volumes':
+            payload = {'kind': 'books#volumes', 'totalItems': 1000, 'items': [make_volume(i) for i in range(40)]}
+            fields = request.url.params.get('fields')
+            if fields:
+                payload = project(payload, parse_fields(fields)[0])
+        else:
+            return httpx.Response(404, json={})
+
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.bodies.append((request.url.host, body))
+        return httpx.Response(200, content=body, headers={'Content-Type': 'application/json'})
+
+
+def measure_parse_time(bodies, repeats=20):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for _, body in bodies:
+            json.loads(body)
+    return (time.perf_counter() - started) / repeats
+
+
+async def collect(fetch, genre, cards):
+    upstream = FakeUpstream()
+    main._http_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+    for user_id in range(1, cards + 1):
+        # Измеряем каждый ответ провайдера, а не попадания в кэш
+        main.provider_cache.entries.clear()
+        await fetch(genre, user_id)
+    await main.close_http_client()
+    return upstream.bodies
+
+
+def report(name, bodies, cards):
+    total_bytes = sum(len(body) for _, body in bodies)
+    parse_time = measure_parse_time(bodies)
+    print(f"{name}: {total_bytes / cards / 1024:.1f} КБ и {parse_time / cards * 1000:.3f} мс разбора JSON на рекомендацию")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cards', type=int, default=20, help="рекомендаций на сценарий")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    main.TMDB_API_KEY = main.TMDB_API_KEY or 'benchmark'
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    try:
+        main.init_db()
+        projected_fields = main.GOOGLE_BOOKS_SEARCH_FIELDS
+
+        main.GOOGLE_BOOKS_SEARCH_FIELDS = None
+        report("book, полные тома", asyncio.run(collect(main.get_book_recommendations, 'fiction', args.cards)), args.cards)
+
+        main.GOOGLE_BOOKS_SEARCH_FIELDS = projected_fields
+        report("book, fields=", asyncio.run(collect(main.get_book_recommendations, 'fiction', args.cards)), args.cards)
+
+        report("movie, discover", asyncio.run(collect(main.get_movie_recommendations, '28', args.cards)), args.cards)
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,91 @@
+"""
+Бенчмарк: стоимость отрисовки экранов и карточек на одно нажатие кнопки.
+
+Сравнивает прежний способ (клавиатура и текст собираются заново при каждом
+нажатии) и текущий (постоянные экраны берутся из SCREENS, карточка
+подставляет значения в заранее экранированный шаблон). В замер карточки
+входит экранирование значений для MarkdownV2, которого прежний код не делал.
+Запуск из корня репозитория:
+
+    python benchmarks/render_cost.py --clicks 20000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def legacy_genre_menu(category):
+    """Меню жанров в прежнем виде: новые кнопки и callback_data на каждое нажатие."""
+    menu = main.GENRE_MENUS[category]
+    buttons = [
+        InlineKeyboardButton(label, callback_data=main.encode_callback('genre', category, genre=genre))
+        for label, genre in menu['genres']
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([
+        InlineKeyboardButton(menu['random_label'], callback_data=main.encode_callback('random', category)),
+        InlineKeyboardButton("◀️ Назад", callback_data=main.encode_callback('menu'))
+    ])
+    return menu['title'], InlineKeyboardMarkup(keyboard)
+
+
+def legacy_movie_card(movie):
+    """Карточка фильма в прежнем виде: f-строка и клавиатура собираются целиком."""
+    message_text = (
+        f"🎬 *{movie.title}*\n"
+        f"({movie.subtitle}, {movie.year})\n\n"
+        f"⭐ Рейтинг: {movie.rating}/10\n"
+        f"🎭 Жанры: {movie.genres}\n\n"
+        f"📝 *Описание:*\n{movie.description}"
+    )
+    genre_code = main.genre_codes.code_for(movie.genres)
+    keyboard = [
+        [
+            InlineKeyboardButton("👍 Нравится", callback_data=main.encode_callback(
+                'rate', 'movie', item_id=movie.id, rating=5, genre_code=genre_code)),
+            InlineKeyboardButton("👎 Не нравится", callback_data=main.encode_callback(
+                'rate', 'movie', item_id=movie.id, rating=1, genre_code=genre_code))
+        ],
+        [InlineKeyboardButton(main.MORE_BUTTON_LABELS['movie'], callback_data=main.encode_callback('random', 'movie'))],
+        [InlineKeyboardButton("◀️ Назад к жанрам", callback_data=main.encode_callback('category', 'movie'))]
+    ]
+    return message_text, InlineKeyboardMarkup(keyboard), movie.image_url
+
+
+def per_click(func, clicks):
+    """Среднее время одного вызова в микросекундах."""
+    return timeit.timeit(func, number=clicks) / clicks * 1e6
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clicks', type=int, default=20000, help="нажатий на каждый замер")
+    args = parser.parse_args()
+
+    movie = main.ItemRecord(
+        'movie', '603', "Матрица", subtitle="The Matrix", year='1999', rating=8.2,
+        genres="боевик, фантастика", description="Хакер Нео узнает правду о мире. " * 8,
+        image_url="https://image.tmdb.org/t/p/w500/poster.jpg",
+    )
+    main.genre_codes.remember(1, movie.genres)
+
+    rows = [
+        ("меню жанров", lambda: legacy_genre_menu('book'), lambda: main.SCREENS[('genre_menu', 'book')]),
+        ("карточка фильма", lambda: legacy_movie_card(movie), lambda: main.render_card(movie)),
+    ]
+    print(f"нажатий на замер: {args.clicks}")
+    for name, legacy, current in rows:
+        legacy_us = per_click(legacy, args.clicks)
+        current_us = per_click(current, args.clicks)
+        print(f"{name}: сборка при нажатии {legacy_us:.1f} мкс, реестр экранов {current_us:.1f} мкс "
+              f"({legacy_us / current_us:.1f}x)")
+
+
+if __name__ == '__main__':
+    main_cli()
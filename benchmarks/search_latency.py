@@ -0,0 +1,92 @@
+"""
+Бенчмарк: задержка локального поиска по каталогу (FTS5).
+
+Заполняет временную БД элементами и замеряет search_items без обращения
+к провайдерам на запросах, которые набираются по буквам, как в inline-режиме.
+Запуск из корня репозитория:
+
+    python benchmarks/search_latency.py --items 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+SYLLABLES = [
+    "ма", "ра", "ка", "ло", "ви", "не", "то", "зо", "ги", "бу", "де", "ри", "ан", "ос", "ту",
+    "ле", "ни", "ко", "са", "ве", "ро", "ми", "да", "пе", "ча", "ше", "ду", "ль", "ск", "ой",
+]
+
+
+def make_vocabulary(size):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(random.choices(SYLLABLES, k=random.randint(2, 4))))
+    return sorted(words)
+
+
+def make_records(count, vocabulary):
+    # В описаниях частоты слов распределены по закону Ципфа, как в обычном тексте;
+    # слова названий почти не повторяются между элементами
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    records = []
+    for i in range(count):
+        title = ' '.join(random.choices(vocabulary, k=random.randint(1, 4))).capitalize()
+        category = ('movie', 'music', 'book')[i % 3]
+        records.append(main.ItemRecord(
+            category, f"bench{i}", title, subtitle=random.choice(vocabulary),
+            creator=f"Автор {i % 500}", year=str(1950 + i % 70),
+            description=' '.join(random.choices(vocabulary, weights, k=40)),
+        ))
+    return records
+
+
+def keystrokes(word):
+    """Запросы, которые приходят в inline-режиме при наборе слова."""
+    return [word[:length] for length in range(2, len(word) + 1)]
+
+
+async def run(args):
+    main.init_db()
+    vocabulary = make_vocabulary(20000)
+    records = make_records(args.items, vocabulary)
+    started = time.perf_counter()
+    await main.run_db(main.upsert_items, records)
+    print(f"элементов: {args.items}, запись с индексацией: {time.perf_counter() - started:.2f} с")
+
+    # Набор по буквам названий существующих элементов и короткие префиксы частых слов
+    queries = [query for record in random.sample(records, 10) for query in keystrokes(record.title)]
+    queries += [vocabulary[0][:2], vocabulary[1][:3], "автор 42"]
+    timings = []
+    for _ in range(args.rounds):
+        for query in queries:
+            started = time.perf_counter()
+            await main.search_items(query, allow_upstream=False)
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"запросов: {len(timings)}, медиана {statistics.median(timings):.2f} мс, "
+          f"p95 {timings[int(len(timings) * 0.95)]:.2f} мс, максимум {timings[-1]:.2f} мс")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=50000, help="элементов в каталоге")
+    parser.add_argument('--rounds', type=int, default=5, help="повторов набора запросов")
+    args = parser.parse_args()
+
+    random.seed(1)
+    # БД создается во временном каталоге, рабочая не затрагивается
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main_cli()
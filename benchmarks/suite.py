@@ -0,0 +1,267 @@
+"""
+Набор бенчмарков горячих путей: запись в БД, исключение истории, выбор кандидата, отрисовка.
+
+Каждый замер повторяется несколько раз (число вызовов в повторе подбирается так,
+чтобы повтор длился не меньше --min-time), в результат попадают медиана, минимум,
+среднее и разброс времени одного вызова. Результаты сохраняются в JSON, а режим
+сравнения отмечает замеры, медиана которых выросла больше порога относительно
+сохраненного базового прогона. Запуск из корня репозитория:
+
+    python benchmarks/suite.py --save benchmarks/baseline.json
+    python benchmarks/suite.py --compare benchmarks/baseline.json --threshold 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+HISTORY_SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+# Записей в истории у пользователя, для которого ищутся уже рекомендованные элементы
+USER_HISTORY = 200
+CANDIDATES = 20
+
+
+class Case:
+    """Замер: имя, функция без аргументов и необязательная подготовка перед повторами."""
+    __slots__ = ('name', 'func', 'setup')
+
+    def __init__(self, name, func, setup=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+
+
+def measure(func, repeats, min_time):
+    """Время одного вызова в микросекундах для каждого повтора."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 5 or number >= 1 << 20:
+            break
+        number *= 2
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number * 1e6)
+    return number, timings
+
+
+def summarize(number, timings):
+    median = statistics.median(timings)
+    return {
+        'median_us': round(median, 3),
+        'min_us': round(min(timings), 3),
+        'mean_us': round(statistics.fmean(timings), 3),
+        'stdev_us': round(statistics.stdev(timings), 3) if len(timings) > 1 else 0.0,
+        'ops_per_s': round(1e6 / median, 1),
+        'repeats': len(timings),
+        'calls_per_repeat': number,
+    }
+
+
+# Запись: каждый вызов открывает соединение и фиксирует транзакцию, как в обработчиках
+
+def storage_cases():
+    counter = iter(range(10 ** 9))
+
+    def save_history():
+        main.save_recommendation_history(next(counter) % 5000, 'movie', str(next(counter)))
+
+    def save_preference():
+        main.save_preference(next(counter) % 5000, 'movie', 'боевик, комедия', str(next(counter) % 20000), 5)
+
+    return [
+        Case('storage.save_recommendation_history', save_history),
+        Case('storage.save_preference', save_preference),
+    ]
+
+
+# Исключение истории: fetch_recommended_ids на таблице заданного размера
+
+def fill_history(path, rows):
+    """История из rows записей; у пользователя 1 ровно USER_HISTORY фильмов."""
+    conn = sqlite3.connect(path)
+    conn.execute('DELETE FROM recommendation_history')
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    own = [(1, 'movie', str(i), date) for i in range(USER_HISTORY)]
+    others = (
+        (2 + i % 50000, ('movie', 'music', 'book')[i % 3], str(i), date)
+        for i in range(max(0, rows - USER_HISTORY))
+    )
+    conn.executemany('''
+    INSERT INTO recommendation_history (user_id, category, item_id, recommendation_date) VALUES (?, ?, ?, ?)
+    ''', own)
+    conn.executemany('''
+    INSERT INTO recommendation_history (user_id, category, item_id, recommendation_date) VALUES (?, ?, ?, ?)
+    ''', others)
+    conn.commit()
+    conn.close()
+
+
+def history_cases(sizes):
+    conn = main.get_db_connection()
+    cases = []
+    for label in sizes:
+        cases.append(Case(
+            f'history.exclusion[{label}]',
+            lambda: main.fetch_recommended_ids(conn, 1, 'movie'),
+            setup=lambda rows=HISTORY_SIZES[label]: fill_history('user_preferences.db', rows),
+        ))
+    return cases
+
+
+# Выбор кандидата: отбор еще не рекомендованных и взвешенный выбор, как в get_movie_recommendations
+
+def selection_cases():
+    candidates = [{'id': 1000 + i, 'title': f"Фильм {i}"} for i in range(CANDIDATES)]
+    recommended_ids = {str(1000 + i) for i in range(0, CANDIDATES, 3)}
+    for i in range(CANDIDATES):
+        main.trending.record('movie', 1000 + i, 'боевик', impressions=i, likes=i % 4)
+
+    def filter_and_pick():
+        filtered = [movie for movie in candidates if str(movie['id']) not in recommended_ids]
+        return main.pick_candidate('movie', filtered or candidates)
+
+    return [
+        Case('selection.filter_and_pick', filter_and_pick),
+        Case('selection.pick_candidate', lambda: main.pick_candidate('movie', candidates)),
+    ]
+
+
+# Отрисовка: текст карточки (MarkdownV2) и карточка с клавиатурой
+
+def render_cases():
+    movie = main.ItemRecord(
+        'movie', '603', "Матрица", subtitle="The Matrix", year='1999', rating=8.2,
+        genres="боевик, фантастика", description="Хакер Нео узнает правду о мире. " * 8,
+        image_url="https://image.tmdb.org/t/p/w500/poster.jpg",
+    )
+    track = main.ItemRecord(
+        'music', 'track1', "Кукушка", creator="Кино", subtitle="Черный альбом",
+        image_url="https://i.scdn.co/image/cover", link="https://open.spotify.com/track/1",
+    )
+    main.genre_codes.remember(1, movie.genres)
+    return [
+        Case('render.card_text[movie]', lambda: main.render_card_text(movie)),
+        Case('render.card[movie]', lambda: main.render_card(movie)),
+        Case('render.card[music]', lambda: main.render_card(track)),
+        Case('render.build_screens', main.build_screens),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_cases(cases, args):
+    results = {}
+    for case in cases:
+        if args.filter and args.filter not in case.name:
+            continue
+        if case.setup:
+            case.setup()
+        number, timings = measure(case.func, args.repeats, args.min_time)
+        results[case.name] = summarize(number, timings)
+        result = results[case.name]
+        print(f"{case.name:<40} {result['median_us']:>12.2f} мкс  "
+              f"(мин {result['min_us']:.2f}, ±{result['stdev_us']:.2f}, {result['ops_per_s']:.0f} оп/с)")
+    return results
+
+
+def compare(results, baseline, threshold, partial=False):
+    """Печатает сравнение медиан с базовым прогоном; возвращает имена регрессий."""
+    regressions = []
+    print(f"\nсравнение с базовым прогоном {baseline['meta'].get('revision') or ''} (порог +{threshold:.0%}):")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f"  {name:<40} новый замер")
+            continue
+        ratio = result['median_us'] / base['median_us']
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = '  РЕГРЕССИЯ'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            mark = '  быстрее'
+        print(f"  {name:<40} {base['median_us']:>10.2f} -> {result['median_us']:>10.2f} мкс  x{ratio:.2f}{mark}")
+    for name in sorted(baseline['results'].keys() - results.keys()) if not partial else ():
+        print(f"  {name:<40} нет в текущем прогоне")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1k,100k,1m',
+                        help="размеры истории для замера исключения через запятую: " + ', '.join(HISTORY_SIZES))
+    parser.add_argument('--repeats', type=int, default=7, help="повторов каждого замера")
+    parser.add_argument('--min-time', type=float, default=0.2, help="минимальная длительность повтора, с")
+    parser.add_argument('--filter', help="только замеры, в имени которых есть эта строка")
+    parser.add_argument('--save', help="сохранить результаты в JSON")
+    parser.add_argument('--compare', help="JSON базового прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="допустимый рост медианы относительно базового прогона")
+    args = parser.parse_args()
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in HISTORY_SIZES]
+    if unknown:
+        parser.error(f"неизвестные размеры истории: {', '.join(unknown)}")
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+    save_path = os.path.abspath(args.save) if args.save else None
+
+    random.seed(1)
+    # БД создается во временном каталоге, рабочая не затрагивается
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        main.init_db()
+        cases = storage_cases() + history_cases(sizes) + selection_cases() + render_cases()
+        results = run_cases(cases, args)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'repeats': args.repeats,
+            'min_time': args.min_time,
+        },
+        'results': results,
+    }
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"\nрезультаты сохранены в {save_path}")
+    if baseline is not None and compare(results, baseline, args.threshold, partial=bool(args.filter)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
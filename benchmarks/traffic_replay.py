@@ -0,0 +1,332 @@
+"""
+Воспроизведение трафика: сессии пользователей из снимка рабочей БД против бота на заглушках.
+
+Читает recommendation_history и user_preferences из снимка (только чтение),
+восстанавливает сессии пользователей (перерыв больше --session-gap начинает
+новую сессию с /start): переход в категорию и выбор жанра, циклы «🔄 Еще»
+(следующий показ той же категории не позже --loop-gap), оценки и возврат в меню.
+Жанр кнопки определяется по жанрам элемента из таблицы items или оценки; если он
+не совпадает ни с одной кнопкой, нажимается случайная рекомендация.
+
+Сессии проигрываются с исходными интервалами, ускоренными в --speed раз, против
+бота на заглушках из load_harness.py. Заглушки возвращают синтетические элементы,
+поэтому воспроизводится последовательность действий, а не сами рекомендации.
+Возраст записей кэша провайдеров считается по часам, ускоренным в то же число
+раз, чтобы доля попаданий соответствовала исходному темпу; квоты провайдеров
+работают в реальном времени. БД бота - копия снимка во временном каталоге.
+Запуск из корня репозитория:
+
+    python benchmarks/traffic_replay.py snapshot.db --speed 1 --since "2024-05-01 18:00" --hours 1
+    python benchmarks/traffic_replay.py snapshot.db --speed 100 --max-users 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load_harness import (  # noqa: E402
+    Harness, SimulatedUser, StepFailed, add_stub_arguments, callbacks, find_callback,
+)
+import main  # noqa: E402
+
+# Пауза перед оценкой, если за показом в сессии больше ничего не было, секунды
+RATE_DELAY = 10
+
+
+class Action:
+    """Действие пользователя в момент at (секунды от начала эпохи по времени записи)."""
+
+    __slots__ = ('at', 'step', 'category', 'genre', 'rating')
+
+    def __init__(self, at, step, category=None, genre=None, rating=None):
+        self.at = at
+        self.step = step
+        self.category = category
+        self.genre = genre
+        self.rating = rating
+
+
+class ScaledClock:
+    """Монотонные часы, идущие в speed раз быстрее настоящих."""
+
+    __slots__ = ('origin', 'speed')
+
+    def __init__(self, speed):
+        self.origin = time.monotonic()
+        self.speed = speed
+
+    def __call__(self):
+        return self.origin + (time.monotonic() - self.origin) * self.speed
+
+
+def menu_genre(category, genres):
+    """Ключ кнопки жанра для жанров элемента; None, если подходящей кнопки нет."""
+    genres = (genres or '').lower()
+    for label, genre in main.GENRE_MENUS[category]['genres']:
+        if label.lower() in genres or genre in genres.replace(' ', '-').split(', '):
+            return genre
+    return None
+
+
+def load_events(path, since, until):
+    """Показы из снимка: [(user_id, время, категория, жанры, оценка)] по времени."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    has_items = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'items'").fetchone()
+    preferences = {}
+    for row in conn.execute('SELECT user_id, category, genre, item_id, rating FROM user_preferences ORDER BY id'):
+        preferences[(row['user_id'], row['category'], row['item_id'])] = (row['rating'], row['genre'])
+
+    items_join = 'LEFT JOIN items ON items.category = h.category AND items.item_id = h.item_id' if has_items else ''
+    item_genres = 'items.genres' if has_items else 'NULL'
+    rows = conn.execute(f'''
+    SELECT h.user_id, h.category, h.item_id, h.recommendation_date, {item_genres} AS genres
+    FROM recommendation_history AS h {items_join}
+    WHERE h.recommendation_date >= ? AND h.recommendation_date < ?
+    ORDER BY h.recommendation_date, h.id
+    ''', (since, until)).fetchall()
+    conn.close()
+
+    events = []
+    for row in rows:
+        if row['category'] not in main.GENRE_MENUS:
+            continue
+        rating, rated_genre = preferences.get((row['user_id'], row['category'], row['item_id']), (None, None))
+        at = datetime.strptime(row['recommendation_date'], "%Y-%m-%d %H:%M:%S").timestamp()
+        events.append((row['user_id'], at, row['category'], row['genres'] or rated_genre, rating))
+    return events
+
+
+def build_sessions(events, session_gap, loop_gap):
+    """Действия каждого пользователя: user_id -> [Action] в порядке времени."""
+    by_user = defaultdict(list)
+    for user_id, at, category, genres, rating in events:
+        by_user[user_id].append((at, category, genres, rating))
+
+    actions = {}
+    for user_id, shows in by_user.items():
+        user_actions = []
+        previous = None
+        for index, (at, category, genres, rating) in enumerate(shows):
+            if previous is None or at - previous[0] > session_gap:
+                user_actions.append(Action(at, 'start'))
+                previous = None
+            if previous is not None and previous[1] == category and at - previous[0] <= loop_gap:
+                user_actions.append(Action(at, 'more', category))
+                if category == 'music':
+                    # «Еще музыка» возвращает к выбору жанра
+                    user_actions.append(Action(at, 'genre', category, menu_genre(category, genres)))
+            else:
+                if previous is not None:
+                    user_actions.append(Action(at, 'menu'))
+                user_actions.append(Action(at, 'category', category))
+                user_actions.append(Action(at, 'genre', category, menu_genre(category, genres)))
+            if rating is not None:
+                # Время оценки не записывается: середина паузы до следующего показа сессии
+                following = shows[index + 1][0] if index + 1 < len(shows) else None
+                if following is not None and following - at <= session_gap:
+                    rated_at = at + (following - at) / 2
+                else:
+                    rated_at = at + RATE_DELAY
+                user_actions.append(Action(rated_at, 'rate', category, rating=5 if rating >= 3 else 1))
+            previous = (at, category)
+        actions[user_id] = user_actions
+    return actions
+
+
+class Desync(Exception):
+    """На экране пользователя нет кнопки, которую он нажал в записанной сессии."""
+
+
+class ReplayUser(SimulatedUser):
+    """Пользователь, повторяющий записанные действия с исходными интервалами."""
+
+    def __init__(self, harness, user_id, replay):
+        super().__init__(harness, user_id)
+        self.replay = replay
+        self.screen = None
+        self.card = None
+
+    def button(self, message, action, category=None):
+        data = find_callback(message, action, category) if message else None
+        if data is None:
+            raise Desync(action)
+        return data
+
+    def card_or_failure(self, category):
+        failures = {main.SCREENS[('not_found', category)].text, main.SCREENS[('fetch_error', category)].text}
+
+        def expect(message):
+            if message.get('text') in failures:
+                self.harness.record('recommendation_failed', 0)
+                return True
+            return find_callback(message, 'rate') is not None
+        return expect
+
+    async def perform(self, action):
+        def has(button_action):
+            return lambda message: find_callback(message, button_action) is not None
+
+        step, category = action.step, action.category
+        if step == 'start':
+            self.screen = await self.command('/start', 'start', has('category'))
+        elif step == 'menu':
+            if find_callback(self.screen or {}, 'menu') is None:
+                # С карточки в главное меню ведет только путь через экран жанров
+                self.screen = await self.click(self.screen, self.button(self.screen, 'category'),
+                                               'back_to_genres', has('genre'))
+            self.screen = await self.click(self.screen, self.button(self.screen, 'menu'), 'back_to_menu',
+                                           has('category'))
+        elif step == 'category':
+            self.screen = await self.click(self.screen, self.button(self.screen, 'category', category),
+                                           'open_category', has('genre'))
+        elif step == 'genre':
+            options = [data for callback, data in callbacks(self.screen or {})
+                       if callback.action == 'genre' and callback.genre == action.genre]
+            data = options[0] if options else self.button(self.screen, 'random', category)
+            self.card = self.screen = await self.click(self.screen, data, 'recommendation',
+                                                       self.card_or_failure(category))
+        elif step == 'more':
+            data = self.button(self.screen, 'random', category)
+            if category == 'music':
+                self.screen = await self.click(self.screen, data, 'more', has('genre'))
+            else:
+                self.card = self.screen = await self.click(self.screen, data, 'more', self.card_or_failure(category))
+        elif step == 'rate':
+            data = next((data for callback, data in callbacks(self.card or {})
+                         if callback.action == 'rate' and callback.rating == action.rating), None)
+            if data is None:
+                raise Desync('rate')
+            self.screen = await self.click(self.card, data, 'rate', has('random'))
+
+    async def run_actions(self, actions):
+        previous_at = None
+        skipping = False
+        for action in actions:
+            if skipping and action.step != 'start':
+                self.replay.skipped[action.step] += 1
+                continue
+            skipping = False
+            await self.replay.wait_until(action.at, record_lag=action.at != previous_at)
+            previous_at = action.at
+            try:
+                await self.perform(action)
+            except StepFailed as e:
+                # До конца сессии действия пропускаются: экран пользователя неизвестен
+                self.replay.aborted[str(e)] += 1
+                skipping = True
+            except Desync as e:
+                self.replay.aborted[f"нет кнопки {e}"] += 1
+                skipping = True
+
+
+class Replay:
+    """Расписание воспроизведения: время записи -> момент по часам цикла событий."""
+
+    def __init__(self, trace_start, speed):
+        self.trace_start = trace_start
+        self.speed = speed
+        self.wall_start = None
+        self.lags = []
+        self.aborted = Counter()
+        self.skipped = Counter()
+
+    async def wait_until(self, at, record_lag=True):
+        target = self.wall_start + (at - self.trace_start) / self.speed
+        delay = target - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if record_lag:
+            self.lags.append(max(0.0, time.perf_counter() - target))
+
+
+async def run(args, sessions, trace_start, trace_end):
+    main.provider_cache.clock = ScaledClock(args.speed)
+    harness = Harness(args)
+    await harness.start()
+    try:
+        replay = Replay(trace_start, args.speed)
+        before = harness.begin_run()
+        replay.wall_start = time.perf_counter()
+        await asyncio.gather(*(
+            ReplayUser(harness, user_id, replay).run_actions(actions) for user_id, actions in sessions.items()
+        ))
+        elapsed = time.perf_counter() - replay.wall_start
+        harness.report(f"воспроизведение x{args.speed:g}: пользователей {len(sessions)}", elapsed, replay.aborted, before)
+
+        duration = trace_end - trace_start
+        lags = sorted(replay.lags) or [0.0]
+        p50, p95 = (lags[min(int(len(lags) * q), len(lags) - 1)] * 1000 for q in (0.5, 0.95))
+        print(f"  запись {timedelta(seconds=round(duration))} проиграна за {elapsed:.1f} с "
+              f"(x{duration / elapsed:.1f} при заданном x{args.speed:g})")
+        print(f"  отставание от расписания: p50 {p50:.0f} мс, p95 {p95:.0f} мс, максимум {lags[-1] * 1000:.0f} мс")
+        if replay.aborted:
+            print(f"  прерваны сессии: {', '.join(f'{reason} {n}' for reason, n in replay.aborted.most_common())}; "
+                  f"пропущено действий {sum(replay.skipped.values())}")
+    finally:
+        await harness.stop()
+
+
+def copy_snapshot(path, target):
+    """Копия снимка для БД бота (через backup API, снимок может использоваться)."""
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    destination = sqlite3.connect(target)
+    with destination:
+        source.backup(destination)
+    source.close()
+    destination.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('snapshot', help="снимок БД бота (user_preferences.db)")
+    parser.add_argument('--speed', type=float, default=10, help="ускорение относительно записанного времени")
+    parser.add_argument('--since', help="начало окна записи (YYYY-MM-DD HH:MM), по умолчанию вся история")
+    parser.add_argument('--hours', type=float, help="длительность окна записи, часы")
+    parser.add_argument('--max-users', type=int, help="случайная выборка пользователей")
+    parser.add_argument('--session-gap', type=float, default=30, help="перерыв, начинающий новую сессию, минуты")
+    parser.add_argument('--loop-gap', type=float, default=5,
+                        help="показ той же категории не позже стольких минут считается нажатием «Еще»")
+    parser.add_argument('--empty-db', action='store_true', help="бот начинает с пустой БД вместо копии снимка")
+    add_stub_arguments(parser)
+    parser.set_defaults(think_ms=0)
+    args = parser.parse_args()
+
+    snapshot = os.path.abspath(args.snapshot)
+    since = datetime.fromisoformat(args.since) if args.since else datetime.min
+    until = since + timedelta(hours=args.hours) if args.hours else datetime.max
+    events = load_events(snapshot, since.strftime("%Y-%m-%d %H:%M:%S"), until.strftime("%Y-%m-%d %H:%M:%S"))
+    if not events:
+        parser.error("в выбранном окне нет показов")
+
+    random.seed(args.seed)
+    sessions = build_sessions(events, args.session_gap * 60, args.loop_gap * 60)
+    if args.max_users and len(sessions) > args.max_users:
+        sessions = {user_id: sessions[user_id] for user_id in random.sample(sorted(sessions), args.max_users)}
+    trace_start = min(actions[0].at for actions in sessions.values())
+    trace_end = max(actions[-1].at for actions in sessions.values())
+    steps = Counter(action.step for actions in sessions.values() for action in actions)
+    print(f"показов {len(events)}, пользователей {len(sessions)}, действий {sum(steps.values())} "
+          f"({', '.join(f'{step} {count}' for step, count in steps.most_common())}); "
+          f"запись {timedelta(seconds=round(trace_end - trace_start))}, "
+          f"воспроизведение около {(trace_end - trace_start) / args.speed:.0f} с")
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # БД бота создается во временном каталоге, снимок не изменяется
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        if not args.empty_db:
+            copy_snapshot(snapshot, 'user_preferences.db')
+        asyncio.run(run(args, sessions, trace_start, trace_end))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,85 @@
+"""
+Бенчмарк: чтение топа популярного за неделю.
+
+Сравнивает агрегацию по истории и оценкам (GROUP BY по всем событиям окна на
+каждый показ экрана) и текущий способ (счетчики обновляются при записи событий,
+топ читается из памяти). Запуск из корня репозитория:
+
+    python benchmarks/trending_reads.py --events 200000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+GENRES = ['боевик, комедия', 'драма', 'фантастика, ужасы', 'мелодрама', 'триллер']
+
+GROUP_BY_TOP_SQL = '''
+SELECT item_id, sum(score) AS score FROM (
+    SELECT item_id, 0.1 AS score FROM recommendation_history
+    WHERE category = ? AND recommendation_date >= ?
+    UNION ALL
+    SELECT item_id, CASE WHEN rating >= 4 THEN 1.0 WHEN rating <= 2 THEN -1.0 ELSE 0 END
+    FROM user_preferences WHERE category = ?
+)
+GROUP BY item_id HAVING score > 0 ORDER BY score DESC LIMIT ?
+'''
+
+
+def write_events(conn, events, items):
+    """События с записью счетчиков, как в record_recommendation и record_rating."""
+    for i in range(events):
+        # Популярность элементов распределена по закону Ципфа
+        item = min(int(random.paretovariate(1.1)), items) - 1
+        genres = GENRES[item % len(GENRES)]
+        user_id = i % 5000
+        main.insert_recommendation_history(conn, user_id, 'movie', str(item))
+        main.bump_trending_counts(conn, 'movie', item, genres, impressions=1)
+        if i % 4 == 0:
+            main.record_rating(conn, user_id, 'movie', genres, str(item), random.choice((1, 5, 5)))
+    conn.commit()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=200000, help="показов в истории за неделю")
+    parser.add_argument('--items', type=int, default=20000, help="разных элементов")
+    parser.add_argument('--reads', type=int, default=20, help="чтений топа на замер")
+    args = parser.parse_args()
+
+    random.seed(1)
+    # БД создается во временном каталоге, рабочая не затрагивается
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        main.init_db()
+        conn = main.get_db_connection()
+        started = time.perf_counter()
+        write_events(conn, args.events, args.items)
+        print(f"событий: {args.events}, запись с обновлением счетчиков: {time.perf_counter() - started:.1f} с")
+
+        since = (main.datetime.now() - main.timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+        group_by_ms = timeit.timeit(
+            lambda: conn.execute(GROUP_BY_TOP_SQL, ('movie', since, 'movie', 3)).fetchall(), number=args.reads
+        ) / args.reads * 1000
+
+        started = time.perf_counter()
+        asyncio.run(main.load_trending())
+        load_ms = (time.perf_counter() - started) * 1000
+        top_us = timeit.timeit(
+            lambda: main.trending.top('item', 'movie', 3), number=args.reads * 1000
+        ) / (args.reads * 1000) * 1e6
+        conn.close()
+
+    print(f"GROUP BY по истории и оценкам: {group_by_ms:.1f} мс на чтение")
+    print(f"топ из памяти: {top_us:.2f} мкс на чтение (загрузка при запуске {load_ms:.0f} мс)")
+
+
+if __name__ == '__main__':
+    main_cli()
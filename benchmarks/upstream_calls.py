@@ -0,0 +1,188 @@
+"""
+Бенчмарк: количество запросов к внешним API на одну карточку рекомендации.
+
+Провайдеры TMDB, Spotify и Google Books подменяются фиктивным транспортом httpx,
+который отвечает данными в формате настоящих API и считает запросы по эндпоинтам.
+Режим --legacy воспроизводит прежний путь получения карточки: подробности фильма
+(/movie/{id}) и трека (/v1/tracks/{id}) запрашиваются для каждой карточки, токен
+Spotify - для каждой рекомендации, кэша ответов провайдеров нет. Сравнение с
+текущим путем:
+
+    python benchmarks/upstream_calls.py --cards 20 --legacy
+    python benchmarks/upstream_calls.py --cards 20 [--cold | --warm]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+from collections import Counter
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def make_movie(movie_id):
+    return {
+        'id': movie_id,
+        'title': f"Фильм {movie_id}",
+        'original_title': f"Movie {movie_id}",
+        'release_date': '2021-05-01',
+        'vote_average': 7.1,
+        'overview': "Описание фильма",
+        'poster_path': f"/poster{movie_id}.jpg",
+        'genre_ids': [28, 35],
+    }
+
+
+def make_track(track_id):
+    return {
+        'id': f"track{track_id}",
+        'name': f"Трек {track_id}",
+        'artists': [{'name': 'Исполнитель'}],
+        'album': {'name': 'Альбом', 'images': [{'url': 'https://i.scdn.co/image/1'}]},
+        'preview_url': None,
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+    }
+
+
+def make_book(book_id):
+    return {
+        'id': f"book{book_id}",
+        'volumeInfo': {
+            'title': f"Книга {book_id}",
+            'authors': ['Автор'],
+            'publishedDate': '2019-01-01',
+            'description': "Описание книги",
+            'categories': ['Fiction'],
+            'language': 'ru',
+            'imageLinks': {'thumbnail': 'https://books.google.com/thumb'},
+            'previewLink': 'https://books.google.com/preview',
+        },
+    }
+
+
+class FakeUpstream:
+    """Отвечает на запросы main.py и считает их по эндпоинтам."""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def endpoint(self, request):
+        path = re.sub(r"(?<=/movie/)\d+$|(?<=/tracks/)\w+$|(?<=/volumes/)\w+$", "{id}", request.url.path)
+        return f"{request.url.host}{path}"
+
+    def __call__(self, request):
+        self.calls[self.endpoint(request)] += 1
+        path = request.url.path
+
+        if request.url.host == 'accounts.spotify.com':
+            return httpx.Response(200, json={'access_token': 'token', 'expires_in': 3600})
+        if path.endswith('/genre/movie/list'):
+            return httpx.Response(200, json={'genres': [{'id': 28, 'name': 'боевик'}, {'id': 35, 'name': 'комедия'}]})
+        if path.endswith('/discover/movie') or path.endswith('/movie/popular'):
+            return httpx.Response(200, json={'results': [make_movie(i) for i in range(1, 21)]})
+        if path.startswith('/3/movie/'):
+            movie = make_movie(int(path.rsplit('/', 1)[-1]))
+            movie['genres'] = [{'id': 28, 'name': 'боевик'}, {'id': 35, 'name': 'комедия'}]
+            return httpx.Response(200, json=movie)
+        if path == '/v1/search':
+            return httpx.Response(200, json={'tracks': {'items': [make_track(i) for i in range(50)]}})
+        if path == '/v1/tracks':
+            ids = request.url.params.get('ids', '').split(',')
+            return httpx.Response(200, json={'tracks': [make_track(track_id.replace('track', '')) for track_id in ids]})
+        if path.startswith('/v1/tracks/'):
+            return httpx.Response(200, json=make_track(path.rsplit('track', 1)[-1]))
+        if path == '/books/v1/volumes':
+            return httpx.Response(200, json={'items': [make_book(i) for i in range(40)]})
+        return httpx.Response(404, json={})
+
+
+def enable_legacy_path():
+    """Отключает сокращения запросов: карточка всегда собирается из подробностей элемента."""
+    async def no_genre_names():
+        return {}
+
+    main.get_tmdb_genre_names = no_genre_names
+    main.has_track_card_fields = lambda track: False
+
+
+def forget_between_cards():
+    """Прежний путь не хранил между карточками ни токен Spotify, ни ответы провайдеров."""
+    main.invalidate_spotify_token()
+    main.provider_cache.entries.clear()
+    main.spotify_hydrator = main.SpotifyHydrator()
+
+
+async def run(cards, cold, warm, legacy=False):
+    main.TMDB_API_KEY = main.TMDB_API_KEY or 'benchmark'
+    main.SPOTIFY_CLIENT_ID = main.SPOTIFY_CLIENT_ID or 'benchmark'
+    main.SPOTIFY_CLIENT_SECRET = main.SPOTIFY_CLIENT_SECRET or 'benchmark'
+    upstream = FakeUpstream()
+    main._http_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+
+    warmup_calls = None
+    if warm:
+        await main.warm_up_caches()
+        warmup_calls = sum(upstream.calls.values())
+
+    results = {}
+    scenarios = [
+        ('movie', main.get_movie_recommendations, '28'),
+        ('music', main.get_music_recommendations, 'rock'),
+        ('book', main.get_book_recommendations, 'fiction'),
+    ]
+    for category, fetch, genre in scenarios:
+        upstream.calls.clear()
+        for user_id in range(1, cards + 1):
+            if legacy:
+                forget_between_cards()
+            elif cold:
+                main.provider_cache.entries.clear()
+            await fetch(genre, user_id)
+        total = sum(upstream.calls.values())
+        results[category] = (total / cards, dict(upstream.calls))
+
+    await main.close_http_client()
+    return warmup_calls, results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cards', type=int, default=20, help="карточек на категорию")
+    parser.add_argument('--cold', action='store_true', help="очищать кэш провайдеров перед каждой карточкой")
+    parser.add_argument('--warm', action='store_true', help="прогреть кэши, как при запуске бота")
+    parser.add_argument('--legacy', action='store_true',
+                        help="прежний путь: подробности и токен на каждую карточку, без кэша")
+    args = parser.parse_args()
+    if args.legacy and (args.cold or args.warm):
+        parser.error("--legacy не сочетается с --cold и --warm")
+    logging.disable(logging.WARNING)
+    if args.legacy:
+        enable_legacy_path()
+
+    # Работаем с временной копией БД, чтобы не трогать историю пользователей
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    try:
+        main.init_db()
+        warmup_calls, results = asyncio.run(run(args.cards, args.cold, args.warm, args.legacy))
+    finally:
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if warmup_calls is not None:
+        print(f"прогрев: {warmup_calls} запросов")
+    for category, (per_card, calls) in results.items():
+        print(f"{category}: {per_card:.2f} запросов на карточку")
+        for endpoint, count in sorted(calls.items()):
+            print(f"    {endpoint}: {count}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,121 @@
+"""
+Бенчмарк: память на одного активного пользователя.
+
+Сравнивает прежний способ (в user_data каждого пользователя лежат полные карточки,
+разобранные из ответа API) и текущий (в user_data только ID, записи общие в каталоге).
+Запуск из корня репозитория:
+
+    python benchmarks/user_memory.py --users 10000 --items 300
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+GENRES = ['боевик, комедия', 'драма', 'фантастика, ужасы', 'мелодрама']
+
+
+def make_payloads(count):
+    movies = [{
+        'id': 1000 + i,
+        'title': f"Фильм {i}",
+        'original_title': f"Movie {i}",
+        'release_date': f"{1990 + i % 30}-05-01",
+        'vote_average': 7.1,
+        'overview': "Описание фильма. " * 15,
+        'poster_path': f"/poster{i}.jpg",
+    } for i in range(count)]
+    tracks = [{
+        'id': f"track{i:018d}",
+        'name': f"Трек {i}",
+        'artists': [{'name': 'Исполнитель'}, {'name': f"Гость {i}"}],
+        'album': {'name': f"Альбом {i}", 'images': [{'url': f"https://i.scdn.co/image/{i:032d}"}]},
+        'preview_url': f"https://p.scdn.co/mp3-preview/{i:032d}",
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{i:022d}"},
+    } for i in range(count)]
+    books = [{
+        'id': f"book{i:08d}",
+        'volumeInfo': {
+            'title': f"Книга {i}",
+            'authors': ['Автор'],
+            'publishedDate': f"{1990 + i % 30}-01-01",
+            'description': "Описание книги. " * 25,
+            'categories': ['Fiction'],
+            'imageLinks': {'thumbnail': f"https://books.google.com/thumb?id={i}"},
+            'previewLink': f"https://books.google.com/preview?id={i}",
+        },
+    } for i in range(count)]
+    return movies, tracks, books
+
+
+def legacy_card(record):
+    """Карточка в прежнем виде: отдельный словарь со свежими строками на каждый запрос."""
+    card = {field: getattr(record, field) for field in main.ItemRecord.__slots__ if field != 'category'}
+    return json.loads(json.dumps(card, ensure_ascii=False))
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, data
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help="активных пользователей")
+    parser.add_argument('--items', type=int, default=300, help="разных элементов в каждой категории")
+    args = parser.parse_args()
+
+    random.seed(1)
+    movies, tracks, books = make_payloads(args.items)
+    choices = [
+        (random.randrange(args.items), random.randrange(args.items), random.randrange(args.items))
+        for _ in range(args.users)
+    ]
+
+    def build_legacy():
+        users = {}
+        for user_id, (m, t, b) in enumerate(choices):
+            users[user_id] = {
+                'current_movie': legacy_card(main.normalize_tmdb_movie(movies[m], random.choice(GENRES))),
+                'current_music': legacy_card(main.normalize_spotify_track(tracks[t])),
+                'current_book': legacy_card(main.normalize_google_book(books[b])),
+            }
+        return users
+
+    def build_catalog():
+        catalog = main.ItemCatalog()
+        users = {}
+        for user_id, (m, t, b) in enumerate(choices):
+            records = (
+                main.normalize_tmdb_movie(movies[m], random.choice(GENRES)),
+                main.normalize_spotify_track(tracks[t]),
+                main.normalize_google_book(books[b]),
+            )
+            for record in records:
+                catalog.add(record)
+            users[user_id] = {
+                'current_movie': catalog.peek('movie', records[0].id).id,
+                'current_music': catalog.peek('music', records[1].id).id,
+                'current_book': catalog.peek('book', records[2].id).id,
+            }
+        return catalog, users
+
+    legacy_bytes, _ = measure(build_legacy)
+    catalog_bytes, (catalog, _) = measure(build_catalog)
+
+    print(f"пользователей: {args.users}, элементов в каталоге: {len(catalog.entries)}")
+    print(f"полные карточки в user_data: {legacy_bytes / args.users:.0f} байт на пользователя")
+    print(f"ID + общий каталог: {catalog_bytes / args.users:.0f} байт на пользователя")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,135 @@
+"""
+Обслуживание БД бота (user_preferences.db) из командной строки.
+
+    python db_maintenance.py enable-incremental-vacuum
+    python db_maintenance.py retention
+    python db_maintenance.py backup
+    python db_maintenance.py export --out export [--snapshot backups/user_preferences-....db.gz]
+
+enable-incremental-vacuum включает в существующей БД режим auto_vacuum = INCREMENTAL,
+в котором фоновая задача бота возвращает освободившиеся страницы файлу небольшими
+шагами. Для этого нужен полный VACUUM: он держит блокировку всей БД, поэтому бот на
+это время нужно остановить. После VACUUM перестраивается поисковый индекс items_fts:
+его строки ссылаются на rowid таблицы items, а VACUUM может их изменить.
+
+retention выполняет один проход хранения истории (архивация старых показов, удаление
+показов fallback_*, инкрементальная очистка) так же, как фоновая задача бота.
+
+backup снимает сжатую резервную копию в BACKUP_DIR так же, как фоновая задача бота;
+бот при этом можно не останавливать.
+
+export выгружает пользователей, предпочтения и историю рекомендаций в файлы
+<таблица>.jsonl.gz для аналитики. Выгрузка идет из согласованного снимка (свежая
+онлайн-копия или готовая копия из BACKUP_DIR), а не из рабочей БД: долгое чтение
+рабочей БД мешало бы боту записывать. Строки читаются курсором по одной, поэтому
+память не зависит от размера таблиц. Заархивированная история уже лежит в
+HISTORY_ARCHIVE_DIR в том же формате.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import main
+
+
+def enable_incremental_vacuum():
+    conn = main.get_db_connection()
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            print("Режим auto_vacuum = INCREMENTAL уже включен")
+            return
+        size_before = os.path.getsize(main.DB_PATH)
+        started = time.perf_counter()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        has_index = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone()
+        if has_index:
+            conn.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+            conn.commit()
+        print(f"Готово за {time.perf_counter() - started:.1f} с: размер БД "
+              f"{size_before / 2 ** 20:.1f} -> {os.path.getsize(main.DB_PATH) / 2 ** 20:.1f} МБ"
+              + (", поисковый индекс перестроен" if has_index else ""))
+    finally:
+        conn.close()
+
+
+def run_retention():
+    archived, purged, reclaimed = asyncio.run(main.run_history_retention())
+    print(f"Архивировано показов {archived} (в {main.HISTORY_ARCHIVE_DIR}), удалено fallback {purged}, "
+          f"освобождено страниц {reclaimed}")
+
+
+def run_backup():
+    path, snapshot_size, size = main.create_backup()
+    print(f"Резервная копия {path}: {snapshot_size / 2 ** 20:.1f} МБ (сжато {size / 2 ** 20:.1f} МБ)")
+
+
+EXPORT_TABLES = ('users', 'user_preferences', 'recommendation_history')
+
+
+def export_table(conn, table, path):
+    """Пишет строки таблицы в path (JSON по строке); возвращает число строк."""
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        for row in conn.execute(f'SELECT * FROM {table}'):
+            file.write(json.dumps(dict(row), ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+def export_snapshot(out_dir, snapshot=None):
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=out_dir) as directory:
+        snapshot_path = os.path.join(directory, 'snapshot.db')
+        if snapshot:
+            with gzip.open(snapshot, 'rb') as source, open(snapshot_path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        else:
+            main.snapshot_database(snapshot_path)
+        conn = sqlite3.connect(f'file:{snapshot_path}?mode=ro', uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            for table in EXPORT_TABLES:
+                path = os.path.join(out_dir, f"{table}.jsonl.gz")
+                started = time.perf_counter()
+                count = export_table(conn, table, path)
+                print(f"{table}: {count} строк -> {path} ({time.perf_counter() - started:.1f} с)")
+        finally:
+            conn.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('enable-incremental-vacuum', help="включить инкрементальную очистку (бот остановлен)")
+    commands.add_parser('retention', help="один проход хранения истории")
+    commands.add_parser('backup', help="сжатая резервная копия в BACKUP_DIR")
+    export = commands.add_parser('export', help="выгрузка таблиц в JSONL для аналитики")
+    export.add_argument('--out', default='export', help="каталог для файлов <таблица>.jsonl.gz")
+    export.add_argument('--snapshot', help="выгрузить из готовой копии .db.gz вместо свежего снимка")
+    args = parser.parse_args()
+
+    if args.command == 'export' and args.snapshot:
+        export_snapshot(args.out, args.snapshot)
+        return 0
+    main.init_db()
+    if args.command == 'enable-incremental-vacuum':
+        enable_incremental_vacuum()
+    elif args.command == 'retention':
+        run_retention()
+    elif args.command == 'backup':
+        run_backup()
+    elif args.command == 'export':
+        export_snapshot(args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
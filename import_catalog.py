@@ -0,0 +1,218 @@
+"""
+Импорт каталога фильмов, треков и книг из локальных выгрузок (CSV или JSONL) в таблицу items.
+
+Файл читается потоково и записывается пачками, поэтому расход памяти не зависит
+от размера выгрузки. Импортированные элементы попадают в поисковый индекс (/search)
+и служат запасным источником рекомендаций, когда провайдеры недоступны или
+исчерпаны квоты. Запуск из корня репозитория:
+
+    python import_catalog.py movies.csv --category movie
+    python import_catalog.py books.jsonl.gz --category book --batch-size 5000
+
+Колонки сопоставляются с полями карточки по FIELD_ALIASES. Если в выгрузке есть
+колонка category (movie, music или book), --category можно не указывать; другие
+значения этой колонки (жанр, полка) игнорируются. Строки без ID или названия и строки
+со слишком длинным для кнопок оценки ID пропускаются.
+"""
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+
+import main
+
+# Колонки выгрузки для каждого поля ItemRecord; берется первая непустая
+FIELD_ALIASES = {
+    'id': ('id', 'item_id', 'tmdb_id', 'track_id', 'spotify_id', 'volume_id', 'isbn'),
+    'title': ('title', 'name', 'track_name'),
+    'subtitle': ('subtitle', 'original_title', 'album', 'album_name'),
+    'creator': ('creator', 'authors', 'author', 'artists', 'artist', 'artist_name'),
+    'year': ('year', 'release_date', 'published_date', 'publishedDate', 'release_year'),
+    'rating': ('rating', 'vote_average', 'average_rating'),
+    'genres': ('genres', 'genre', 'categories', 'track_genre'),
+    'description': ('description', 'overview', 'summary'),
+    'image_url': ('image_url', 'poster_url', 'poster_path', 'thumbnail', 'cover_url'),
+    'link': ('link', 'url', 'spotify_url', 'preview_link', 'previewLink'),
+    'preview_url': ('preview_url',),
+}
+# Подпись к фото в Telegram ограничена 1024 символами
+DESCRIPTION_LIMIT = 600
+TMDB_IMAGE_BASE = "https://image.tmdb.org/t/p/w500"
+# Значения полей карточки, которых нет в выгрузке, - те же, что у normalize_* в main.py
+CARD_DEFAULTS = {
+    'movie': {'subtitle': '', 'year': 'Год неизвестен', 'rating': 0, 'genres': '',
+              'description': 'Описание отсутствует'},
+    'music': {'creator': 'Неизвестный артист', 'subtitle': 'Альбом неизвестен'},
+    'book': {'creator': 'Автор неизвестен', 'year': 'Дата неизвестна', 'genres': 'Категория неизвестна',
+             'description': 'Описание отсутствует'},
+}
+# Коды жанров в кнопках оценки - base36; ID проверяется с запасом на четырехзначный код
+MAX_GENRE_CODE = 36 ** 4 - 1
+
+
+def open_dump(path):
+    """Открывает выгрузку как текст; файлы .gz распаковываются на лету."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if os.path.splitext(name)[1].lower() in ('.jsonl', '.ndjson', '.json') else 'csv'
+
+
+def read_rows(file, dump_format):
+    """Строки выгрузки по одной; None для строк, которые не удалось разобрать."""
+    if dump_format == 'csv':
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield row if isinstance(row, dict) else None
+
+
+def plain_value(value):
+    """Списки (авторы, жанры TMDB вида {"id": 28, "name": "Action"}) склеиваются через запятую."""
+    if isinstance(value, list):
+        names = [item.get('name') if isinstance(item, dict) else item for item in value]
+        return ', '.join(str(name) for name in names if name)
+    if isinstance(value, dict):
+        return value.get('name')
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def field_value(row, field):
+    for column in FIELD_ALIASES[field]:
+        value = plain_value(row.get(column))
+        if value:
+            return value
+    return None
+
+
+def fits_rate_button(category, item_id):
+    """Помещается ли ID в callback_data кнопок оценки (лимит Telegram - 64 байта)."""
+    try:
+        main.encode_callback('rate', category, item_id=item_id, rating=5, genre_code=MAX_GENRE_CODE)
+    except ValueError:
+        return False
+    return True
+
+
+def row_to_record(row, category):
+    """
+    Запись каталога из строки выгрузки; None, если не хватает ID, названия или категории
+    или ID не помещается в кнопки оценки.
+    """
+    # Колонка category в выгрузках бывает жанром или полкой ("Fiction"): учитываем
+    # ее, только если это категория бота
+    column = plain_value(row.get('category'))
+    if column in main.CATEGORY_CODES:
+        category = column
+    item_id = field_value(row, 'id')
+    title = field_value(row, 'title')
+    if category not in main.CATEGORY_CODES or not item_id or not title:
+        return None
+    if not fits_rate_button(category, item_id):
+        return None
+
+    year = field_value(row, 'year')
+    rating = field_value(row, 'rating')
+    try:
+        rating = round(float(rating), 1) if rating else None
+    except ValueError:
+        rating = None
+    description = field_value(row, 'description')
+    if description and len(description) > DESCRIPTION_LIMIT:
+        description = description[:DESCRIPTION_LIMIT] + '...'
+    image_url = field_value(row, 'image_url')
+    if category == 'movie' and image_url and image_url.startswith('/'):
+        # В выгрузках TMDB хранится только путь постера
+        image_url = TMDB_IMAGE_BASE + image_url
+
+    fields = {
+        'subtitle': field_value(row, 'subtitle'),
+        'creator': field_value(row, 'creator'),
+        'year': year[:4] if year and year[:4].isdigit() else year,
+        'rating': rating,
+        'genres': field_value(row, 'genres'),
+        'description': description,
+    }
+    for field, default in CARD_DEFAULTS[category].items():
+        if fields[field] is None:
+            fields[field] = default
+    return main.ItemRecord(
+        category, item_id, title, **fields,
+        image_url=image_url,
+        link=field_value(row, 'link'),
+        preview_url=field_value(row, 'preview_url'),
+    )
+
+
+def import_catalog(path, category=None, dump_format=None, batch_size=1000, report=print):
+    """
+    Импортирует выгрузку пачками по batch_size строк; каждая пачка - одна транзакция.
+    Возвращает (импортировано, пропущено).
+    """
+    main.init_db()
+    stats = {'imported': 0, 'skipped': 0}
+
+    def records(rows):
+        for row in rows:
+            record = row_to_record(row, category) if row is not None else None
+            if record is None:
+                stats['skipped'] += 1
+                continue
+            yield record
+
+    started = time.perf_counter()
+    conn = main.get_db_connection()
+    try:
+        with open_dump(path) as file:
+            stream = records(read_rows(file, dump_format or detect_format(path)))
+            while True:
+                batch = list(itertools.islice(stream, batch_size))
+                if not batch:
+                    break
+                main.upsert_items(conn, batch)
+                conn.commit()
+                stats['imported'] += len(batch)
+                report(f"импортировано {stats['imported']}, пропущено {stats['skipped']}, "
+                       f"{stats['imported'] / (time.perf_counter() - started):.0f} строк/с")
+    finally:
+        conn.close()
+    return stats['imported'], stats['skipped']
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path', help="файл выгрузки (.csv, .jsonl, можно сжатый .gz)")
+    parser.add_argument('--category', choices=sorted(main.CATEGORY_CODES),
+                        help="категория элементов, если в выгрузке нет колонки category")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="формат (по умолчанию по расширению)")
+    parser.add_argument('--batch-size', type=int, default=1000, help="строк в одной транзакции")
+    args = parser.parse_args()
+
+    # Описания в выгрузках бывают длиннее стандартного ограничения поля CSV (128 КБ)
+    csv.field_size_limit(16 * 1024 * 1024)
+    imported, skipped = import_catalog(args.path, args.category, args.format, args.batch_size)
+    print(f"Готово: импортировано {imported}, пропущено {skipped}")
+    return 0 if imported or not skipped else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
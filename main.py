@@ -1,19 +1,48 @@
 # main.py
 import os
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import gzip
 import logging
+import logging.handlers
+import queue
 import sqlite3
-from datetime import datetime
+import ssl
+import sys
+import time
+import bisect
+import functools
+import heapq
+import itertools
+import threading
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+from werkzeug.serving import make_server
 from dotenv import load_dotenv
-import requests
+from flask import Flask, Response
+import httpx
 import json
+import math
 import random
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+import re
+import shutil
+import string
+from telegram import (
+    Update, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+)
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     filters,
     ContextTypes
 )
@@ -21,11 +50,145 @@ from telegram.ext import (
 # Загрузка переменных среды из файла .env
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+# Настройка логирования.
+# Обработчики корневого логгера только кладут записи в очередь; форматирование,
+# маскирование секретов и запись в поток/файл выполняет отдельный поток
+# (QueueListener), поэтому цикл событий не ждет диска. Сообщения пишутся с
+# аргументами ("... %s", значение): строка собирается только в потоке записи,
+# а шаблон служит ключом ограничения частоты.
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 'text' - как раньше, 'json' - по объекту JSON на строку
+LOG_STYLE = os.getenv("LOG_STYLE", "text")
+LOG_FILE = os.getenv("LOG_FILE")
+# Не больше LOG_RATE_LIMIT сообщений одного шаблона за LOG_RATE_WINDOW секунд (ошибки не ограничиваются)
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", "10"))
+
+# API-ключи и токены в URL и заголовках (TMDB api_key, Google key, токен бота в URL Bot API)
+SECRET_PATTERNS = (
+    (re.compile(r'(?i)\b(api_key|key|access_token|client_secret|token)=[^&\s\'"]+'), r'\1=***'),
+    (re.compile(r'(?i)\b(Bearer|Basic)\s+[\w.~+/=-]+'), r'\1 ***'),
+    (re.compile(r'\bbot\d+:[\w-]+'), 'bot***'),
 )
+
+def redact_secrets(text):
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+class LogContextFilter(logging.Filter):
+    """
+    Добавляет к записи ID трассы (контекст доступен только в потоке, где
+    вызван логгер) и ограничивает частоту сообщений одного шаблона. Когда окно
+    сменяется, первое сообщение сообщает, сколько повторов было подавлено.
+    """
+    
+    MAX_KEYS = 10000
+    
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.windows = {}  # (логгер, шаблон) -> [начало окна, выведено, подавлено]
+    
+    def filter(self, record):
+        span = current_span.get()
+        record.trace_id = span.trace.trace_id if span is not None else None
+        record.suppressed = 0
+        if record.levelno >= logging.ERROR or not self.limit:
+            return True
+        
+        key = (record.name, str(record.msg))
+        state = self.windows.get(key)
+        if state is None or record.created - state[0] >= self.window:
+            if len(self.windows) >= self.MAX_KEYS:
+                self.windows.clear()
+            record.suppressed = state[2] if state else 0
+            self.windows[key] = [record.created, 1, 0]
+            return True
+        if state[1] < self.limit:
+            state[1] += 1
+            return True
+        state[2] += 1
+        return False
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет запись в очередь без форматирования: QueueHandler.prepare собирает
+    сообщение сразу, а здесь это делает поток записи. Аргументы сообщений -
+    строки и числа, поэтому к моменту записи они не меняются.
+    """
+    
+    def prepare(self, record):
+        return record
+
+class PipelineFormatter(logging.Formatter):
+    """Формат текстовый или JSON; секреты маскируются в готовой строке, включая трассировку исключения."""
+    
+    def __init__(self, style='text'):
+        super().__init__(LOG_FORMAT)
+        self.json_style = style == 'json'
+    
+    def format(self, record):
+        suppressed = getattr(record, 'suppressed', 0)
+        trace_id = getattr(record, 'trace_id', None)
+        if self.json_style:
+            entry = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                'template': str(record.msg),
+            }
+            if trace_id:
+                entry['trace_id'] = trace_id
+            if suppressed:
+                entry['suppressed'] = suppressed
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return redact_secrets(json.dumps(entry, ensure_ascii=False, default=str))
+        
+        text = super().format(record)
+        if suppressed:
+            text += f" (подавлено повторов: {suppressed})"
+        if trace_id:
+            text += f" [trace {trace_id}]"
+        return redact_secrets(text)
+
+def configure_logging():
+    # Формат не использует файл, строку, процесс и поток вызова: не собираем их для
+    # каждой записи (см. раздел Optimization в logging HOWTO)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    log_queue = queue.SimpleQueue()
+    formatter = PipelineFormatter(LOG_STYLE)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.handlers.WatchedFileHandler(LOG_FILE, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Записи, оставшиеся в очереди, дописываются при выходе
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
+# httpx логирует каждый запрос вместе с URL, в котором передаются API-ключи
+logging.getLogger("httpx").setLevel(logging.WARNING)
+# Сервер метрик не логирует каждый запрос сборщика
+logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
 # API ключи
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
@@ -50,41 +213,438 @@ SPOTIFY_GENRE_MAPPING = {
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает ошибки, возникающие в диспетчере обновлений."""
     logger.error("Произошла ошибка при обработке обновления %s", update, exc_info=context.error)
+    metrics.inc('bot_telegram_errors_total', (('error', type(context.error).__name__),))
     
     # Извлекаем информацию об ошибке
     error_message = str(context.error)
     
     # Если у нас есть объект update и сообщение
     if update and isinstance(update, Update) and update.effective_message:
-        # Отправляем пользователю сообщение об ошибке
-        error_text = f"😔 Произошла ошибка при обработке вашего запроса.\n\nПопробуйте начать сначала с помощью команды /start"
-        
-        # Добавляем кнопку для возврата в главное меню
-        keyboard = [
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")],
-            [InlineKeyboardButton("🔄 Начать заново", callback_data="start_over")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+        # Отправляем пользователю сообщение об ошибке с кнопками возврата в главное меню
+        screen = SCREENS['error']
         try:
             await update.effective_message.reply_text(
-                error_text,
-                reply_markup=reply_markup
+                screen.text,
+                reply_markup=screen.reply_markup
             )
         except Exception as e:
-            logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
+            logger.error("Не удалось отправить сообщение об ошибке: %s", e)
+            metrics.inc('bot_telegram_errors_total', (('error', type(e).__name__),))
+
+# Метрики в формате Prometheus.
+# Все наблюдения делаются в потоке цикла событий, поэтому счетчики - обычные словари
+# и списки без блокировок: запись метрики стоит доли микросекунды. Сервер метрик
+# (см. start_metrics_server) тоже собирает текст в цикле событий.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_FAMILIES = {
+    'bot_handler_duration_seconds': ('histogram', "Время обработки обновления по обработчикам"),
+    'bot_handler_errors_total': ('counter', "Исключения в обработчиках"),
+    'bot_provider_request_duration_seconds': ('histogram', "Время запроса к провайдеру по эндпоинтам"),
+    'bot_provider_responses_total': ('counter', "Ответы провайдеров по статусам"),
+    'bot_db_query_duration_seconds': ('histogram', "Время выполнения запросов к БД по функциям run_db"),
+    'bot_fallbacks_total': ('counter', "Рекомендации из запасных источников"),
+    'bot_item_catalog_lookups_total': ('counter', "Обращения к каталогу элементов в памяти"),
+    'bot_telegram_errors_total': ('counter', "Ошибки при обработке обновлений и отправке сообщений"),
+    'bot_event_loop_lag_seconds': ('histogram', "Опоздание таймера цикла событий"),
+    'bot_event_loop_blocks_total': ('counter', "Блокировки цикла событий дольше LOOP_BLOCK_MS"),
+    'bot_slow_updates_total': ('counter', "Обновления дольше SLOW_UPDATE_MS по обработчикам"),
+    'bot_db_backups_total': ('counter', "Резервные копии БД по результатам"),
+}
+
+class MetricHistogram:
+    """Гистограмма с границами METRIC_BUCKETS; счетчики корзин не накопительные."""
+    
+    __slots__ = ('counts', 'sum')
+    
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+    
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+class Metrics:
+    """Гистограммы и счетчики по (имя, метки); метки - кортеж пар (имя, значение)."""
+    
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+    
+    def observe(self, name, labels, seconds):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = MetricHistogram()
+        histogram.observe(seconds)
+    
+    def inc(self, name, labels=(), value=1):
+        self.counters[(name, labels)] += value
+
+metrics = Metrics()
+
+# Трассировка обновлений.
+# Для доли обновлений (TRACE_SAMPLE_RATE) создается трасса. Текущий спан хранится
+# в contextvars, поэтому запросы к провайдерам, БД и Telegram, а также задачи,
+# созданные обработчиком, добавляют в нее свои спаны. Трасса записывается, когда
+# завершены все ее спаны: в кольцевой буфер (команда /trace) и, если задан
+# TRACE_FILE, строкой JSON в файл. В файл трассы пишет отдельный поток через
+# очередь, как и логи: цикл событий не ждет диска.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_FILE = os.getenv("TRACE_FILE")
+# ID пользователей Telegram через запятую, которым доступны служебные команды
+ADMIN_USER_IDS = frozenset(int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(',') if user_id.strip())
+
+current_span = contextvars.ContextVar('current_span', default=None)
+TRACE_BUFFER = deque(maxlen=TRACE_BUFFER_SIZE)
+
+class Trace:
+    __slots__ = ('trace_id', 'started_at', 'spans', 'open_spans', 'finished')
+    
+    def __init__(self):
+        self.trace_id = os.urandom(8).hex()
+        self.started_at = time.time()
+        self.spans = []
+        self.open_spans = 0
+        self.finished = False
+
+class Span:
+    """Шаг обработки обновления: имя, атрибуты и длительность."""
+    
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attrs', 'started', 'duration')
+    
+    def __init__(self, trace, parent, name, attrs):
+        self.trace = trace
+        self.span_id = len(trace.spans) + 1
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.duration = None
+        trace.spans.append(self)
+        trace.open_spans += 1
+    
+    def finish(self, **attrs):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started
+        self.attrs.update(attrs)
+        self.trace.open_spans -= 1
+        if not self.trace.open_spans:
+            self.trace.finished = True
+            record_trace(self.trace)
+
+def start_span(name, root=False, **attrs):
+    """
+    Открывает спан в текущей трассе; корневой спан начинает новую трассу с
+    вероятностью TRACE_SAMPLE_RATE. Возвращает None, если обновление не трассируется.
+    """
+    parent = current_span.get()
+    if parent is None:
+        if not root or random.random() >= TRACE_SAMPLE_RATE:
+            return None
+        return Span(Trace(), None, name, attrs)
+    if parent.trace.finished:
+        return None
+    return Span(parent.trace, parent, name, attrs)
+
+@contextlib.contextmanager
+def trace_span(name, root=False, **attrs):
+    """Спан на время блока; вложенные вызовы становятся его дочерними спанами."""
+    span = start_span(name, root, **attrs)
+    if span is None:
+        yield None
+        return
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+def record_trace(trace):
+    started = trace.spans[0].started
+    spans = [{
+        'span_id': span.span_id,
+        'parent_id': span.parent_id,
+        'name': span.name,
+        'offset_ms': round((span.started - started) * 1000, 2),
+        'duration_ms': round(span.duration * 1000, 2),
+        'attrs': span.attrs,
+    } for span in trace.spans]
+    record = {
+        'trace_id': trace.trace_id,
+        'time': datetime.fromtimestamp(trace.started_at).isoformat(timespec='seconds'),
+        'name': trace.spans[0].attrs.get('handler', trace.spans[0].name),
+        'duration_ms': max(span['offset_ms'] + span['duration_ms'] for span in spans),
+        'spans': spans,
+    }
+    TRACE_BUFFER.append(record)
+    if TRACE_FILE:
+        trace_logger.info(record)
+
+class TraceFormatter(logging.Formatter):
+    """Трасса строкой JSON; сериализуется в потоке записи (завершенная трасса не меняется)."""
+    
+    def format(self, record):
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+def configure_trace_file():
+    """Запись трасс в TRACE_FILE через очередь и отдельный поток (как у логов)."""
+    trace_logger.propagate = False
+    trace_logger.setLevel(logging.INFO)
+    if not TRACE_FILE:
+        return None
+    trace_queue = queue.SimpleQueue()
+    handler = logging.handlers.WatchedFileHandler(TRACE_FILE, encoding='utf-8', delay=True)
+    handler.setFormatter(TraceFormatter())
+    trace_logger.addHandler(LazyQueueHandler(trace_queue))
+    listener = logging.handlers.QueueListener(trace_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+trace_logger = logging.getLogger('traces')
+trace_listener = configure_trace_file()
+
+# Профилирование и контроль задержек цикла событий.
+# Поток-сторож (LoopWatchdog) периодически снимает стек потока цикла событий через
+# sys._current_frames(). Снимки последних STACK_RING_SECONDS хранятся в кольцевом
+# буфере: обновление дольше SLOW_UPDATE_MS сохраняется в PROFILE_DIR вместе со
+# снимками за время своей обработки. Если цикл событий не отвечает дольше
+# LOOP_BLOCK_MS, сторож логирует стек блокирующего синхронного вызова. Команда
+# /profile включает частые снимки на заданное время и сохраняет их в формате
+# folded (flamegraph.pl, speedscope).
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_KEEP_FILES = int(os.getenv("PROFILE_KEEP_FILES", "100"))
+# 0 отключает соответствующую проверку
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "3000"))
+LOOP_BLOCK_MS = float(os.getenv("LOOP_BLOCK_MS", "100"))
+STACK_RING_INTERVAL_MS = float(os.getenv("STACK_RING_INTERVAL_MS", "20"))
+STACK_RING_SECONDS = 60
+# Не чаще одного сохранения медленного обновления за столько секунд
+SLOW_UPDATE_COOLDOWN = 10
+LOOP_HEARTBEAT_INTERVAL = 0.05
+STACK_DEPTH_LIMIT = 64
+# Верхний кадр стека, когда цикл событий ждет событий
+IDLE_FRAMES = ('selectors.py:select',)
+# Кадры самого цикла событий есть почти в каждом снимке и не попадают в сводку /profile
+LOOP_FRAME_FILES = ('base_events.py:', 'events.py:', 'runners.py:', 'tasks.py:', 'selectors.py:')
+
+def folded_stack(frame):
+    """Стек в формате folded: «файл:функция» от внешнего вызова к внутреннему через «;»."""
+    names = []
+    while frame is not None and len(names) < STACK_DEPTH_LIMIT:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def stack_tail(stack, depth=5):
+    return ' <- '.join(reversed(stack.split(';')[-depth:]))
+
+class LoopWatchdog(threading.Thread):
+    """Поток, снимающий стеки цикла событий и замечающий его блокировки."""
+    
+    def __init__(self, loop):
+        super().__init__(name='loop-watchdog', daemon=True)
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        # Время последнего срабатывания таймера в цикле событий (watch_loop_lag)
+        self.heartbeat = time.perf_counter()
+        self.reported_heartbeat = None
+        self.lock = threading.Lock()
+        self.ring = deque()
+        self.blocks = deque(maxlen=100)
+        self.profile = None
+        self.stopping = threading.Event()
+    
+    def interval(self):
+        if self.profile is not None:
+            return PROFILE_SAMPLE_INTERVAL_MS / 1000
+        return min(value for value in (STACK_RING_INTERVAL_MS, LOOP_BLOCK_MS / 4) if value > 0) / 1000
+    
+    def run(self):
+        next_ring_sample = 0.0
+        while not self.stopping.wait(self.interval()):
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                return
+            now = time.perf_counter()
+            stack = None
+            blocked = now - self.heartbeat - LOOP_HEARTBEAT_INTERVAL
+            if LOOP_BLOCK_MS and blocked * 1000 > LOOP_BLOCK_MS and self.reported_heartbeat != self.heartbeat:
+                # О каждой блокировке сообщаем один раз, пока таймер цикла снова не сработает
+                self.reported_heartbeat = self.heartbeat
+                stack = folded_stack(frame)
+                self.blocks.append((self.heartbeat, stack))
+                logger.warning("Цикл событий заблокирован дольше %.0f мс: %s", blocked * 1000, stack_tail(stack))
+                self.loop.call_soon_threadsafe(metrics.inc, 'bot_event_loop_blocks_total')
+            if self.profile is not None or (STACK_RING_INTERVAL_MS and now >= next_ring_sample):
+                stack = stack or folded_stack(frame)
+                next_ring_sample = now + STACK_RING_INTERVAL_MS / 1000
+                with self.lock:
+                    if self.profile is not None:
+                        self.profile[stack] += 1
+                    self.ring.append((now, stack))
+                    while self.ring[0][0] < now - STACK_RING_SECONDS:
+                        self.ring.popleft()
+            del frame
+    
+    def samples_between(self, started, finished):
+        with self.lock:
+            return Counter(stack for at, stack in self.ring if started <= at <= finished)
+    
+    def start_profile(self):
+        with self.lock:
+            self.profile = Counter()
+    
+    def stop_profile(self):
+        with self.lock:
+            profile, self.profile = self.profile, None
+        return profile
+
+loop_watchdog = None
+last_slow_capture = 0.0
+
+async def watch_loop_lag(watchdog):
+    """Таймер в цикле событий: опоздание срабатывания - задержка цикла."""
+    while True:
+        expected = time.perf_counter() + LOOP_HEARTBEAT_INTERVAL
+        await asyncio.sleep(LOOP_HEARTBEAT_INTERVAL)
+        now = time.perf_counter()
+        watchdog.heartbeat = now
+        metrics.observe('bot_event_loop_lag_seconds', (), max(0.0, now - expected))
+
+def start_loop_watchdog():
+    global loop_watchdog
+    if not (STACK_RING_INTERVAL_MS or LOOP_BLOCK_MS):
+        return
+    loop_watchdog = LoopWatchdog(asyncio.get_running_loop())
+    loop_watchdog.start()
+    start_maintenance_task(watch_loop_lag(loop_watchdog))
+
+def stop_loop_watchdog():
+    global loop_watchdog
+    if loop_watchdog is not None:
+        loop_watchdog.stopping.set()
+        loop_watchdog = None
+
+def write_profile_artifact(name, content):
+    """Сохраняет файл в PROFILE_DIR и удаляет самые старые сверх PROFILE_KEEP_FILES (в потоке)."""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, name), 'w', encoding='utf-8') as file:
+            file.write(content)
+        files = sorted(os.scandir(PROFILE_DIR), key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:max(0, len(files) - PROFILE_KEEP_FILES)]:
+            os.remove(entry.path)
+    except OSError as e:
+        logger.warning("Не удалось сохранить %s в %s: %s", name, PROFILE_DIR, e)
+
+def capture_slow_update(name, update, started, elapsed, span=None):
+    """Сохраняет медленное обновление: данные, трассу и стеки цикла событий за время обработки."""
+    global last_slow_capture
+    metrics.inc('bot_slow_updates_total', (('handler', name),))
+    now = time.monotonic()
+    if now - last_slow_capture < SLOW_UPDATE_COOLDOWN:
+        return
+    last_slow_capture = now
+    
+    finished = started + elapsed
+    samples = Counter()
+    blocks = []
+    if loop_watchdog is not None:
+        samples = loop_watchdog.samples_between(started, finished)
+        blocks = [stack for at, stack in list(loop_watchdog.blocks) if started <= at <= finished]
+    record = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'handler': name,
+        'duration_ms': round(elapsed * 1000, 1),
+        'trace_id': span.trace.trace_id if span is not None else None,
+        'update': update.to_dict() if isinstance(update, Update) else None,
+        'stack_samples': samples.most_common(),
+        'loop_blocks': blocks,
+    }
+    file_name = f"slow-{datetime.now():%Y%m%d-%H%M%S}-{name}.json"
+    content = redact_secrets(json.dumps(record, ensure_ascii=False, indent=1, default=str))
+    asyncio.get_running_loop().run_in_executor(None, write_profile_artifact, file_name, content)
+    logger.warning("Медленное обновление: %s, %.0f мс, сохранено в %s", name, elapsed * 1000,
+                   os.path.join(PROFILE_DIR, file_name))
 
 # Подключение к БД
-def get_db_connection():
-    conn = sqlite3.connect('user_preferences.db')
+DB_PATH = 'user_preferences.db'
+
+def get_db_connection(timeout=5.0):
+    conn = sqlite3.connect(DB_PATH, timeout=timeout)
     conn.row_factory = sqlite3.Row
     return conn
 
+async def run_db(func, *args):
+    """
+    Выполняет функцию работы с БД в отдельном потоке, не блокируя цикл событий.
+    Функция получает соединение первым аргументом и не должна сама делать commit.
+    Если вызывающая задача отменена, текущий запрос прерывается через
+    Connection.interrupt(), а незакоммиченные изменения откатываются.
+    """
+    state = {'conn': None, 'cancelled': False, 'elapsed': None}
+    
+    def call():
+        if state['cancelled']:
+            return None
+        started = time.perf_counter()
+        conn = get_db_connection()
+        state['conn'] = conn
+        try:
+            result = func(conn, *args)
+            if state['cancelled']:
+                conn.rollback()
+                return None
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            state['conn'] = None
+            conn.close()
+            state['elapsed'] = time.perf_counter() - started
+    
+    span = start_span('db', query=func.__name__)
+    try:
+        return await asyncio.to_thread(call)
+    except asyncio.CancelledError:
+        state['cancelled'] = True
+        conn = state['conn']
+        if conn is not None:
+            try:
+                conn.interrupt()
+            except sqlite3.ProgrammingError:
+                # Соединение уже закрыто потоком
+                pass
+        raise
+    finally:
+        # Время замеряется в потоке, а учитывается здесь, в цикле событий
+        if state['elapsed'] is not None:
+            metrics.observe('bot_db_query_duration_seconds', (('query', func.__name__),), state['elapsed'])
+        if span is not None:
+            span.finish()
+
 # Инициализация базы данных
 def init_db():
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    # Новая БД создается с инкрементальной очисткой (см. retain_history). В существующей
+    # режим меняется только полным VACUUM: python db_maintenance.py enable-incremental-vacuum
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
     # Создание таблицы пользователей
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -121,48 +681,497 @@ def init_db():
     )
     ''')
     
-    conn.commit()
-    conn.close()
+    # Индекс для исключения уже рекомендованных элементов (fetch_recommended_ids)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_history_user_category
+    ON recommendation_history (user_id, category)
+    ''')
+    
+    # Элементы, показанные пользователю до архивации истории: без дат и повторов,
+    # чтобы исключение уже рекомендованного работало и после переноса в архив
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS history_seen (
+        user_id INTEGER,
+        category TEXT,
+        item_id TEXT,
+        PRIMARY KEY (user_id, category, item_id)
+    ) WITHOUT ROWID
+    ''')
+    
+    # Каталог элементов, на которые ссылаются история и user_data
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS items (
+        category TEXT,
+        item_id TEXT,
+        title TEXT,
+        subtitle TEXT,
+        creator TEXT,
+        year TEXT,
+        rating REAL,
+        genres TEXT,
+        description TEXT,
+        image_url TEXT,
+        link TEXT,
+        preview_url TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (category, item_id)
+    )
+    ''')
+    
+    # Счетчики популярности по часовым интервалам: показы и оценки элементов и жанров
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS trending_counts (
+        bucket INTEGER,
+        kind TEXT,
+        category TEXT,
+        key TEXT,
+        impressions INTEGER DEFAULT 0,
+        likes INTEGER DEFAULT 0,
+        dislikes INTEGER DEFAULT 0,
+        PRIMARY KEY (bucket, kind, category, key)
+    )
+    ''')
+    
+    # Полнотекстовый индекс каталога для поиска; обновляется триггерами при записи в items
+    try:
+        create_item_search_index(cursor)
+    except sqlite3.OperationalError as e:
+        logger.warning("Полнотекстовый поиск недоступен (нет FTS5 в SQLite): %s", e)
 
-# Регистрация пользователя в базе данных
-def register_user(user_id, username, first_name, last_name):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Короткие коды жанров для кнопок оценки (общие для всех процессов бота)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS genre_codes (
+        code INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE
+    )
+    ''')
     
+    # Сохраненные состояния диалогов и user_data (SQLitePersistence)
     cursor.execute('''
-    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, registration_date)
-    VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, username, first_name, last_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    CREATE TABLE IF NOT EXISTS conversation_states (
+        name TEXT,
+        conversation_key TEXT,
+        state INTEGER,
+        updated_at TEXT,
+        PRIMARY KEY (name, conversation_key)
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_conversation_states_updated
+    ON conversation_states (name, updated_at)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at TEXT
+    )
+    ''')
     
     conn.commit()
+    # WAL: чтение (резервное копирование, выгрузка, отчеты) не блокирует запись
+    # обработчиков, а запись - чтение. Режим сохраняется в файле БД
+    journal_mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+    if journal_mode != 'wal':
+        logger.warning("Не удалось включить режим WAL, журнал БД: %s", journal_mode)
     conn.close()
 
+# Поля элемента, по которым ищет /search и inline-режим
+ITEM_SEARCH_COLUMNS = ('title', 'subtitle', 'creator', 'description')
+
+def item_search_values(row):
+    # Токенизатор unicode61 не приравнивает «ё» к «е», поэтому заменяем ее
+    # одинаково при индексации и в запросе
+    return ', '.join(f"replace(replace({row}.{column}, 'ё', 'е'), 'Ё', 'Е')" for column in ITEM_SEARCH_COLUMNS)
+
+def create_item_search_index(cursor):
+    """
+    Создает FTS5-индекс над items (external content: текст хранится только в items)
+    и триггеры, которые обновляют его при каждой записи элемента.
+    ID строк индекса совпадают с rowid таблицы items; после полного VACUUM
+    индекс нужно перестроить, инкрементальная очистка rowid не меняет.
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone()
+    columns = ', '.join(ITEM_SEARCH_COLUMNS)
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        {columns}, content='items', content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts (rowid, {columns}) VALUES (new.rowid, {item_search_values('new')});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts (items_fts, rowid, {columns}) VALUES ('delete', old.rowid, {item_search_values('old')});
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF {columns} ON items BEGIN
+        INSERT INTO items_fts (items_fts, rowid, {columns}) VALUES ('delete', old.rowid, {item_search_values('old')});
+        INSERT INTO items_fts (rowid, {columns}) VALUES (new.rowid, {item_search_values('new')});
+    END
+    ''')
+    if not exists:
+        # Элементы, сохраненные до появления индекса
+        cursor.execute(f'''
+        INSERT INTO items_fts (rowid, {columns}) SELECT items.rowid, {item_search_values('items')} FROM items
+        ''')
+
+# Регистрация пользователя в базе данных на переданном соединении (для run_db)
+def register_user(conn, user_id, username, first_name, last_name):
+    conn.execute('''
+    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, registration_date)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, username, first_name, last_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
 # Сохранение предпочтений пользователя
 def save_preference(user_id, category, genre, item_id, rating):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+    record_rating(conn, user_id, category, genre, item_id, rating)
+    conn.commit()
+    conn.close()
+
+# Оценка и счетчики популярности одной транзакцией на переданном соединении (для run_db)
+def record_rating(conn, user_id, category, genre, item_id, rating):
+    conn.execute('''
     INSERT INTO user_preferences (user_id, category, genre, item_id, rating)
     VALUES (?, ?, ?, ?, ?)
     ''', (user_id, category, genre, item_id, rating))
-    
-    conn.commit()
-    conn.close()
+    bump_trending_counts(conn, category, item_id, genre, **rating_counts(rating))
 
-# Сохранение истории рекомендаций
-def save_recommendation_history(user_id, category, item_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+# Счетчики популярности текущего часового интервала: элемент и каждый его жанр
+def bump_trending_counts(conn, category, item_id, genres, impressions=0, likes=0, dislikes=0):
+    if not (impressions or likes or dislikes):
+        return
+    bucket = trending_bucket()
+    rows = [(bucket, 'item', category, str(item_id), impressions, likes, dislikes)]
+    rows += [(bucket, 'genre', category, genre, impressions, likes, dislikes) for genre in split_genres(genres)]
+    conn.executemany('''
+    INSERT INTO trending_counts (bucket, kind, category, key, impressions, likes, dislikes)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (bucket, kind, category, key) DO UPDATE SET
+        impressions = impressions + excluded.impressions,
+        likes = likes + excluded.likes,
+        dislikes = dislikes + excluded.dislikes
+    ''', rows)
+
+def load_trending_counts(conn, since_bucket):
+    return conn.execute('''
+    SELECT bucket, kind, category, key, impressions, likes, dislikes
+    FROM trending_counts WHERE bucket >= ? ORDER BY bucket
+    ''', (since_bucket,)).fetchall()
+
+def prune_trending_counts(conn, before_bucket):
+    return conn.execute('DELETE FROM trending_counts WHERE bucket < ?', (before_bucket,)).rowcount
+
+# Запись в историю рекомендаций на переданном соединении (для run_db)
+def insert_recommendation_history(conn, user_id, category, item_id):
+    conn.execute('''
     INSERT INTO recommendation_history (user_id, category, item_id, recommendation_date)
     VALUES (?, ?, ?, ?)
     ''', (user_id, category, item_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    
+
+# Запись элемента каталога на переданном соединении (для run_db)
+ITEM_UPSERT_SQL = '''
+INSERT INTO items (category, item_id, title, subtitle, creator, year, rating, genres,
+                   description, image_url, link, preview_url, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (category, item_id) DO UPDATE SET
+    title = excluded.title, subtitle = excluded.subtitle, creator = excluded.creator,
+    year = excluded.year, rating = excluded.rating, genres = excluded.genres,
+    description = excluded.description, image_url = excluded.image_url,
+    link = excluded.link, preview_url = excluded.preview_url, updated_at = excluded.updated_at
+'''
+
+def upsert_item(conn, record):
+    conn.execute(ITEM_UPSERT_SQL, record.as_row() + (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+
+def load_item_row(conn, category, item_id):
+    return conn.execute('''
+    SELECT category, item_id, title, subtitle, creator, year, rating, genres,
+           description, image_url, link, preview_url
+    FROM items WHERE category = ? AND item_id = ?
+    ''', (category, item_id)).fetchone()
+
+# Несколько элементов каталога одним запросом (результаты поиска, импорт каталога)
+def upsert_items(conn, records):
+    updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany(ITEM_UPSERT_SQL, (record.as_row() + (updated_at,) for record in records))
+
+# Поиск по FTS5-индексу. Сначала ищем в названиях и авторах с ранжированием (bm25,
+# название весит больше); если этого мало, добавляем совпадения в описаниях без
+# ранжирования, новые первыми: с коротким префиксом совпадает большая часть описаний,
+# и ранжирование всех совпадений стоило бы десятки миллисекунд. Демо-элементы не ищутся.
+def select_item_matches(conn, match, category, order, limit):
+    category_filter = 'AND items.category = ?' if category else ''
+    params = (match, category, limit) if category else (match, limit)
+    return conn.execute(f'''
+    SELECT items.category, items.item_id, items.title, items.subtitle, items.creator, items.year,
+           items.rating, items.genres, items.description, items.image_url, items.link, items.preview_url
+    FROM items_fts JOIN items ON items.rowid = items_fts.rowid
+    WHERE items_fts MATCH ? {category_filter} AND items.item_id NOT LIKE 'fallback_%'
+    ORDER BY {order}
+    LIMIT ?
+    ''', params).fetchall()
+
+def search_item_rows(conn, match, category=None, limit=10):
+    rows = select_item_matches(
+        conn, f"{{title subtitle creator}} : ({match})", category,
+        'bm25(items_fts, 10.0, 5.0, 5.0, 1.0)', limit
+    )
+    if len(rows) < limit:
+        found = {(row['category'], row['item_id']) for row in rows}
+        rows += [
+            row for row in select_item_matches(
+                conn, f"{{description}} : ({match})", category, 'items_fts.rowid DESC', limit
+            )
+            if (row['category'], row['item_id']) not in found
+        ][:limit - len(rows)]
+    return rows
+
+# Элементы категории для работы без провайдеров. Выборка начинается со случайной строки:
+# ORDER BY random() читал бы всю таблицу, а импортированный каталог может быть большим.
+# Элементы, уже рекомендованные пользователю, отбрасываются, если есть другие.
+def load_offline_item_rows(conn, category, genre_terms=(), user_id=None, limit=50):
+    max_rowid = conn.execute('SELECT max(rowid) FROM items').fetchone()[0]
+    if not max_rowid:
+        return []
+    genre_filter = ''
+    params = (category,)
+    if genre_terms:
+        genre_filter = 'AND (' + ' OR '.join('genres LIKE ?' for _ in genre_terms) + ')'
+        params += tuple(f"%{term}%" for term in genre_terms)
+    query = f'''
+    SELECT category, item_id, title, subtitle, creator, year, rating, genres,
+           description, image_url, link, preview_url
+    FROM items
+    WHERE category = ? {genre_filter} AND item_id NOT LIKE 'fallback_%' AND rowid >= ? AND rowid < ?
+    LIMIT ?
+    '''
+    start = random.randint(1, max_rowid)
+    rows = conn.execute(query, params + (start, max_rowid + 1, limit)).fetchall()
+    if len(rows) < limit:
+        rows += conn.execute(query, params + (0, start, limit - len(rows))).fetchall()
+    if user_id and rows:
+        recommended_ids = fetch_recommended_ids(conn, user_id, category)
+        rows = [row for row in rows if row['item_id'] not in recommended_ids] or rows
+    return rows
+
+# Код жанра для callback_data; новый жанр получает следующий свободный код
+def ensure_genre_code(conn, name):
+    conn.execute('INSERT OR IGNORE INTO genre_codes (name) VALUES (?)', (name,))
+    return conn.execute('SELECT code FROM genre_codes WHERE name = ?', (name,)).fetchone()['code']
+
+def load_genre_name(conn, code):
+    row = conn.execute('SELECT name FROM genre_codes WHERE code = ?', (code,)).fetchone()
+    return row['name'] if row else None
+
+# Элемент (если он новый или изменился), запись истории с показом и код жанра одной транзакцией
+def record_recommendation(conn, user_id, record, store_item=True, assign_genre_code=False):
+    if store_item:
+        upsert_item(conn, record)
+    if user_id:
+        insert_recommendation_history(conn, user_id, record.category, record.id)
+        bump_trending_counts(conn, record.category, record.id, record.genres, impressions=1)
+    if assign_genre_code:
+        return ensure_genre_code(conn, record.genres)
+    return None
+
+# Сохранение истории рекомендаций
+def save_recommendation_history(user_id, category, item_id):
+    conn = get_db_connection()
+    insert_recommendation_history(conn, user_id, category, item_id)
     conn.commit()
     conn.close()
 
+# ID элементов, которые уже рекомендовались пользователю в категории (включая архивированную историю)
+def fetch_recommended_ids(conn, user_id, category):
+    cursor = conn.execute('''
+    SELECT item_id FROM recommendation_history
+    WHERE user_id = ? AND category = ?
+    UNION ALL
+    SELECT item_id FROM history_seen
+    WHERE user_id = ? AND category = ?
+    ''', (user_id, category, user_id, category))
+    return {row['item_id'] for row in cursor.fetchall()}
+
+# Хранение истории рекомендаций.
+# Показы старше HISTORY_RETENTION_DAYS переносятся в сжатые помесячные файлы
+# HISTORY_ARCHIVE_DIR/history-YYYY-MM.jsonl.gz, а их ID - в history_seen. Показы
+# демо-элементов и треков без ID (fallback_*) удаляются без архивации. Каждая пачка -
+# отдельная короткая транзакция: строки читаются и пишутся в архив до начала
+# транзакции, блокировка записи держится только на время INSERT и DELETE.
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "180"))  # 0 - хранить все
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "history_archive")
+RETENTION_BATCH_SIZE = 500
+RETENTION_SCAN_SIZE = 5000
+VACUUM_PAGES_PER_STEP = 200
+
+def append_history_archive(archive_dir, month, rows):
+    """Дописывает строки истории в архив месяца (новый член gzip) и сбрасывает файл на диск."""
+    os.makedirs(archive_dir, exist_ok=True)
+    data = ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+    with open(os.path.join(archive_dir, f"history-{month}.jsonl.gz"), 'ab') as file:
+        with gzip.GzipFile(fileobj=file, mode='ab') as archive:
+            archive.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+def archive_history_batch(conn, cutoff, archive_dir, limit=RETENTION_BATCH_SIZE):
+    """
+    Архивирует самые старые показы, если они раньше cutoff; возвращает число удаленных строк.
+    Строки удаляются только после записи архива: при сбое между ними пачка будет
+    заархивирована повторно (строки архива содержат id).
+    """
+    rows = conn.execute('''
+    SELECT id, user_id, category, item_id, recommendation_date FROM recommendation_history
+    ORDER BY id LIMIT ?
+    ''', (limit,)).fetchall()
+    expired = list(itertools.takewhile(lambda row: row['recommendation_date'] < cutoff, rows))
+    if not expired:
+        return 0
+    kept = [row for row in expired if not (row['item_id'] or '').startswith('fallback_')]
+    by_month = {}
+    for row in kept:
+        by_month.setdefault(row['recommendation_date'][:7], []).append(row)
+    for month, month_rows in by_month.items():
+        append_history_archive(archive_dir, month, month_rows)
+    
+    conn.executemany(
+        'INSERT OR IGNORE INTO history_seen (user_id, category, item_id) VALUES (?, ?, ?)',
+        [(row['user_id'], row['category'], row['item_id']) for row in kept]
+    )
+    # У более ранних строк id меньше (AUTOINCREMENT), все они вошли в пачку
+    conn.execute('DELETE FROM recommendation_history WHERE id <= ?', (expired[-1]['id'],))
+    return len(expired)
+
+def purge_fallback_history_batch(conn, after_id, scan_size=RETENTION_SCAN_SIZE):
+    """
+    Удаляет показы fallback_* среди следующих scan_size строк после after_id.
+    Возвращает (id последней просмотренной строки или None, если строк больше нет; удалено).
+    """
+    last_id = conn.execute('''
+    SELECT max(id) FROM (SELECT id FROM recommendation_history WHERE id > ? ORDER BY id LIMIT ?)
+    ''', (after_id, scan_size)).fetchone()[0]
+    if last_id is None:
+        return None, 0
+    deleted = conn.execute('''
+    DELETE FROM recommendation_history WHERE id > ? AND id <= ? AND item_id LIKE 'fallback_%'
+    ''', (after_id, last_id)).rowcount
+    return last_id, deleted
+
+def incremental_vacuum_step(conn, pages=VACUUM_PAGES_PER_STEP):
+    """
+    Возвращает файлу БД до pages свободных страниц: (освобождено, осталось свободных)
+    или None, если в БД не включен режим auto_vacuum = INCREMENTAL.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return None
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if free:
+        conn.execute(f'PRAGMA incremental_vacuum({min(free, pages)})').fetchall()
+    remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return free - remaining, remaining
+
+# Резервные копии БД.
+# Копия снимается online backup API по BACKUP_PAGES_PER_STEP страниц: блокировка
+# чтения держится только на время шага, между шагами обработчики свободно пишут.
+# Если копируемая БД меняется другим соединением, SQLite начинает копирование
+# заново; тогда шаг увеличивается в BACKUP_STEP_GROWTH раз, а после BACKUP_MAX_RESTARTS
+# перезапусков копия снимается одним шагом. БД работает в режиме WAL (см. init_db),
+# поэтому и этот шаг - только транзакция чтения, запись обработчиков его не ждет.
+# Готовый снимок переводится в обычный журнал (один файл), проверяется
+# (quick_check), сжимается и ротируется.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.02
+BACKUP_STEP_GROWTH = 8
+BACKUP_MAX_RESTARTS = 3
+BACKUP_PREFIX = 'user_preferences-'
+
+class BackupRestarted(Exception):
+    pass
+
+def snapshot_database(target_path, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE):
+    """Копирует БД в target_path онлайн; возвращает число страниц копии."""
+    source = get_db_connection()
+    target = sqlite3.connect(target_path)
+    
+    def progress(status, remaining, total):
+        if remaining > progress.remaining:
+            raise BackupRestarted()
+        progress.remaining = remaining
+    
+    try:
+        for _ in range(BACKUP_MAX_RESTARTS):
+            progress.remaining = float('inf')
+            try:
+                source.backup(target, pages=pages, progress=progress, sleep=pause)
+                break
+            except BackupRestarted:
+                pages *= BACKUP_STEP_GROWTH
+        else:
+            logger.warning("Резервная копия перезапускалась %s раз из-за записи в БД, "
+                           "копирование одним шагом", BACKUP_MAX_RESTARTS)
+            source.backup(target)
+        target.execute('PRAGMA journal_mode = DELETE')
+        return target.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+
+def compress_file(source_path, target_path):
+    """Сжимает файл в gzip потоком; target_path появляется только целиком записанным."""
+    partial_path = target_path + '.partial'
+    with open(source_path, 'rb') as source, open(partial_path, 'wb') as file:
+        with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=6) as archive:
+            shutil.copyfileobj(source, archive, 1024 * 1024)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(partial_path, target_path)
+
+def rotate_backups(backup_dir, keep):
+    """Удаляет самые старые сжатые копии сверх keep; возвращает удаленные имена."""
+    names = sorted(
+        name for name in os.listdir(backup_dir)
+        if name.startswith(BACKUP_PREFIX) and name.endswith('.db.gz')
+    )
+    removed = names[:-keep] if keep > 0 else []
+    for name in removed:
+        os.remove(os.path.join(backup_dir, name))
+    return removed
+
+def create_backup(backup_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """
+    Снимает, проверяет и сжимает копию БД в backup_dir, затем ротирует старые копии.
+    Возвращает (путь к копии, размер снимка, размер сжатой копии). Выполняется в потоке.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    name = BACKUP_PREFIX + datetime.now().strftime("%Y%m%d-%H%M%S")
+    snapshot_path = os.path.join(backup_dir, name + '.db')
+    backup_path = snapshot_path + '.gz'
+    try:
+        snapshot_database(snapshot_path)
+        check_conn = sqlite3.connect(snapshot_path)
+        try:
+            result = check_conn.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            check_conn.close()
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f"снимок БД поврежден: {result}")
+        compress_file(snapshot_path, backup_path)
+        snapshot_size = os.path.getsize(snapshot_path)
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+    rotate_backups(backup_dir, keep)
+    return backup_path, snapshot_size, os.path.getsize(backup_path)
+
 # Получение предпочтений пользователя
 def get_user_preferences(user_id, category=None):
     conn = get_db_connection()
@@ -188,78 +1197,1241 @@ def get_user_preferences(user_id, category=None):
 def generate_random_id():
     return f"fallback_{random.randint(10000, 99999)}"
 
-# Функции для получения рекомендаций от API
+# Хранение состояний диалогов и user_data в SQLite.
+# В user_data лежат только ID текущих карточек; сами элементы берутся из каталога.
+PERSISTED_USER_DATA_KEYS = ('current_movie', 'current_music', 'current_book')
+# Как часто PTB передает изменения в хранилище, секунды
+PERSISTENCE_UPDATE_INTERVAL = 30
+# Задержка записи: изменения одного прохода PTB пишутся одной транзакцией
+PERSISTENCE_FLUSH_DELAY = 1.0
+# Состояния диалогов старше этого срока при запуске не загружаются
+CONVERSATION_STATE_TTL = timedelta(days=7)
+# user_data неактивных пользователей выгружается из памяти (данные остаются в БД)
+USER_DATA_IDLE_TTL = 30 * 60
+USER_DATA_EVICTION_INTERVAL = 5 * 60
 
-async def get_movie_recommendations(genre_id=None, user_id=None):
-    # Используем популярные фильмы, если жанр не указан
-    if genre_id:
-        url = f"https://api.themoviedb.org/3/discover/movie?api_key={TMDB_API_KEY}&with_genres={genre_id}&sort_by=popularity.desc&page=1"
-    else:
-        url = f"https://api.themoviedb.org/3/movie/popular?api_key={TMDB_API_KEY}&page=1"
+def compact_user_data(user_data):
+    """Оставляет в user_data только сохраняемые ключи и сериализует их в JSON."""
+    compact = {key: user_data[key] for key in PERSISTED_USER_DATA_KEYS if user_data.get(key)}
+    return json.dumps(compact, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+def expand_user_data(data):
+    compact = json.loads(data)
+    for key, value in compact.items():
+        # Ранее сохранялась часть карточки, теперь хранится только ID
+        if isinstance(value, dict):
+            compact[key] = str(value.get('id'))
+    return compact
+
+def load_user_data_row(conn, user_id):
+    row = conn.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+    return row['data'] if row else None
+
+def load_conversation_states(conn, name, since):
+    cursor = conn.execute('''
+    SELECT conversation_key, state FROM conversation_states
+    WHERE name = ? AND updated_at >= ?
+    ''', (name, since))
+    return {tuple(json.loads(row['conversation_key'])): row['state'] for row in cursor.fetchall()}
+
+def write_persistence_batch(conn, user_rows, conversation_rows):
+    """Записывает накопленные изменения одной транзакцией."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany('''
+    INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+    ''', [(user_id, data, now) for user_id, data in user_rows if data is not None])
+    conn.executemany(
+        'DELETE FROM user_data WHERE user_id = ?',
+        [(user_id,) for user_id, data in user_rows if data is None]
+    )
+    conn.executemany('''
+    INSERT INTO conversation_states (name, conversation_key, state, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (name, conversation_key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+    ''', [(name, key, state, now) for (name, key), state in conversation_rows if state is not None])
+    conn.executemany(
+        'DELETE FROM conversation_states WHERE name = ? AND conversation_key = ?',
+        [(name, key) for (name, key), state in conversation_rows if state is None]
+    )
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранилище PTB в той же базе SQLite.
     
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        if 'results' in data and data['results']:
-            # Исключаем фильмы, которые уже были рекомендованы пользователю
-            if user_id:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('''
-                SELECT item_id FROM recommendation_history
-                WHERE user_id = ? AND category = 'movie'
-                ''', (user_id,))
-                recommended_ids = [row['item_id'] for row in cursor.fetchall()]
-                conn.close()
-                
-                filtered_results = [movie for movie in data['results'] if str(movie['id']) not in recommended_ids]
-                if filtered_results:
-                    movie = random.choice(filtered_results)
-                else:
-                    # Если все фильмы уже рекомендованы, берем любой
-                    movie = random.choice(data['results'])
+    user_data загружается лениво при первом обновлении от пользователя, а не при запуске,
+    и выгружается из памяти после USER_DATA_IDLE_TTL без активности.
+    Изменения копятся в памяти: неизмененные данные не пишутся, остальные
+    записываются пачкой через PERSISTENCE_FLUSH_DELAY после прохода PTB.
+    """
+    
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL, flush_delay=PERSISTENCE_FLUSH_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+        self.loaded_users = set()
+        self.last_seen = {}
+        # Последнее записанное (или загруженное) значение: по нему отсекаются неизмененные данные
+        self.written_user_data = {}
+        self.pending_users = {}
+        self.pending_conversations = {}
+        self.flush_task = None
+    
+    def schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.delayed_flush())
+    
+    async def delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.write_pending()
+    
+    async def write_pending(self):
+        if not self.pending_users and not self.pending_conversations:
+            return
+        user_rows = list(self.pending_users.items())
+        conversation_rows = list(self.pending_conversations.items())
+        self.pending_users = {}
+        self.pending_conversations = {}
+        try:
+            await run_db(write_persistence_batch, user_rows, conversation_rows)
+        except Exception as e:
+            logger.error("Ошибка записи состояний в БД: %s", e)
+            # Возвращаем изменения в очередь, если их не перекрыли более новые
+            for user_id, data in user_rows:
+                self.pending_users.setdefault(user_id, data)
+            for key, state in conversation_rows:
+                self.pending_conversations.setdefault(key, state)
+            return
+        for user_id, data in user_rows:
+            if data is None:
+                self.written_user_data.pop(user_id, None)
             else:
-                movie = random.choice(data['results'])
-            
-            # Сохраняем рекомендацию в историю
-            if user_id:
-                save_recommendation_history(user_id, 'movie', str(movie['id']))
-            
-            # Получаем дополнительную информацию о фильме
-            movie_url = f"https://api.themoviedb.org/3/movie/{movie['id']}?api_key={TMDB_API_KEY}&language=ru"
-            movie_response = requests.get(movie_url, timeout=10)
-            movie_response.raise_for_status()
-            movie_data = movie_response.json()
-            
-            # Формируем информацию о фильме
-            title = movie_data.get('title', 'Название неизвестно')
-            original_title = movie_data.get('original_title', '')
-            year = movie_data.get('release_date', '')[:4] if movie_data.get('release_date') else 'Год неизвестен'
-            rating = movie_data.get('vote_average', 0)
-            genres = ', '.join([genre['name'] for genre in movie_data.get('genres', [])])
-            overview = movie_data.get('overview', 'Описание отсутствует')
-            poster_path = movie_data.get('poster_path', None)
-            poster_url = f"https://image.tmdb.org/t/p/w500{poster_path}" if poster_path else None
-            
-            return {
-                'id': movie['id'],
-                'title': title,
-                'original_title': original_title,
-                'year': year,
-                'rating': rating,
-                'genres': genres,
-                'overview': overview,
-                'poster_url': poster_url
-            }
-        
+                self.written_user_data[user_id] = data
+    
+    async def get_user_data(self):
+        # Данные пользователей подгружаются в refresh_user_data
+        return {}
+    
+    async def refresh_user_data(self, user_id, user_data):
+        self.last_seen[user_id] = time.monotonic()
+        if user_id in self.loaded_users:
+            return
+        self.loaded_users.add(user_id)
+        data = await run_db(load_user_data_row, user_id)
+        if data is None:
+            return
+        self.written_user_data[user_id] = data
+        for key, value in expand_user_data(data).items():
+            user_data.setdefault(key, value)
+    
+    async def update_user_data(self, user_id, data):
+        # PTB отмечает пользователя и без вызова обработчика; данные, которые не
+        # загружались (или уже выгружены), пусты и не должны затирать сохраненные
+        if user_id not in self.loaded_users:
+            return
+        compact = compact_user_data(data)
+        if self.written_user_data.get(user_id) == compact and user_id not in self.pending_users:
+            return
+        self.pending_users[user_id] = compact
+        self.schedule_flush()
+    
+    async def drop_user_data(self, user_id):
+        self.loaded_users.discard(user_id)
+        self.last_seen.pop(user_id, None)
+        self.pending_users[user_id] = None
+        self.schedule_flush()
+    
+    def evict_idle_users(self, application, idle_ttl=USER_DATA_IDLE_TTL):
+        """Выгружает из памяти user_data пользователей, неактивных дольше idle_ttl."""
+        cutoff = time.monotonic() - idle_ttl
+        idle_users = [
+            user_id for user_id, seen in self.last_seen.items()
+            if seen < cutoff and user_id not in self.pending_users
+        ]
+        for user_id in idle_users:
+            # В PTB нет публичного способа убрать данные только из памяти:
+            # drop_user_data удалил бы их и из хранилища
+            application._user_data.pop(user_id, None)
+            self.loaded_users.discard(user_id)
+            self.written_user_data.pop(user_id, None)
+            del self.last_seen[user_id]
+        return len(idle_users)
+    
+    async def get_conversations(self, name):
+        since = (datetime.now() - CONVERSATION_STATE_TTL).strftime("%Y-%m-%d %H:%M:%S")
+        return await run_db(load_conversation_states, name, since)
+    
+    async def update_conversation(self, name, key, new_state):
+        self.pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self.schedule_flush()
+    
+    async def flush(self):
+        # Отложенную запись не отменяем: отмена откатила бы уже начатую транзакцию
+        if self.flush_task is not None and not self.flush_task.done():
+            await self.flush_task
+        await self.write_pending()
+    
+    # chat_data, bot_data и callback_data бот не использует
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
         return None
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# HTTP-клиент для обращения к внешним API.
+# Запросы выполняются асинхронно, поэтому отмена задачи прерывает запрос
+# и сразу освобождает соединение.
+_http_client = None
+
+def get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=10)
+    return _http_client
+
+TELEGRAM_POOL_SIZE = 256
+
+class TracedHTTPXRequest(HTTPXRequest):
+    """
+    Запросы к Bot API (отправка и редактирование сообщений) как спаны трассы.
+    in_flight - число незавершенных запросов (для /readyz).
+    """
+    
+    in_flight = 0
+    
+    async def do_request(self, url, method, *args, **kwargs):
+        TracedHTTPXRequest.in_flight += 1
+        try:
+            # В URL есть токен бота, поэтому в спан попадает только метод API
+            with trace_span('telegram', method=url.rsplit('/', 1)[-1]):
+                return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            TracedHTTPXRequest.in_flight -= 1
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+
+# Учет квот внешних API
+
+class QuotaExceeded(httpx.HTTPError):
+    """Запрос к API отклонен локально, чтобы не превысить квоту провайдера."""
+
+# Лимиты провайдеров: запросов в секунду, размер всплеска и дневной бюджет (None - без ограничения)
+PROVIDER_QUOTAS = {
+    'tmdb': {'rate': 40, 'burst': 40, 'daily': None},
+    'spotify': {'rate': 10, 'burst': 20, 'daily': None},
+    'google_books': {'rate': 1, 'burst': 10, 'daily': int(os.getenv("GOOGLE_BOOKS_DAILY_QUOTA", "1000"))},
+}
+
+PROVIDER_HOSTS = {
+    'api.themoviedb.org': 'tmdb',
+    'api.spotify.com': 'spotify',
+    'accounts.spotify.com': 'spotify',
+    'www.googleapis.com': 'google_books',
+}
+
+# Приоритет текущих запросов: 'interactive' - пользователь ждет ответа,
+# 'background' - предзагрузка, которая уступает квоту интерактивным запросам
+request_priority = contextvars.ContextVar('request_priority', default='interactive')
+
+# Дневные квоты Google сбрасываются в полночь по тихоокеанскому времени
+QUOTA_DAY_TIMEZONE = timezone(timedelta(hours=-8))
+
+class TokenBucket:
+    """Корзина токенов: пополняется со скоростью rate, вмещает не больше capacity."""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def try_take(self, reserve=0.0):
+        """Берет токен, оставляя в корзине не меньше reserve; иначе возвращает время ожидания."""
+        self.refill()
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return 0.0
+        return (1 + reserve - self.tokens) / self.rate
+
+class QuotaManager:
+    """
+    Следит за скоростью и дневным объемом запросов к каждому провайдеру.
+    Интерактивные запросы при нехватке токенов недолго ждут, фоновые сразу
+    отклоняются и не могут расходовать резерв дневного бюджета и всплеска.
+    """
+    
+    BACKGROUND_RESERVE = 0.2
+    NEAR_EXHAUSTION = 0.1
+    MAX_INTERACTIVE_WAIT = 2.0
+    
+    def __init__(self, quotas):
+        self.quotas = quotas
+        self.buckets = {name: TokenBucket(q['rate'], q['burst']) for name, q in quotas.items()}
+        self.daily_used = dict.fromkeys(quotas, 0)
+        self.blocked_until = dict.fromkeys(quotas, 0.0)
+        self.counters = {name: {'allowed': 0, 'waited': 0, 'shed': 0} for name in quotas}
+        self.day = self._today()
+    
+    @staticmethod
+    def _today():
+        return datetime.now(QUOTA_DAY_TIMEZONE).date()
+    
+    def _roll_day(self):
+        today = self._today()
+        if today != self.day:
+            self.day = today
+            self.daily_used = dict.fromkeys(self.quotas, 0)
+    
+    def daily_remaining(self, provider):
+        self._roll_day()
+        daily = self.quotas[provider]['daily']
+        if daily is None:
+            return None
+        return max(daily - self.daily_used[provider], 0)
+    
+    def is_near_exhaustion(self, provider):
+        """True, если дневного бюджета почти не осталось или провайдер ответил 429."""
+        if time.monotonic() < self.blocked_until[provider]:
+            return True
+        remaining = self.daily_remaining(provider)
+        daily = self.quotas[provider]['daily']
+        return remaining is not None and remaining <= daily * self.NEAR_EXHAUSTION
+    
+    def _shed(self, provider, reason):
+        self.counters[provider]['shed'] += 1
+        raise QuotaExceeded(f"Квота {provider} исчерпана: {reason}")
+    
+    async def acquire(self, provider, priority='interactive'):
+        """Резервирует один запрос к провайдеру или выбрасывает QuotaExceeded."""
+        background = priority == 'background'
+        
+        blocked_for = self.blocked_until[provider] - time.monotonic()
+        if blocked_for > 0 and (background or blocked_for > self.MAX_INTERACTIVE_WAIT):
+            self._shed(provider, f"провайдер ограничил запросы еще на {blocked_for:.0f} с")
+        
+        remaining = self.daily_remaining(provider)
+        if remaining is not None:
+            reserve = self.quotas[provider]['daily'] * self.BACKGROUND_RESERVE if background else 0
+            if remaining <= reserve:
+                self._shed(provider, "дневной бюджет")
+        
+        if blocked_for > 0:
+            self.counters[provider]['waited'] += 1
+            await asyncio.sleep(blocked_for)
+        
+        bucket = self.buckets[provider]
+        reserve = bucket.capacity * self.BACKGROUND_RESERVE if background else 0
+        wait = bucket.try_take(reserve)
+        if wait > 0:
+            if background or wait > self.MAX_INTERACTIVE_WAIT:
+                self._shed(provider, "лимит запросов в секунду")
+            self.counters[provider]['waited'] += 1
+            # Токен резервируется сразу, чтобы ожидающие запросы выстраивались в очередь
+            bucket.tokens -= 1
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Запрос отменен до отправки: поиск пользователя заменен новым
+                # (/start, новый поиск или уход с экрана - cancel_recommendation_fetch)
+                # или бот останавливается. Токен возвращается, иначе отмены
+                # постепенно съедали бы квоту
+                bucket.refill()
+                bucket.tokens = min(bucket.capacity, bucket.tokens + 1)
+                raise
+        
+        self.daily_used[provider] += 1
+        self.counters[provider]['allowed'] += 1
+    
+    def note_rate_limited(self, provider, retry_after=None):
+        """Учитывает ответ 429: до истечения Retry-After новые запросы не отправляются."""
+        try:
+            delay = float(retry_after) if retry_after else 1.0
+        except ValueError:
+            delay = 1.0
+        self.blocked_until[provider] = max(self.blocked_until[provider], time.monotonic() + delay)
+        logger.warning("Провайдер %s ограничил запросы (429), пауза %.0f с", provider, delay)
+    
+    def mark_exhausted(self, provider):
+        """Отмечает дневной бюджет исчерпанным по ответу самого провайдера."""
+        daily = self.quotas[provider]['daily']
+        if daily is not None:
+            self.daily_used[provider] = max(self.daily_used[provider], daily)
+        logger.warning("Дневная квота %s исчерпана по ответу API", provider)
+    
+    def snapshot(self):
+        """Текущее состояние квот для метрик."""
+        result = {}
+        for provider, bucket in self.buckets.items():
+            bucket.refill()
+            result[provider] = {
+                'tokens': round(bucket.tokens, 2),
+                'daily_used': self.daily_used[provider],
+                'daily_remaining': self.daily_remaining(provider),
+                **self.counters[provider],
+            }
+        return result
+
+quota_manager = QuotaManager(PROVIDER_QUOTAS)
+
+def get_quota_metrics():
+    return quota_manager.snapshot()
+
+async def acquire_quota(url):
+    provider = PROVIDER_HOSTS.get(httpx.URL(url).host)
+    if provider:
+        await quota_manager.acquire(provider, request_priority.get())
+    return provider
+
+def note_quota_response(provider, response):
+    if provider and response.status_code == 429:
+        quota_manager.note_rate_limited(provider, response.headers.get('Retry-After'))
+
+# Хеджирование запросов: если ответ задерживается дольше обычного (p90 провайдера),
+# отправляется второй такой же запрос и используется тот, что ответит первым.
+# Включается переменной среды HEDGE_REQUESTS=1.
+HEDGING_ENABLED = os.getenv("HEDGE_REQUESTS", "0") == "1"
+# Не больше такой доли дополнительных запросов от общего числа
+HEDGE_MAX_EXTRA_RATIO = float(os.getenv("HEDGE_MAX_EXTRA_RATIO", "0.05"))
+# Порог не вычисляется, пока наблюдений меньше этого числа
+HEDGE_MIN_SAMPLES = 50
+
+class LatencyHistogram:
+    """
+    Гистограмма задержек с фиксированными границами корзин (в секундах).
+    Счетчики периодически уменьшаются вдвое, чтобы порог следовал за
+    текущим поведением провайдера, а не за всей историей.
+    """
+    
+    BOUNDS = (0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, float('inf'))
+    DECAY_EVERY = 1000
+    
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.total = 0
+        self.observed = 0
+        self.sum = 0.0
+    
+    def observe(self, seconds):
+        for index, bound in enumerate(self.BOUNDS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.total += 1
+        self.observed += 1
+        self.sum += seconds
+        if self.total >= self.DECAY_EVERY:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+    
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает квантиль q."""
+        if not self.total:
+            return None
+        rank = q * self.total
+        cumulative = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.BOUNDS[-1]
+
+class HedgingPolicy:
+    """Собирает задержки провайдеров и решает, когда отправлять дублирующий запрос."""
+    
+    def __init__(self, max_extra_ratio=HEDGE_MAX_EXTRA_RATIO, min_samples=HEDGE_MIN_SAMPLES):
+        self.max_extra_ratio = max_extra_ratio
+        self.min_samples = min_samples
+        self.histograms = {provider: LatencyHistogram() for provider in PROVIDER_QUOTAS}
+        self.requests = Counter()
+        self.hedges = Counter()
+        self.hedge_wins = Counter()
+    
+    def observe(self, provider, seconds):
+        self.histograms[provider].observe(seconds)
+    
+    def threshold(self, provider):
+        histogram = self.histograms[provider]
+        if histogram.total < self.min_samples:
+            return None
+        threshold = histogram.quantile(0.9)
+        return None if threshold == float('inf') else threshold
+    
+    def may_hedge(self, provider):
+        return self.hedges[provider] < self.requests[provider] * self.max_extra_ratio
+
+hedging_policy = HedgingPolicy()
+
+# ID в путях запросов заменяются на {id}, чтобы число эндпоинтов в метриках было ограничено
+ENDPOINT_ID_SEGMENT = re.compile(r'^(?=.*\d)[\w-]{10,}$|^\d{2,}$')
+
+@functools.lru_cache(maxsize=1024)
+def endpoint_labels(provider, path):
+    endpoint = '/'.join(
+        '{id}' if ENDPOINT_ID_SEGMENT.match(segment) else segment for segment in path.split('/')
+    )
+    return (('provider', provider), ('endpoint', endpoint))
+
+# Подряд идущие ошибки и время последних ответов провайдеров (для /readyz)
+PROVIDER_FAILING_AFTER = 5
+provider_health = {
+    provider: {'consecutive_failures': 0, 'last_success': None, 'last_failure': None}
+    for provider in PROVIDER_QUOTAS
+}
+
+def note_provider_outcome(provider, status):
+    health = provider_health.get(provider)
+    if health is None or status == 'cancelled':
+        return
+    if status == 'error' or status.startswith('5'):
+        health['consecutive_failures'] += 1
+        health['last_failure'] = time.time()
+    else:
+        health['consecutive_failures'] = 0
+        health['last_success'] = time.time()
+
+def observe_provider_request(provider, url, seconds, status, span=None):
+    labels = endpoint_labels(provider, httpx.URL(url).path)
+    metrics.observe('bot_provider_request_duration_seconds', labels, seconds)
+    metrics.inc('bot_provider_responses_total', labels + (('status', status),))
+    note_provider_outcome(provider, status)
+    if span is not None:
+        span.finish(endpoint=labels[1][1], status=status)
+
+async def send_get(provider, url, headers, timeout):
+    """Отправляет один GET-запрос и учитывает его задержку и ответ."""
+    span = start_span('provider', provider=provider) if provider else None
+    started = time.monotonic()
+    try:
+        response = await get_http_client().get(url, headers=headers, timeout=timeout)
+    except asyncio.CancelledError:
+        # Запрос длился не меньше этого времени: тоже учитываем, чтобы не занижать p90
+        if provider:
+            elapsed = time.monotonic() - started
+            hedging_policy.observe(provider, elapsed)
+            observe_provider_request(provider, url, elapsed, 'cancelled', span)
+        raise
+    except httpx.HTTPError:
+        if provider:
+            observe_provider_request(provider, url, time.monotonic() - started, 'error', span)
+        raise
+    if provider:
+        elapsed = time.monotonic() - started
+        hedging_policy.observe(provider, elapsed)
+        observe_provider_request(provider, url, elapsed, str(response.status_code), span)
+    note_quota_response(provider, response)
+    return response
+
+async def hedged_get(provider, url, headers, timeout):
+    primary = asyncio.ensure_future(send_get(provider, url, headers, timeout))
+    tasks = [primary]
+    try:
+        threshold = hedging_policy.threshold(provider)
+        if threshold is None:
+            return await primary
+        
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done or not hedging_policy.may_hedge(provider):
+            return await primary
+        
+        try:
+            # Дублирующий запрос не должен ждать квоту и тратить резерв интерактивных запросов
+            await quota_manager.acquire(provider, 'background')
+        except QuotaExceeded:
+            return await primary
+        
+        hedging_policy.hedges[provider] += 1
+        hedge = asyncio.ensure_future(send_get(provider, url, headers, timeout))
+        tasks.append(hedge)
+        
+        # Выигрывает первый успешный (2xx) ответ: быстрый 5xx или 429 одного запроса
+        # не должен заменять ответ другого, который еще выполняется
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().is_success:
+                    if task is hedge:
+                        hedging_policy.hedge_wins[provider] += 1
+                    return task.result()
+        # Оба запроса неуспешны: ответ с ошибкой (сначала основного), иначе исключение основного
+        for task in tasks:
+            if task.exception() is None:
+                return task.result()
+        return primary.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def api_get(url, headers=None, timeout=10):
+    provider = await acquire_quota(url)
+    if provider:
+        hedging_policy.requests[provider] += 1
+    if HEDGING_ENABLED and provider:
+        return await hedged_get(provider, url, headers, timeout)
+    return await send_get(provider, url, headers, timeout)
+
+# Кэш результатов поиска у провайдеров
+
+class CachedFailure(httpx.HTTPError):
+    """Недавний запрос с тем же ключом завершился ошибкой; повтор отложен."""
+
+# Время жизни записей по провайдерам: (свежая запись, допустимая устарелость) в секундах
+PROVIDER_CACHE_TTL = {
+    'tmdb': (10 * 60, 60 * 60),
+    'spotify': (10 * 60, 60 * 60),
+    'google_books': (30 * 60, 6 * 60 * 60),
+}
+# Сколько помнить пустые ответы и ошибки, чтобы не повторять заведомо пустые запросы
+NEGATIVE_CACHE_TTL = 60
+
+def is_cacheable_failure(error):
+    """
+    Стоит ли запомнить ошибку: нет данных (404), сбой провайдера (5xx) или сети.
+    Отказы по квоте (локальные и 429) и ошибки авторизации (401, 403 - например,
+    истекший токен Spotify) не запоминаются: повтор скоро пройдет.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 404 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+class ProviderCache:
+    """
+    Кэш ответов провайдеров по ключу (URL запроса).
+    Свежая запись отдается сразу. Устаревшая тоже отдается сразу, а в фоне
+    запускается обновление (stale-while-revalidate). Пустые ответы и сбои
+    провайдера (is_cacheable_failure) запоминаются на NEGATIVE_CACHE_TTL. Одинаковые одновременные запросы
+    объединяются в один. Если квота провайдера почти исчерпана или он
+    недоступен, отдается последняя удачная версия независимо от возраста.
+    Возраст записей считается по clock (benchmarks/traffic_replay.py подменяет
+    его ускоренными часами).
+    """
+    
+    def __init__(self, max_entries=2000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.refreshing = set()
+        self.tasks = set()
+        self.stats = Counter()
+    
+    async def get(self, key, fetch, provider, is_empty=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            age = self.clock() - entry['stored_at']
+            fresh_ttl, stale_ttl = PROVIDER_CACHE_TTL.get(provider, (0, 0))
+            
+            if entry['negative']:
+                if age < NEGATIVE_CACHE_TTL:
+                    self.stats['negative'] += 1
+                    return self._unwrap(entry)
+            elif age < fresh_ttl:
+                self.stats['hit'] += 1
+                self.entries.move_to_end(key)
+                return entry['data']
+            elif age < fresh_ttl + stale_ttl or quota_manager.is_near_exhaustion(provider):
+                self.stats['stale'] += 1
+                self.entries.move_to_end(key)
+                self._refresh_in_background(key, fetch, provider, is_empty)
+                return entry['data']
+        
+        self.stats['miss'] += 1
+        try:
+            return await self._load(key, fetch, provider, is_empty)
+        except httpx.HTTPError:
+            if entry is not None and not entry['negative']:
+                # Провайдер недоступен: отдаем последнюю удачную версию
+                self.stats['stale_on_error'] += 1
+                return entry['data']
+            raise
+    
+    @staticmethod
+    def _unwrap(entry):
+        if entry['error']:
+            raise CachedFailure(entry['error'])
+        return entry['data']
+    
+    def _store(self, key, data=None, error=None, negative=False):
+        self.entries[key] = {
+            'data': data,
+            'error': error,
+            'negative': negative,
+            'stored_at': self.clock(),
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    async def _fetch_and_store(self, key, fetch, is_empty):
+        try:
+            data = await fetch()
+        except httpx.HTTPError as e:
+            existing = self.entries.get(key)
+            if is_cacheable_failure(e) and (existing is None or existing['negative']):
+                self._store(key, error=str(e), negative=True)
+            raise
+        
+        self._store(key, data=data, negative=bool(is_empty and is_empty(data)))
+        return data
+    
+    async def _load(self, key, fetch, provider, is_empty):
+        inflight = self.inflight.get(key)
+        if inflight is None:
+            task = asyncio.get_running_loop().create_task(self._fetch_and_store(key, fetch, is_empty))
+            inflight = self.inflight[key] = {'task': task, 'waiters': 0}
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.stats['coalesced'] += 1
+        
+        inflight['waiters'] += 1
+        try:
+            return await asyncio.shield(inflight['task'])
+        except asyncio.CancelledError:
+            # Запрос отменяется, только если его больше никто не ждет
+            if inflight['waiters'] == 1:
+                inflight['task'].cancel()
+            raise
+        finally:
+            inflight['waiters'] -= 1
+    
+    def _refresh_in_background(self, key, fetch, provider, is_empty):
+        if key in self.refreshing or key in self.inflight:
+            return
+        self.refreshing.add(key)
+        
+        async def refresh():
+            request_priority.set('background')
+            # Фоновое обновление не относится к трассе запроса, который его вызвал
+            current_span.set(None)
+            try:
+                await self._fetch_and_store(key, fetch, is_empty)
+                self.stats['refreshed'] += 1
+            except Exception as e:
+                logger.warning("Не удалось обновить кэш %s: %s", provider, e)
+            finally:
+                self.refreshing.discard(key)
+        
+        task = asyncio.get_running_loop().create_task(refresh())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+provider_cache = ProviderCache()
+
+async def cached_get_json(url, is_empty=None, headers=None):
+    """GET-запрос к провайдеру через кэш; возвращает разобранный JSON."""
+    async def fetch():
+        response = await api_get(url, headers=headers)
+        response.raise_for_status()
+        return response.json()
+    
+    return await provider_cache.get(url, fetch, PROVIDER_HOSTS.get(httpx.URL(url).host), is_empty)
+
+# Построение запросов к API и приведение ответов к формату карточек
+
+# Поля Google Books, нужные для выбора книги и ее карточки (partial response).
+# Без проекции API возвращает полные тома: описания, ISBN, saleInfo, accessInfo и т.д.
+GOOGLE_BOOKS_SEARCH_FIELDS = (
+    "items(id,volumeInfo(title,authors,publishedDate,description,categories,"
+    "language,imageLinks/thumbnail,previewLink))"
+)
+GOOGLE_BOOKS_TITLE_FIELDS = "id,volumeInfo/title"
+
+def build_tmdb_url(path, **params):
+    """
+    Формирует URL запроса к TMDB с русской локализацией.
+    TMDB не поддерживает выбор полей; подресурсы (credits, videos и т.п.) можно
+    получить тем же запросом через append_to_response, не делая отдельных вызовов.
+    """
+    params = {'api_key': TMDB_API_KEY, 'language': 'ru', **params}
+    return f"https://api.themoviedb.org/3{path}?{urlencode(params)}"
+
+def build_google_books_url(path="", fields=None, use_key=True, **params):
+    """Формирует URL запроса к Google Books с проекцией полей fields."""
+    if fields:
+        params['fields'] = fields
+    if use_key and GOOGLE_BOOKS_API_KEY:
+        params['key'] = GOOGLE_BOOKS_API_KEY
+    url = f"https://www.googleapis.com/books/v1/volumes{path}"
+    return f"{url}?{urlencode(params)}" if params else url
+
+def build_google_books_search_url(query, use_key=True):
+    return build_google_books_url(
+        fields=GOOGLE_BOOKS_SEARCH_FIELDS, use_key=use_key,
+        q=query, maxResults=40, langRestrict='ru', country='RU'
+    )
+
+def intern_text(value):
+    return sys.intern(value) if value else value
+
+class ItemRecord:
+    """
+    Компактная запись элемента (фильм, трек, книга) для карточки.
+    Поля общие для всех провайдеров; повторяющиеся строки (жанры, годы) интернируются.
+    
+    Фильм: subtitle - оригинальное название, description - описание, image_url - постер.
+    Трек: title - название трека, creator - исполнители, subtitle - альбом, link - Spotify.
+    Книга: creator - авторы, year - год издания, genres - категории, link - предпросмотр.
+    """
+    
+    __slots__ = (
+        'category', 'id', 'title', 'subtitle', 'creator', 'year', 'rating',
+        'genres', 'description', 'image_url', 'link', 'preview_url',
+    )
+    
+    def __init__(self, category, id, title, subtitle=None, creator=None, year=None, rating=None,
+                 genres=None, description=None, image_url=None, link=None, preview_url=None):
+        self.category = intern_text(category)
+        self.id = str(id)
+        self.title = title
+        self.subtitle = subtitle
+        self.creator = creator
+        self.year = intern_text(year)
+        self.rating = rating
+        self.genres = intern_text(genres)
+        self.description = description
+        self.image_url = image_url
+        self.link = link
+        self.preview_url = preview_url
+    
+    def as_row(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+    
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+    
+    def __eq__(self, other):
+        return isinstance(other, ItemRecord) and self.as_row() == other.as_row()
+    
+    __hash__ = None
+
+class ItemCatalog:
+    """
+    Общий каталог элементов: пользователи хранят только ID, а запись одна на всех.
+    В памяти держится ограниченное число последних элементов, остальные
+    подгружаются из таблицы items.
+    """
+    
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+    
+    def is_current(self, record):
+        """True, если в каталоге уже лежит такая же запись."""
+        known = self.entries.get((record.category, record.id))
+        return known is not None and known == record
+    
+    def add(self, record):
+        """Добавляет запись; возвращает True, если элемент новый или изменился."""
+        key = (record.category, record.id)
+        if self.is_current(record):
+            self.entries.move_to_end(key)
+            return False
+        self.entries[key] = record
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+    
+    def peek(self, category, item_id):
+        return self.entries.get((category, str(item_id)))
+    
+    async def get(self, category, item_id):
+        if not item_id:
+            return None
+        record = self.peek(category, item_id)
+        if record is not None:
+            self.entries.move_to_end((category, record.id))
+            metrics.inc('bot_item_catalog_lookups_total', (('result', 'hit'),))
+            return record
+        metrics.inc('bot_item_catalog_lookups_total', (('result', 'miss'),))
+        row = await run_db(load_item_row, category, str(item_id))
+        if row is None:
+            return None
+        record = ItemRecord.from_row(tuple(row))
+        self.add(record)
+        return record
+
+item_catalog = ItemCatalog()
+
+class GenreCodes:
+    """
+    Короткие коды строк жанров для кнопок оценки. Коды хранятся в таблице
+    genre_codes, поэтому кнопку может обработать любой процесс бота.
+    """
+    
+    def __init__(self):
+        self.codes = {}
+        self.names = {}
+    
+    def remember(self, code, name):
+        name = intern_text(name)
+        self.codes[name] = code
+        self.names[code] = name
+    
+    def code_for(self, name):
+        return self.codes.get(name)
+    
+    async def name_for(self, code):
+        name = self.names.get(code)
+        if name is None:
+            name = await run_db(load_genre_name, code)
+            if name is not None:
+                self.remember(code, name)
+        return name
+
+genre_codes = GenreCodes()
+
+# Популярное у пользователей бота: показы и оценки за последние TRENDING_WINDOW_BUCKETS часов.
+# Счетчики обновляются по каждому событию (в БД - в той же транзакции, что и само событие),
+# поэтому для топа не нужен GROUP BY по истории и оценкам.
+TRENDING_BUCKET_SECONDS = 60 * 60
+TRENDING_WINDOW_BUCKETS = 7 * 24
+# Сколько лучших элементов и жанров держать отсортированными для каждой категории
+TRENDING_TOP_SIZE = 50
+# Вклад событий в очки популярности: показы выбирает сам бот, поэтому они весят меньше оценок
+TRENDING_WEIGHTS = (0.1, 1.0, -1.0)  # показ, 👍, 👎
+# Счетчики старше окна удаляются из БД с таким интервалом, секунды
+TRENDING_PRUNE_INTERVAL = 60 * 60
+
+def trending_bucket(timestamp=None):
+    return int((time.time() if timestamp is None else timestamp) // TRENDING_BUCKET_SECONDS)
+
+def trending_score(impressions, likes, dislikes):
+    return impressions * TRENDING_WEIGHTS[0] + likes * TRENDING_WEIGHTS[1] + dislikes * TRENDING_WEIGHTS[2]
+
+def split_genres(genres):
+    return [genre.strip() for genre in genres.split(',') if genre.strip()] if genres else []
+
+def rating_counts(rating):
+    """Оценка 4-5 считается 👍, 1-2 - 👎, 3 на популярность не влияет."""
+    if rating >= 4:
+        return {'likes': 1}
+    if rating <= 2:
+        return {'dislikes': 1}
+    return {}
+
+class TrendingAggregates:
+    """
+    Скользящие счетчики популярности элементов и жанров в памяти.
+    Счетчики разбиты по часовым интервалам: вышедший из окна интервал целиком
+    вычитается из сумм. Для каждой пары (вид, категория) поддерживается
+    отсортированный топ, поэтому чтение топа стоит O(k); полностью топ
+    пересчитывается, только если один из его элементов потерял очки.
+    """
+    
+    def __init__(self, window_buckets=TRENDING_WINDOW_BUCKETS, top_size=TRENDING_TOP_SIZE):
+        self.window_buckets = window_buckets
+        self.top_size = top_size
+        self.current_bucket = None
+        self.buckets = {}  # интервал -> {(вид, категория, ключ): [показы, 👍, 👎]}
+        self.scores = {}   # (вид, категория) -> {ключ: очки за окно}
+        self.tops = {}     # (вид, категория) -> [(-очки, ключ)] по убыванию очков
+        self.stale = set()
+    
+    def oldest_bucket(self, now_bucket=None):
+        return (trending_bucket() if now_bucket is None else now_bucket) - self.window_buckets + 1
+    
+    def load(self, rows):
+        """Загружает счетчики окна из таблицы trending_counts."""
+        for row in rows:
+            self.add(row['bucket'], row['kind'], row['category'], row['key'],
+                     row['impressions'], row['likes'], row['dislikes'])
+    
+    def record(self, category, item_id, genres, impressions=0, likes=0, dislikes=0):
+        """Учитывает событие для элемента и каждого его жанра (как bump_trending_counts)."""
+        bucket = trending_bucket()
+        self.add(bucket, 'item', category, str(item_id), impressions, likes, dislikes)
+        for genre in split_genres(genres):
+            self.add(bucket, 'genre', category, genre, impressions, likes, dislikes)
+    
+    def add(self, bucket, kind, category, key, impressions=0, likes=0, dislikes=0):
+        self.expire(trending_bucket())
+        if bucket < self.oldest_bucket(self.current_bucket):
+            return
+        counts = self.buckets.setdefault(bucket, {}).setdefault((kind, category, key), [0, 0, 0])
+        counts[0] += impressions
+        counts[1] += likes
+        counts[2] += dislikes
+        self.change(kind, category, key, trending_score(impressions, likes, dislikes))
+    
+    def expire(self, now_bucket):
+        if now_bucket == self.current_bucket:
+            return
+        self.current_bucket = now_bucket
+        limit = self.oldest_bucket(now_bucket)
+        for bucket in [bucket for bucket in self.buckets if bucket < limit]:
+            for (kind, category, key), counts in self.buckets.pop(bucket).items():
+                self.change(kind, category, key, -trending_score(*counts))
+    
+    def change(self, kind, category, key, delta):
+        if not delta:
+            return
+        group = (kind, category)
+        scores = self.scores.setdefault(group, {})
+        score = scores.get(key, 0.0) + delta
+        if abs(score) < 1e-9:
+            scores.pop(key, None)
+        else:
+            scores[key] = score
+        if group in self.stale:
+            return
+        
+        top = self.tops.setdefault(group, [])
+        position = next((i for i, (_, top_key) in enumerate(top) if top_key == key), None)
+        if delta < 0:
+            # Элемент топа потерял очки: его место мог занять элемент не из топа
+            if position is not None:
+                self.stale.add(group)
+            return
+        if position is not None:
+            del top[position]
+        elif len(top) >= self.top_size and -score >= top[-1][0]:
+            return
+        bisect.insort(top, (-score, key))
+        del top[self.top_size:]
+    
+    def top(self, kind, category, k):
+        """Ключи k самых популярных элементов или жанров категории с положительными очками."""
+        self.expire(trending_bucket())
+        group = (kind, category)
+        if group in self.stale:
+            scores = self.scores.get(group, {})
+            self.tops[group] = heapq.nsmallest(self.top_size, ((-score, key) for key, score in scores.items()))
+            self.stale.discard(group)
+        return [key for negative_score, key in self.tops.get(group, [])[:k] if negative_score < 0]
+    
+    def item_score(self, category, item_id):
+        self.expire(trending_bucket())
+        return self.scores.get(('item', category), {}).get(str(item_id), 0.0)
+
+trending = TrendingAggregates()
+
+def pick_candidate(category, candidates, get_id=lambda candidate: candidate['id']):
+    """
+    Случайный кандидат для рекомендации; популярные у пользователей бота элементы
+    выбираются чаще. Вес растет логарифмически (1 + ln(1 + очки)), чтобы подборка
+    не сводилась к нескольким лидерам.
+    """
+    weights = [1 + math.log1p(max(0.0, trending.item_score(category, get_id(candidate))))
+               for candidate in candidates]
+    return random.choices(candidates, weights)[0]
+
+async def remember_recommendation(user_id, record):
+    """
+    Добавляет элемент в каталог и, если указан пользователь, записывает историю
+    и показ в счетчики популярности. Жанру элемента при этом назначается код для кнопок оценки.
+    """
+    # В каталог запись попадает только после записи в БД: иначе при сбое записи
+    # элемент считался бы сохраненным и больше не попал бы в таблицу items
+    is_new = not item_catalog.is_current(record)
+    needs_genre_code = bool(record.genres) and genre_codes.code_for(record.genres) is None
+    if user_id or needs_genre_code:
+        code = await run_db(record_recommendation, user_id, record, is_new, needs_genre_code)
+        if code is not None:
+            genre_codes.remember(code, record.genres)
+        if user_id:
+            trending.record(record.category, record.id, record.genres, impressions=1)
+    item_catalog.add(record)
+
+def normalize_tmdb_movie(movie_data, genres):
+    """Приводит фильм TMDB (из списка или подробностей) к записи для карточки."""
+    poster_path = movie_data.get('poster_path')
+    return ItemRecord(
+        'movie', movie_data['id'],
+        title=movie_data.get('title', 'Название неизвестно'),
+        subtitle=movie_data.get('original_title', ''),
+        year=movie_data.get('release_date', '')[:4] if movie_data.get('release_date') else 'Год неизвестен',
+        rating=movie_data.get('vote_average', 0),
+        genres=genres,
+        description=movie_data.get('overview', 'Описание отсутствует'),
+        image_url=f"https://image.tmdb.org/t/p/w500{poster_path}" if poster_path else None
+    )
+
+def normalize_spotify_track(track_data):
+    """Приводит трек Spotify к записи для карточки."""
+    album = track_data.get('album', {})
+    album_images = album.get('images', [])
+    return ItemRecord(
+        'music', track_data.get('id', generate_random_id()),
+        title=track_data.get('name', 'Название неизвестно'),
+        creator=', '.join([artist.get('name', 'Неизвестный артист') for artist in track_data.get('artists', [])]),
+        subtitle=album.get('name', 'Альбом неизвестен'),
+        preview_url=track_data.get('preview_url'),
+        image_url=album_images[0].get('url') if album_images else None,
+        link=track_data.get('external_urls', {}).get('spotify')
+    )
+
+def normalize_google_book(volume):
+    """Приводит том Google Books к записи для карточки."""
+    volume_info = volume.get('volumeInfo', {})
+    published_date = volume_info.get('publishedDate', 'Дата неизвестна')
+    if published_date and len(published_date) >= 4:
+        published_date = published_date[:4]  # Берем только год
+    description = volume_info.get('description', 'Описание отсутствует')
+    if description and len(description) > 300:
+        description = description[:300] + '...'  # Обрезаем описание
+    return ItemRecord(
+        'book', volume['id'],
+        title=volume_info.get('title', 'Название неизвестно'),
+        creator=', '.join(volume_info.get('authors', ['Автор неизвестен'])),
+        year=published_date,
+        description=description,
+        genres=', '.join(volume_info.get('categories', ['Категория неизвестна'])),
+        image_url=volume_info.get('imageLinks', {}).get('thumbnail'),
+        link=volume_info.get('previewLink')
+    )
+
+# Функции для получения рекомендаций от API
+
+# Кэш названий жанров TMDB на русском: genre_id -> название.
+# Список жанров меняется редко, поэтому загружается один раз в сутки.
+TMDB_GENRE_CACHE_TTL = 24 * 60 * 60
+_tmdb_genre_names = {}
+_tmdb_genre_names_loaded_at = 0.0
+_tmdb_genre_names_lock = asyncio.Lock()
+
+async def get_tmdb_genre_names():
+    """Возвращает таблицу названий жанров TMDB, загружая ее при необходимости."""
+    global _tmdb_genre_names, _tmdb_genre_names_loaded_at
+    
+    async with _tmdb_genre_names_lock:
+        if _tmdb_genre_names and time.monotonic() - _tmdb_genre_names_loaded_at < TMDB_GENRE_CACHE_TTL:
+            return _tmdb_genre_names
+        
+        try:
+            url = build_tmdb_url("/genre/movie/list")
+            response = await api_get(url)
+            response.raise_for_status()
+            genres = response.json().get('genres', [])
+            _tmdb_genre_names = {genre['id']: genre['name'] for genre in genres}
+            _tmdb_genre_names_loaded_at = time.monotonic()
+        except Exception as e:
+            # Оставляем прежнюю таблицу: недостающие жанры будут взяты из подробностей фильма
+            logger.warning("Не удалось загрузить список жанров TMDB: %s", e)
+        
+        return _tmdb_genre_names
+
+def movie_list_url(genre_id=None):
+    """URL списка фильмов: по жанру или популярные, если жанр не указан."""
+    if genre_id:
+        return build_tmdb_url("/discover/movie", with_genres=genre_id, sort_by='popularity.desc', page=1)
+    return build_tmdb_url("/movie/popular", page=1)
+
+async def load_movie_list(genre_id=None):
+    return await cached_get_json(movie_list_url(genre_id), is_empty=lambda data: not data.get('results'))
+
+async def get_movie_recommendations(genre_id=None, user_id=None):
+    # Используем популярные фильмы, если жанр не указан.
+    # Ответ discover/popular с language=ru уже содержит все поля карточки.
+    try:
+        data = await load_movie_list(genre_id)
+        
+        if 'results' in data and data['results']:
+            # Исключаем фильмы, которые уже были рекомендованы пользователю
+            if user_id:
+                recommended_ids = await run_db(fetch_recommended_ids, user_id, 'movie')
+                
+                filtered_results = [movie for movie in data['results'] if str(movie['id']) not in recommended_ids]
+                if filtered_results:
+                    movie = pick_candidate('movie', filtered_results)
+                else:
+                    # Если все фильмы уже рекомендованы, берем любой
+                    movie = pick_candidate('movie', data['results'])
+            else:
+                movie = pick_candidate('movie', data['results'])
+            
+            movie_data = movie
+            genre_names = await get_tmdb_genre_names()
+            genre_ids = movie.get('genre_ids', [])
+            
+            if movie.get('title') and all(genre_id in genre_names for genre_id in genre_ids):
+                genres = ', '.join([genre_names[genre_id] for genre_id in genre_ids])
+            else:
+                # Получаем дополнительную информацию о фильме, только если
+                # в ответе поиска не хватает полей для карточки
+                movie_url = build_tmdb_url(f"/movie/{movie['id']}")
+                movie_response = await api_get(movie_url)
+                movie_response.raise_for_status()
+                movie_data = movie_response.json()
+                genres = ', '.join([genre['name'] for genre in movie_data.get('genres', [])])
+            
+            # Формируем информацию о фильме
+            result = normalize_tmdb_movie(movie_data, genres)
+            
+            # Сохраняем рекомендацию в историю только для собранной карточки,
+            # чтобы отмененный запрос не попадал в историю
+            await remember_recommendation(user_id, result)
+            
+            return result
+        
+        return await get_offline_recommendation('movie', genre_id, user_id)
     except Exception as e:
-        logger.error(f"Ошибка при получении рекомендаций фильмов: {e}")
-        return None
+        logger.error("Ошибка при получении рекомендаций фильмов: %s", e)
+        # TMDB недоступен: берем фильм из локального каталога, если он есть
+        return await get_offline_recommendation('movie', genre_id, user_id)
+
+# Проверяет, вызвана ли ошибка соединения проблемой с SSL-сертификатом
+def is_ssl_error(exc):
+    while exc is not None:
+        if isinstance(exc, ssl.SSLError):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+# Токен Spotify выдается на час; храним его, чтобы не запрашивать на каждую рекомендацию
+SPOTIFY_TOKEN_EXPIRY_MARGIN = 60
+_spotify_token = None
+_spotify_token_expires_at = 0.0
+
+def remember_spotify_token(data):
+    global _spotify_token, _spotify_token_expires_at
+    _spotify_token = data.get("access_token")
+    expires_in = data.get("expires_in", 3600)
+    _spotify_token_expires_at = time.monotonic() + max(expires_in - SPOTIFY_TOKEN_EXPIRY_MARGIN, 0)
+    return _spotify_token
+
+def invalidate_spotify_token():
+    global _spotify_token
+    _spotify_token = None
 
 async def get_spotify_token():
+    if _spotify_token and time.monotonic() < _spotify_token_expires_at:
+        return _spotify_token
+    
     url = "https://accounts.spotify.com/api/token"
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
@@ -268,86 +2440,240 @@ async def get_spotify_token():
     data = {"grant_type": "client_credentials"}
     
     try:
-        # Добавляем параметр verify=True и увеличиваем timeout
-        response = requests.post(url, headers=headers, data=data, auth=auth, 
-                               verify=True, timeout=30)
+        # Увеличиваем timeout для получения токена
+        provider = await acquire_quota(url)
+        with trace_span('provider', provider=provider, endpoint='/api/token'):
+            response = await get_http_client().post(url, headers=headers, data=data, auth=auth, timeout=30)
+        note_quota_response(provider, response)
         
         # Проверяем статус ответа
         if response.status_code == 200:
-            data = response.json()
-            return data.get("access_token")
+            return remember_spotify_token(response.json())
         else:
-            logger.error(f"Ошибка получения токена Spotify: HTTP {response.status_code} - {response.text}")
+            logger.error("Ошибка получения токена Spotify: HTTP %s - %s", response.status_code, response.text)
             return None
-    except requests.exceptions.SSLError as e:
-        logger.error(f"SSL ошибка при получении токена Spotify: {e}")
+    except httpx.ConnectError as e:
+        if not is_ssl_error(e):
+            logger.error("Ошибка при получении токена Spotify: %s", e)
+            return None
+        logger.error("SSL ошибка при получении токена Spotify: %s", e)
         # Альтернативный вариант (использовать только в случае крайней необходимости)
         try:
             # Попытка с отключенной проверкой SSL сертификата (только для отладки)
             logger.warning("Пробуем получить токен с отключенной проверкой SSL (не рекомендуется для продакшена)")
-            response = requests.post(url, headers=headers, data=data, auth=auth, 
-                                   verify=False, timeout=30)
+            async with httpx.AsyncClient(verify=False, timeout=30) as insecure_client:
+                response = await insecure_client.post(url, headers=headers, data=data, auth=auth)
             if response.status_code == 200:
-                data = response.json()
-                return data.get("access_token")
+                return remember_spotify_token(response.json())
             else:
-                logger.error(f"Ошибка получения токена Spotify: HTTP {response.status_code} - {response.text}")
+                logger.error("Ошибка получения токена Spotify: HTTP %s - %s", response.status_code, response.text)
                 return None
         except Exception as alt_e:
-            logger.error(f"Не удалось получить токен даже с отключенной проверкой SSL: {alt_e}")
+            logger.error("Не удалось получить токен даже с отключенной проверкой SSL: %s", alt_e)
             return None
     except Exception as e:
-        logger.error(f"Ошибка при получении токена Spotify: {e}")
+        logger.error("Ошибка при получении токена Spotify: %s", e)
         return None
 
+# Проверяет, что API отклонил запрос из-за недействительного токена
+def is_unauthorized(exc):
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 401
+
+# Объекты треков из поиска и плейлистов уже полные; проверяем, хватает ли их для карточки
+def has_track_card_fields(track):
+    album = track.get('album') or {}
+    return bool(track.get('name') and track.get('artists') and album.get('name')
+                and 'images' in album and 'external_urls' in track)
+
+# Пакетное получение метаданных Spotify
+
+class SpotifyHydrator:
+    """
+    Собирает запрошенные ID треков и альбомов Spotify в течение короткого окна
+    и получает их одним запросом к /v1/tracks?ids= (до 50 ID) или
+    /v1/albums?ids= (до 20 ID). Полученные объекты кэшируются.
+    """
+    
+    BATCH_LIMITS = {'tracks': 50, 'albums': 20}
+    
+    def __init__(self, window=0.02, cache_size=5000, cache_ttl=6 * 60 * 60):
+        self.window = window
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = {kind: OrderedDict() for kind in self.BATCH_LIMITS}
+        self._pending = {kind: {} for kind in self.BATCH_LIMITS}
+        self._flush_scheduled = {kind: False for kind in self.BATCH_LIMITS}
+        self._tasks = set()
+    
+    async def get_tracks(self, track_ids):
+        """Возвращает словарь track_id -> объект трека для найденных треков."""
+        return await self._resolve('tracks', track_ids)
+    
+    async def get_albums(self, album_ids):
+        """Возвращает словарь album_id -> объект альбома (вместе со списком треков)."""
+        return await self._resolve('albums', album_ids)
+    
+    def _cached(self, kind, item_id):
+        entry = self._cache[kind].get(item_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at < time.monotonic():
+            del self._cache[kind][item_id]
+            return None
+        self._cache[kind].move_to_end(item_id)
+        return data
+    
+    def _remember(self, kind, item_id, data):
+        cache = self._cache[kind]
+        cache[item_id] = (time.monotonic() + self.cache_ttl, data)
+        cache.move_to_end(item_id)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+    
+    async def _resolve(self, kind, item_ids):
+        loop = asyncio.get_running_loop()
+        result = {}
+        waiting = {}
+        
+        for item_id in dict.fromkeys(item_ids):
+            data = self._cached(kind, item_id)
+            if data is not None:
+                result[item_id] = data
+                continue
+            future = self._pending[kind].get(item_id)
+            if future is None:
+                future = loop.create_future()
+                self._pending[kind][item_id] = future
+            waiting[item_id] = future
+        
+        if waiting:
+            self._schedule_flush(kind)
+            for item_id, future in waiting.items():
+                # shield: отмена одного ожидающего не должна отменять общий пакет
+                data = await asyncio.shield(future)
+                if data is not None:
+                    result[item_id] = data
+        
+        return result
+    
+    def _schedule_flush(self, kind):
+        loop = asyncio.get_running_loop()
+        if len(self._pending[kind]) >= self.BATCH_LIMITS[kind]:
+            # Полный пакет отправляем сразу, не дожидаясь окна
+            self._start_flush(kind)
+        elif not self._flush_scheduled[kind]:
+            self._flush_scheduled[kind] = True
+            loop.call_later(self.window, self._start_flush, kind)
+    
+    def _start_flush(self, kind):
+        task = asyncio.get_running_loop().create_task(self._flush(kind))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _flush(self, kind):
+        self._flush_scheduled[kind] = False
+        pending = self._pending[kind]
+        
+        while pending:
+            batch = dict(itertools.islice(pending.items(), self.BATCH_LIMITS[kind]))
+            for item_id in batch:
+                del pending[item_id]
+            
+            items = {}
+            try:
+                items = await self._fetch_batch(kind, list(batch))
+            finally:
+                for item_id, future in batch.items():
+                    data = items.get(item_id)
+                    if data is not None:
+                        self._remember(kind, item_id, data)
+                    if not future.done():
+                        future.set_result(data)
+    
+    async def _fetch_batch(self, kind, item_ids):
+        try:
+            token = await get_spotify_token()
+            if not token:
+                return {}
+            
+            url = f"https://api.spotify.com/v1/{kind}?ids={','.join(item_ids)}"
+            response = await api_get(url, headers={"Authorization": f"Bearer {token}"})
+            response.raise_for_status()
+            items = response.json().get(kind) or []
+            logger.info("Получено объектов Spotify (%s) одним запросом: %s", kind, len(items))
+            return {item['id']: item for item in items if item and 'id' in item}
+        except Exception as e:
+            logger.error("Ошибка пакетного запроса к Spotify API (%s): %s", kind, e)
+            if is_unauthorized(e):
+                invalidate_spotify_token()
+            return {}
+
+spotify_hydrator = SpotifyHydrator()
+
+async def spotify_get_json(url, is_empty=None):
+    """Запрос к Spotify через кэш; токен берется при каждом обращении, в том числе при фоновом обновлении."""
+    async def fetch():
+        token = await get_spotify_token()
+        if not token:
+            raise httpx.HTTPError("Не удалось получить токен Spotify")
+        response = await api_get(url, headers={"Authorization": f"Bearer {token}"})
+        response.raise_for_status()
+        return response.json()
+    
+    return await provider_cache.get(url, fetch, 'spotify', is_empty)
+
+def spotify_track_search_url(search_genre):
+    query = search_genre.replace(" ", "+")
+    return f"https://api.spotify.com/v1/search?q=genre:{query}&type=track&limit=50"
+
+async def load_spotify_genre_tracks(search_genre):
+    return await spotify_get_json(
+        spotify_track_search_url(search_genre),
+        is_empty=lambda data: not data.get('tracks', {}).get('items')
+    )
+
 async def get_music_recommendations(genre=None, user_id=None):
     token = await get_spotify_token()
     if not token:
         logger.warning("Не удалось получить токен Spotify, использую запасной вариант")
-        return await get_music_recommendations_fallback(genre, user_id)
-    
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
+        return await get_music_recommendations_fallback(genre, user_id)
     
     try:
         # Преобразуем жанр для лучшей совместимости с API
         search_genre = genre
         if genre and genre in SPOTIFY_GENRE_MAPPING:
             search_genre = SPOTIFY_GENRE_MAPPING[genre]
-            logger.info(f"Преобразован жанр '{genre}' в '{search_genre}' для поиска в Spotify")
+            logger.info("Преобразован жанр '%s' в '%s' для поиска в Spotify", genre, search_genre)
             
         # Если жанр указан, ищем плейлисты по жанру
         if search_genre:
             query = search_genre.replace(" ", "+")
             
             # Альтернативный подход - искать треки, а не плейлисты
-            search_url = f"https://api.spotify.com/v1/search?q=genre:{query}&type=track&limit=50"
-            logger.info(f"Поиск треков по URL: {search_url}")
+            logger.info("Поиск треков по URL: %s", spotify_track_search_url(search_genre))
             
             try:
-                response = requests.get(search_url, headers=headers, timeout=10)
-                response.raise_for_status()  # Проверяем статус ответа
-                data = response.json()
+                data = await load_spotify_genre_tracks(search_genre)
                 
                 if 'tracks' in data and 'items' in data['tracks'] and data['tracks']['items']:
                     tracks = data['tracks']['items']
-                    track = random.choice(tracks)
+                    track = pick_candidate('music', tracks, lambda track: track.get('id'))
                     
                     # Убеждаемся, что трек существует и имеет ID
                     if track and 'id' in track:
-                        logger.info(f"Найден трек по жанру: {track.get('name', 'unknown')}")
+                        logger.info("Найден трек по жанру: %s", track.get('name', 'unknown'))
                     else:
                         logger.warning("Получен трек, но без ID, использую запасной вариант")
                         return await get_music_recommendations_fallback(genre, user_id)
                 else:
-                    logger.warning(f"Не найдены треки по жанру '{search_genre}', ищу плейлисты...")
+                    logger.warning("Не найдены треки по жанру '%s', ищу плейлисты...", search_genre)
                     
                     # Если треки не найдены, попробуем искать плейлисты
                     search_url = f"https://api.spotify.com/v1/search?q={query}&type=playlist&limit=10"
-                    response = requests.get(search_url, headers=headers, timeout=10)
-                    response.raise_for_status()
-                    data = response.json()
+                    data = await spotify_get_json(
+                        search_url, is_empty=lambda data: not data.get('playlists', {}).get('items')
+                    )
                     
                     if 'playlists' in data and 'items' in data['playlists'] and data['playlists']['items']:
                         playlist = random.choice(data['playlists']['items'])
@@ -359,9 +2685,7 @@ async def get_music_recommendations(genre=None, user_id=None):
                         
                         # Получаем треки из плейлиста
                         tracks_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks?limit=20"
-                        tracks_response = requests.get(tracks_url, headers=headers, timeout=10)
-                        tracks_response.raise_for_status()
-                        tracks_data = tracks_response.json()
+                        tracks_data = await spotify_get_json(tracks_url, is_empty=lambda data: not data.get('items'))
                         
                         if 'items' in tracks_data and tracks_data['items']:
                             valid_tracks = [item for item in tracks_data['items'] 
@@ -370,7 +2694,7 @@ async def get_music_recommendations(genre=None, user_id=None):
                             if valid_tracks:
                                 track_item = random.choice(valid_tracks)
                                 track = track_item['track']
-                                logger.info(f"Найден трек через плейлист: {track.get('name', 'unknown')}")
+                                logger.info("Найден трек через плейлист: %s", track.get('name', 'unknown'))
                             else:
                                 logger.warning("Не найдены валидные треки в плейлисте, использую запасной вариант")
                                 return await get_music_recommendations_fallback(genre, user_id)
@@ -378,18 +2702,20 @@ async def get_music_recommendations(genre=None, user_id=None):
                             logger.warning("Не найдены треки в плейлисте, использую запасной вариант")
                             return await get_music_recommendations_fallback(genre, user_id)
                     else:
-                        logger.warning(f"Не найдены плейлисты по жанру '{search_genre}', использую запасной вариант")
+                        logger.warning("Не найдены плейлисты по жанру '%s', использую запасной вариант", search_genre)
                         return await get_music_recommendations_fallback(genre, user_id)
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Ошибка запроса к Spotify API: {e}")
+            except httpx.HTTPError as e:
+                logger.error("Ошибка запроса к Spotify API: %s", e)
+                if is_unauthorized(e):
+                    invalidate_spotify_token()
                 return await get_music_recommendations_fallback(genre, user_id)
         else:
             # Если жанр не указан, используем новые релизы
             try:
                 tracks_url = "https://api.spotify.com/v1/browse/new-releases?limit=20"
-                tracks_response = requests.get(tracks_url, headers=headers, timeout=10)
-                tracks_response.raise_for_status()
-                tracks_data = tracks_response.json()
+                tracks_data = await spotify_get_json(
+                    tracks_url, is_empty=lambda data: not data.get('albums', {}).get('items')
+                )
                 
                 if 'albums' in tracks_data and 'items' in tracks_data['albums'] and tracks_data['albums']['items']:
                     albums = [album for album in tracks_data['albums']['items'] if album and 'id' in album]
@@ -401,18 +2727,17 @@ async def get_music_recommendations(genre=None, user_id=None):
                     album = random.choice(albums)
                     album_id = album['id']
                     
-                    # Получаем треки из альбома
-                    album_tracks_url = f"https://api.spotify.com/v1/albums/{album_id}/tracks?limit=10"
-                    album_tracks_response = requests.get(album_tracks_url, headers=headers, timeout=10)
-                    album_tracks_response.raise_for_status()
-                    album_tracks_data = album_tracks_response.json()
+                    # Получаем альбом вместе с треками через пакетный запрос /v1/albums?ids=
+                    album = (await spotify_hydrator.get_albums([album_id])).get(album_id, album)
+                    album_tracks_data = album.get('tracks') or {}
                     
                     if 'items' in album_tracks_data and album_tracks_data['items']:
                         valid_tracks = [t for t in album_tracks_data['items'] if t and 'id' in t]
                         
                         if valid_tracks:
-                            track = random.choice(valid_tracks)
-                            logger.info(f"Найден трек из новых релизов: {track.get('name', 'unknown')}")
+                            # Треки альбома приходят без данных об альбоме: добавляем их сами
+                            track = dict(random.choice(valid_tracks), album=album)
+                            logger.info("Найден трек из новых релизов: %s", track.get('name', 'unknown'))
                         else:
                             logger.warning("Не найдены валидные треки в альбоме, использую запасной вариант")
                             return await get_music_recommendations_fallback(genre, user_id)
@@ -422,8 +2747,10 @@ async def get_music_recommendations(genre=None, user_id=None):
                 else:
                     logger.warning("Не найдены новые релизы, использую запасной вариант")
                     return await get_music_recommendations_fallback(genre, user_id)
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Ошибка запроса к Spotify API для новых релизов: {e}")
+            except httpx.HTTPError as e:
+                logger.error("Ошибка запроса к Spotify API для новых релизов: %s", e)
+                if is_unauthorized(e):
+                    invalidate_spotify_token()
                 return await get_music_recommendations_fallback(genre, user_id)
         
         # Проверка наличия track_id
@@ -431,20 +2758,14 @@ async def get_music_recommendations(genre=None, user_id=None):
             logger.warning("Отсутствует ID трека, использую запасной вариант")
             return await get_music_recommendations_fallback(genre, user_id)
         
-        # Сохраняем рекомендацию в историю
         track_id = track['id']
-        if user_id:
-            try:
-                save_recommendation_history(user_id, 'music', track_id)
-            except Exception as e:
-                logger.error(f"Ошибка при сохранении истории рекомендаций: {e}")
         
-        # Получаем дополнительную информацию о треке
         try:
-            track_url = f"https://api.spotify.com/v1/tracks/{track_id}"
-            track_response = requests.get(track_url, headers=headers, timeout=10)
-            track_response.raise_for_status()
-            track_data = track_response.json()
+            track_data = track
+            if not has_track_card_fields(track_data):
+                # Получаем дополнительную информацию о треке, только если
+                # в ответе поиска не хватает полей для карточки
+                track_data = (await spotify_hydrator.get_tracks([track_id])).get(track_id)
             
             # Проверяем наличие всех необходимых полей
             if not track_data:
@@ -452,119 +2773,149 @@ async def get_music_recommendations(genre=None, user_id=None):
                 return await get_music_recommendations_fallback(genre, user_id)
                 
             # Формируем информацию о треке с проверкой наличия полей
-            track_name = track_data.get('name', 'Название неизвестно')
-            artists = ', '.join([artist.get('name', 'Неизвестный артист') for artist in track_data.get('artists', [])])
-            
-            album = track_data.get('album', {})
-            album_name = album.get('name', 'Альбом неизвестен')
-            
-            preview_url = track_data.get('preview_url')
+            result = normalize_spotify_track(track_data)
             
-            album_images = album.get('images', [])
-            album_image = album_images[0].get('url') if album_images and len(album_images) > 0 else None
-            
-            spotify_url = track_data.get('external_urls', {}).get('spotify')
-            
-            # Создаем результат с проверкой на None для каждого поля
-            result = {
-                'id': track_data.get('id', generate_random_id()),
-                'track_name': track_name,
-                'artists': artists,
-                'album_name': album_name,
-                'preview_url': preview_url,
-                'album_image': album_image,
-                'spotify_url': spotify_url
-            }
+            # Сохраняем рекомендацию в историю
+            try:
+                await remember_recommendation(user_id, result)
+            except Exception as e:
+                logger.error("Ошибка при сохранении истории рекомендаций: %s", e)
             
-            logger.info(f"Успешно сформированы данные о треке: {track_name} - {artists}")
+            logger.info("Успешно сформированы данные о треке: %s - %s", result.title, result.creator)
             return result
             
         except Exception as e:
-            logger.error(f"Ошибка при получении информации о треке: {e}")
+            logger.error("Ошибка при получении информации о треке: %s", e)
+            if is_unauthorized(e):
+                invalidate_spotify_token()
             return await get_music_recommendations_fallback(genre, user_id)
             
     except Exception as e:
-        logger.error(f"Общая ошибка при получении рекомендаций музыки: {e}")
+        logger.error("Общая ошибка при получении рекомендаций музыки: %s", e)
         return await get_music_recommendations_fallback(genre, user_id)
 
 # Запасной вариант рекомендаций
+
+# Названия жанров в items для жанров меню: у провайдеров и в импортированных каталогах
+# жанры записаны по-разному. LIKE в SQLite не различает регистр только для латиницы,
+# поэтому русские названия ищутся и со строчной, и с заглавной буквы.
+OFFLINE_GENRE_TERMS = {
+    'movie': {
+        '28': ('боевик', 'action'), '35': ('комедия', 'comedy'), '18': ('драма', 'drama'),
+        '878': ('фантастика', 'science fiction'), '27': ('ужасы', 'horror'),
+        '10749': ('мелодрама', 'романтика', 'romance'),
+    },
+    'music': {
+        'pop': ('поп', 'pop'), 'rock': ('рок', 'rock'), 'hip-hop': ('хип-хоп', 'hip-hop', 'hip hop', 'rap'),
+        'electronic': ('электрон', 'electronic'), 'jazz': ('джаз', 'jazz'), 'classical': ('классическ', 'classical'),
+    },
+    'book': {
+        'fiction': ('художественная', 'fiction'), 'fantasy': ('фэнтези', 'fantasy'), 'science': ('наука', 'science'),
+        'history': ('история', 'history'), 'biography': ('биография', 'biography'), 'poetry': ('поэзия', 'poetry'),
+    },
+}
+
+def offline_genre_terms(category, genre):
+    if not genre:
+        return ()
+    terms = OFFLINE_GENRE_TERMS[category].get(str(genre), (str(genre),))
+    return tuple(sorted({variant for term in terms for variant in (term, term.capitalize())}))
+
+async def get_offline_recommendation(category, genre=None, user_id=None):
+    """
+    Рекомендация из локального каталога (импортированного через import_catalog.py или
+    накопленного от провайдеров), когда провайдер недоступен или исчерпана квота.
+    Возвращает None, если подходящих элементов нет.
+    """
+    try:
+        rows = await run_db(load_offline_item_rows, category, offline_genre_terms(category, genre), user_id)
+        if not rows:
+            return None
+        record = ItemRecord.from_row(tuple(pick_candidate(category, rows, lambda row: row['item_id'])))
+        await remember_recommendation(user_id, record)
+    except sqlite3.Error as e:
+        logger.error("Ошибка при выборе рекомендации (%s) из локального каталога: %s", category, e)
+        return None
+    logger.info("Рекомендация (%s) из локального каталога: %s", category, record.id)
+    metrics.inc('bot_fallbacks_total', (('category', category), ('source', 'offline')))
+    return record
+
+# Фиктивные треки для запасного варианта, по одному на жанр
+FALLBACK_MUSIC = {
+    "pop": ItemRecord(
+        'music', "fallback_music_pop",
+        title="Популярный хит",
+        creator="Известный исполнитель",
+        subtitle="Хитовый альбом 2025",
+        image_url="https://via.placeholder.com/300",
+        link="https://open.spotify.com"
+    ),
+    "rock": ItemRecord(
+        'music', "fallback_music_rock",
+        title="Рок-классика",
+        creator="Рок-группа",
+        subtitle="Великие хиты рока",
+        image_url="https://via.placeholder.com/300",
+        link="https://open.spotify.com"
+    ),
+    "hip-hop": ItemRecord(
+        'music',
+        "fallback_music_hip-hop",
+        title="Хип-хоп трек",
+        creator="MC Артист",
+        subtitle="Городские ритмы",
+        image_url="https://via.placeholder.com/300",
+        link="https://open.spotify.com"
+    ),
+    "electronic": ItemRecord(
+        'music', "fallback_music_electronic",
+        title="Электронный бит",
+        creator="DJ Продюсер",
+        subtitle="Электронные вибрации",
+        image_url="https://via.placeholder.com/300",
+        link="https://open.spotify.com"
+    ),
+    "jazz": ItemRecord(
+        'music', "fallback_music_jazz",
+        title="Джазовая импровизация",
+        creator="Джаз квартет",
+        subtitle="Вечера джаза",
+        image_url="https://via.placeholder.com/300",
+        link="https://open.spotify.com"
+    ),
+    "classical": ItemRecord(
+        'music', "fallback_music_classical",
+        title="Классическая симфония",
+        creator="Выдающийся композитор",
+        subtitle="Классические произведения",
+        image_url="https://via.placeholder.com/300",
+        link="https://open.spotify.com"
+    ),
+}
+
 async def get_music_recommendations_fallback(genre=None, user_id=None):
     """
-    Запасной вариант, когда API Spotify недоступен.
-    Возвращает фиктивные данные для демонстрации работы бота.
-    """
-    # Генерируем случайный ID
-    random_id = generate_random_id()
-    
-    # Выбираем фиктивную рекомендацию на основе жанра
-    fallback_recommendations = {
-        "pop": {
-            "id": random_id,
-            "track_name": "Популярный хит",
-            "artists": "Известный исполнитель",
-            "album_name": "Хитовый альбом 2025",
-            "preview_url": None,
-            "album_image": "https://via.placeholder.com/300",
-            "spotify_url": "https://open.spotify.com"
-        },
-        "rock": {
-            "id": random_id,
-            "track_name": "Рок-классика",
-            "artists": "Рок-группа",
-            "album_name": "Великие хиты рока",
-            "preview_url": None,
-            "album_image": "https://via.placeholder.com/300",
-            "spotify_url": "https://open.spotify.com" 
-        },
-        "hip-hop": {
-            "id": random_id,
-            "track_name": "Хип-хоп трек",
-            "artists": "MC Артист",
-            "album_name": "Городские ритмы",
-            "preview_url": None,
-            "album_image": "https://via.placeholder.com/300",
-            "spotify_url": "https://open.spotify.com"
-        },
-        "electronic": {
-            "id": random_id,
-            "track_name": "Электронный бит",
-            "artists": "DJ Продюсер",
-            "album_name": "Электронные вибрации",
-            "preview_url": None,
-            "album_image": "https://via.placeholder.com/300",
-            "spotify_url": "https://open.spotify.com"
-        },
-        "jazz": {
-            "id": random_id,
-            "track_name": "Джазовая импровизация",
-            "artists": "Джаз квартет",
-            "album_name": "Вечера джаза",
-            "preview_url": None,
-            "album_image": "https://via.placeholder.com/300",
-            "spotify_url": "https://open.spotify.com"
-        },
-        "classical": {
-            "id": random_id,
-            "track_name": "Классическая симфония",
-            "artists": "Выдающийся композитор",
-            "album_name": "Классические произведения",
-            "preview_url": None,
-            "album_image": "https://via.placeholder.com/300",
-            "spotify_url": "https://open.spotify.com"
-        }
-    }
-    
-    # Сохраняем рекомендацию в историю
-    if user_id:
-        save_recommendation_history(user_id, 'music', random_id)
+    Запасной вариант, когда API Spotify недоступен: трек из локального каталога,
+    а если его нет - фиктивные данные для демонстрации работы бота.
+    """
+    record = await get_offline_recommendation('music', genre, user_id)
+    if record:
+        return record
     
-    # Если жанр указан и он есть в нашем списке, возвращаем соответствующую рекомендацию
-    if genre and genre in fallback_recommendations:
-        return fallback_recommendations[genre]
+    # Выбираем фиктивную рекомендацию на основе жанра, иначе случайную
+    if genre and genre in FALLBACK_MUSIC:
+        record = FALLBACK_MUSIC[genre]
     else:
-        # Иначе возвращаем случайную рекомендацию
-        random_genre = random.choice(list(fallback_recommendations.keys()))
-        return fallback_recommendations[random_genre]
+        record = random.choice(list(FALLBACK_MUSIC.values()))
+    metrics.inc('bot_fallbacks_total', (('category', 'music'), ('source', 'demo')))
+    
+    # Демо-данные не записываются в историю пользователя, только в каталог
+    try:
+        await remember_recommendation(None, record)
+    except Exception as e:
+        logger.error("Ошибка при сохранении демо-трека в каталог: %s", e)
+    
+    return record
 
 # Словарь соответствия жанров на русском языке
 BOOK_GENRE_RUSSIAN = {
@@ -576,92 +2927,131 @@ BOOK_GENRE_RUSSIAN = {
     "poetry": "поэзия"
 }
 
+def book_genre_query(genre):
+    """Поисковый запрос Google Books для жанра с русским эквивалентом."""
+    ru_query = BOOK_GENRE_RUSSIAN.get(genre, genre)
+    return f"subject:{genre} OR {ru_query}"
+
+# Фиктивные книги для запасного варианта, по одной на жанр
+FALLBACK_BOOKS = {
+    "fiction": ItemRecord(
+        'book', "fallback_book_fiction",
+        title="Великий роман",
+        creator="Известный Писатель",
+        year="2023",
+        description="Увлекательная история о приключениях и испытаниях героя в загадочном мире.",
+        genres="Художественная литература",
+        image_url="https://via.placeholder.com/300",
+        link="https://books.google.com"
+    ),
+    "fantasy": ItemRecord(
+        'book', "fallback_book_fantasy",
+        title="Хроники магического мира",
+        creator="Фантаст Волшебников",
+        year="2024",
+        description="Эпическая сага о магии, драконах и великих сражениях.",
+        genres="Фэнтези",
+        image_url="https://via.placeholder.com/300",
+        link="https://books.google.com"
+    ),
+    "science": ItemRecord(
+        'book', "fallback_book_science",
+        title="Наука будущего",
+        creator="Профессор Знаний",
+        year="2025",
+        description="Исследование последних научных достижений и их влияния на будущее человечества.",
+        genres="Наука, Технологии",
+        image_url="https://via.placeholder.com/300",
+        link="https://books.google.com"
+    ),
+    "history": ItemRecord(
+        'book', "fallback_book_history",
+        title="Забытые страницы истории",
+        creator="Историк Летописцев",
+        year="2024",
+        description="Исследование малоизвестных исторических событий, изменивших ход истории.",
+        genres="История",
+        image_url="https://via.placeholder.com/300",
+        link="https://books.google.com"
+    ),
+    "biography": ItemRecord(
+        'book', "fallback_book_biography",
+        title="Жизнь замечательных людей",
+        creator="Биограф Жизнеписец",
+        year="2023",
+        description="Биография выдающейся личности, преодолевшей все трудности на пути к успеху.",
+        genres="Биография",
+        image_url="https://via.placeholder.com/300",
+        link="https://books.google.com"
+    ),
+    "poetry": ItemRecord(
+        'book', "fallback_book_poetry",
+        title="Сборник стихов о вечном",
+        creator="Поэт Рифмоплётов",
+        year="2025",
+        description="Сборник проникновенных стихов о любви, жизни и поиске смысла.",
+        genres="Поэзия",
+        image_url="https://via.placeholder.com/300",
+        link="https://books.google.com"
+    ),
+}
+
 async def get_book_recommendations_fallback(genre=None, user_id=None):
     """
-    Запасной вариант, когда API Google Books недоступен.
-    Возвращает фиктивные данные для демонстрации работы бота.
-    """
-    # Генерируем случайный ID
-    random_id = generate_random_id()
-    
-    # Выбираем фиктивную рекомендацию на основе жанра
-    fallback_recommendations = {
-        "fiction": {
-            "id": random_id,
-            "title": "Великий роман",
-            "authors": "Известный Писатель",
-            "published_date": "2023",
-            "description": "Увлекательная история о приключениях и испытаниях героя в загадочном мире.",
-            "categories": "Художественная литература",
-            "image_url": "https://via.placeholder.com/300",
-            "preview_link": "https://books.google.com"
-        },
-        "fantasy": {
-            "id": random_id,
-            "title": "Хроники магического мира",
-            "authors": "Фантаст Волшебников",
-            "published_date": "2024",
-            "description": "Эпическая сага о магии, драконах и великих сражениях.",
-            "categories": "Фэнтези",
-            "image_url": "https://via.placeholder.com/300",
-            "preview_link": "https://books.google.com"
-        },
-        "science": {
-            "id": random_id,
-            "title": "Наука будущего",
-            "authors": "Профессор Знаний",
-            "published_date": "2025",
-            "description": "Исследование последних научных достижений и их влияния на будущее человечества.",
-            "categories": "Наука, Технологии",
-            "image_url": "https://via.placeholder.com/300",
-            "preview_link": "https://books.google.com"
-        },
-        "history": {
-            "id": random_id,
-            "title": "Забытые страницы истории",
-            "authors": "Историк Летописцев",
-            "published_date": "2024",
-            "description": "Исследование малоизвестных исторических событий, изменивших ход истории.",
-            "categories": "История",
-            "image_url": "https://via.placeholder.com/300",
-            "preview_link": "https://books.google.com"
-        },
-        "biography": {
-            "id": random_id,
-            "title": "Жизнь замечательных людей",
-            "authors": "Биограф Жизнеписец",
-            "published_date": "2023",
-            "description": "Биография выдающейся личности, преодолевшей все трудности на пути к успеху.",
-            "categories": "Биография",
-            "image_url": "https://via.placeholder.com/300",
-            "preview_link": "https://books.google.com"
-        },
-        "poetry": {
-            "id": random_id,
-            "title": "Сборник стихов о вечном",
-            "authors": "Поэт Рифмоплётов",
-            "published_date": "2025",
-            "description": "Сборник проникновенных стихов о любви, жизни и поиске смысла.",
-            "categories": "Поэзия",
-            "image_url": "https://via.placeholder.com/300",
-            "preview_link": "https://books.google.com"
-        }
-    }
-    
-    # Сохраняем рекомендацию в историю
-    if user_id:
-        try:
-            save_recommendation_history(user_id, 'book', random_id)
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении рекомендации в историю: {e}")
+    Запасной вариант, когда API Google Books недоступен: книга из локального каталога,
+    а если ее нет - фиктивные данные для демонстрации работы бота.
+    """
+    record = await get_offline_recommendation('book', genre, user_id)
+    if record:
+        return record
     
-    # Если жанр указан и он есть в нашем списке, возвращаем соответствующую рекомендацию
-    if genre and genre in fallback_recommendations:
-        return fallback_recommendations[genre]
+    # Выбираем фиктивную рекомендацию на основе жанра, иначе случайную
+    if genre and genre in FALLBACK_BOOKS:
+        record = FALLBACK_BOOKS[genre]
     else:
-        # Иначе возвращаем случайную рекомендацию
-        random_genre = random.choice(list(fallback_recommendations.keys()))
-        return fallback_recommendations[random_genre]
+        record = random.choice(list(FALLBACK_BOOKS.values()))
+    metrics.inc('bot_fallbacks_total', (('category', 'book'), ('source', 'demo')))
+    
+    # Демо-данные не записываются в историю пользователя, только в каталог
+    try:
+        await remember_recommendation(None, record)
+    except Exception as e:
+        logger.error("Ошибка при сохранении демо-книги в каталог: %s", e)
+    
+    return record
+
+# Причины ошибок Google API, означающие исчерпание квоты
+GOOGLE_QUOTA_REASONS = {'dailyLimitExceeded', 'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'}
+
+def is_google_quota_error(response):
+    try:
+        errors = response.json().get('error', {}).get('errors', [])
+    except ValueError:
+        return False
+    return any(error.get('reason') in GOOGLE_QUOTA_REASONS for error in errors)
+
+async def fetch_google_books_search(query):
+    url = build_google_books_search_url(query)
+    response = await api_get(url)
+    
+    if response.status_code == 403 and is_google_quota_error(response):
+        # Исчерпанная квота не восстановится от повтора: не тратим запросы до сброса
+        quota_manager.mark_exhausted('google_books')
+    elif response.status_code == 403 and GOOGLE_BOOKS_API_KEY:
+        # Если ключ отклонен по другой причине, пробуем без него
+        logger.warning("Ошибка доступа с API ключом Google Books, пробуем без ключа")
+        url = build_google_books_search_url(query, use_key=False)
+        response = await api_get(url)
+    
+    response.raise_for_status()  # Проверяем статус ответа
+    logger.info("Статус ответа API: %s", response.status_code)
+    return response.json()
+
+async def load_google_books(query):
+    return await provider_cache.get(
+        build_google_books_search_url(query), lambda: fetch_google_books_search(query), 'google_books',
+        is_empty=lambda data: not data.get('items')
+    )
 
 async def get_book_recommendations(genre=None, user_id=None):
     """
@@ -671,49 +3061,29 @@ async def get_book_recommendations(genre=None, user_id=None):
         # Формируем запрос с учетом русского языка
         if genre:
             # Используем русский эквивалент жанра, если он есть
-            ru_query = BOOK_GENRE_RUSSIAN.get(genre, genre)
-            query = f"subject:{genre} OR {ru_query}"
-            logger.info(f"Поиск книг по запросу: {query}")
+            query = book_genre_query(genre)
+            logger.info("Поиск книг по запросу: %s", query)
         else:
             # Случайные категории для поиска книг на русском
             categories = ["роман", "фантастика", "детектив", "история", "биография", "поэзия"]
             random_category = random.choice(categories)
             query = f"subject:{random_category}"
-            logger.info(f"Поиск случайных книг по запросу: {query}")
+            logger.info("Поиск случайных книг по запросу: %s", query)
         
-        # Добавляем параметры для русского языка
-        url = f"https://www.googleapis.com/books/v1/volumes?q={query}&maxResults=40&langRestrict=ru&country=RU"
-        if GOOGLE_BOOKS_API_KEY:
-            url += f"&key={GOOGLE_BOOKS_API_KEY}"
+        # Добавляем параметры для русского языка и запрашиваем только нужные поля
+        url = build_google_books_search_url(query)
         
-        logger.info(f"URL запроса к Google Books API: {url}")
+        logger.info("URL запроса к Google Books API: %s", url)
         
         try:
-            response = requests.get(url, timeout=10)
-            
-            # Если получаем ошибку доступа с API ключом, пробуем без него
-            if response.status_code == 403 and GOOGLE_BOOKS_API_KEY:
-                logger.warning("Ошибка доступа с API ключом Google Books, пробуем без ключа")
-                url = url.replace(f"&key={GOOGLE_BOOKS_API_KEY}", "")
-                response = requests.get(url, timeout=10)
+            data = await load_google_books(query)
             
-            response.raise_for_status()  # Проверяем статус ответа
-            data = response.json()
-            
-            logger.info(f"Статус ответа API: {response.status_code}")
-            logger.info(f"Количество найденных книг: {len(data.get('items', []))}")
+            logger.info("Количество найденных книг: %s", len(data.get('items', [])))
             
             if 'items' in data and data['items']:
                 # Исключаем книги, которые уже были рекомендованы пользователю
                 if user_id:
-                    conn = get_db_connection()
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                    SELECT item_id FROM recommendation_history
-                    WHERE user_id = ? AND category = 'book'
-                    ''', (user_id,))
-                    recommended_ids = [row['item_id'] for row in cursor.fetchall()]
-                    conn.close()
+                    recommended_ids = await run_db(fetch_recommended_ids, user_id, 'book')
                     
                     # Фильтруем только книги на русском языке
                     filtered_results = []
@@ -726,8 +3096,8 @@ async def get_book_recommendations(genre=None, user_id=None):
                                 filtered_results.append(book)
                     
                     if filtered_results:
-                        book = random.choice(filtered_results)
-                        logger.info(f"Выбрана новая книга (не из истории): {book.get('id', 'unknown')}")
+                        book = pick_candidate('book', filtered_results)
+                        logger.info("Выбрана новая книга (не из истории): %s", book.get('id', 'unknown'))
                     else:
                         # Если все книги уже рекомендованы или нет русских книг, используем запасной вариант
                         logger.warning("Не найдено подходящих книг на русском, использую запасной вариант")
@@ -742,1653 +3112,1722 @@ async def get_book_recommendations(genre=None, user_id=None):
                             russian_books.append(book)
                     
                     if russian_books:
-                        book = random.choice(russian_books)
-                        logger.info(f"Выбрана случайная книга на русском: {book.get('id', 'unknown')}")
+                        book = pick_candidate('book', russian_books)
+                        logger.info("Выбрана случайная книга на русском: %s", book.get('id', 'unknown'))
                     else:
                         logger.warning("Не найдено книг на русском языке, использую запасной вариант")
                         return await get_book_recommendations_fallback(genre, user_id)
                 
-                # Сохраняем рекомендацию в историю
-                if user_id:
-                    try:
-                        save_recommendation_history(user_id, 'book', book['id'])
-                        logger.info(f"Рекомендация сохранена в историю для пользователя {user_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при сохранении рекомендации в историю: {e}")
-                
-                # Формируем информацию о книге
-                volume_info = book.get('volumeInfo', {})
-                title = volume_info.get('title', 'Название неизвестно')
-                authors = ', '.join(volume_info.get('authors', ['Автор неизвестен']))
-                published_date = volume_info.get('publishedDate', 'Дата неизвестна')
-                if published_date and len(published_date) >= 4:
-                    published_date = published_date[:4]  # Берем только год
-                description = volume_info.get('description', 'Описание отсутствует')
-                if description and len(description) > 300:
-                    description = description[:300] + '...'  # Обрезаем описание
-                categories = ', '.join(volume_info.get('categories', ['Категория неизвестна']))
-                image_url = volume_info.get('imageLinks', {}).get('thumbnail')
-                preview_link = volume_info.get('previewLink')
-                
-                # Собираем результат
-                result = {
-                    'id': book['id'],
-                    'title': title,
-                    'authors': authors,
-                    'published_date': published_date,
-                    'description': description,
-                    'categories': categories,
-                    'image_url': image_url,
-                    'preview_link': preview_link
-                }
-                
-                logger.info(f"Сформирован результат для книги: {title}")
-                return result
-            else:
-                logger.warning(f"API вернул пустой список книг или отсутствует ключ 'items'")
-                return await get_book_recommendations_fallback(genre, user_id)
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка запроса к Google Books API: {e}")
-            return await get_book_recommendations_fallback(genre, user_id)
-        
-    except Exception as e:
-        logger.error(f"Общая ошибка при получении рекомендаций книг: {e}")
-        return await get_book_recommendations_fallback(genre, user_id)
-
-# Функции-обработчики команд бота
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = update.effective_user
-    register_user(user.id, user.username, user.first_name, user.last_name)
-    
-    keyboard = [
-        [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-        [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-        [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-        [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        f"Привет, {user.first_name}! 👋\n\n"
-        "Я бот-рекомендатель фильмов, музыки и книг. Выбери категорию, и я предложу тебе что-нибудь интересное!",
-        reply_markup=reply_markup
-    )
-    
-    return START_ROUTES
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(
-        "🤖 *Справка по боту-рекомендателю* 🤖\n\n"
-        "*Доступные команды:*\n"
-        "/start - Начать взаимодействие с ботом\n"
-        "/help - Показать эту справку\n"
-        "/movies - Рекомендации фильмов\n"
-        "/music - Рекомендации музыки\n"
-        "/books - Рекомендации книг\n"
-        "/history - Показать историю рекомендаций\n\n"
-        "*Как пользоваться:*\n"
-        "1. Выберите интересующую категорию\n"
-        "2. Выберите жанр или получите случайную рекомендацию\n"
-        "3. Оцените рекомендацию для улучшения будущих предложений\n\n"
-        "Приятного использования! 😊",
-        parse_mode='Markdown'
-    )
-
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(
-        "Действие отменено. Чтобы начать заново, используйте команду /start"
-    )
-    return ConversationHandler.END
-
-async def handle_category_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    
-    callback_data = query.data
-    
-    if callback_data == "category_movies":
-        movie_genres = [
-            [
-                InlineKeyboardButton("Боевик", callback_data="movie_genre_28"),
-                InlineKeyboardButton("Комедия", callback_data="movie_genre_35")
-            ],
-            [
-                InlineKeyboardButton("Драма", callback_data="movie_genre_18"),
-                InlineKeyboardButton("Фантастика", callback_data="movie_genre_878")
-            ],
-            [
-                InlineKeyboardButton("Ужасы", callback_data="movie_genre_27"),
-                InlineKeyboardButton("Романтика", callback_data="movie_genre_10749")
-            ],
-            [
-                InlineKeyboardButton("Случайный фильм", callback_data="movie_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(movie_genres)
-        
-        await query.edit_message_text(
-            text="Выбери жанр фильма или получи случайную рекомендацию:",
-            reply_markup=reply_markup
-        )
-        return GENRE_SELECTION
-    
-    elif callback_data == "category_music":
-        music_genres = [
-            [
-                InlineKeyboardButton("Поп", callback_data="music_genre_pop"),
-                InlineKeyboardButton("Рок", callback_data="music_genre_rock")
-            ],
-            [
-                InlineKeyboardButton("Хип-хоп", callback_data="music_genre_hip-hop"),
-                InlineKeyboardButton("Электронная", callback_data="music_genre_electronic")
-            ],
-            [
-                InlineKeyboardButton("Джаз", callback_data="music_genre_jazz"),
-                InlineKeyboardButton("Классическая", callback_data="music_genre_classical")
-            ],
-            [
-                InlineKeyboardButton("Случайная музыка", callback_data="music_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(music_genres)
-        
-        await query.edit_message_text(
-            text="Выбери жанр музыки или получи случайную рекомендацию:",
-            reply_markup=reply_markup
-        )
-        return GENRE_SELECTION
-    
-    elif callback_data == "category_books":
-        book_genres = [
-            [
-                InlineKeyboardButton("Фантастика", callback_data="book_genre_fiction"),
-                InlineKeyboardButton("Фэнтези", callback_data="book_genre_fantasy")
-            ],
-            [
-                InlineKeyboardButton("Наука", callback_data="book_genre_science"),
-                InlineKeyboardButton("История", callback_data="book_genre_history")
-            ],
-            [
-                InlineKeyboardButton("Биография", callback_data="book_genre_biography"),
-                InlineKeyboardButton("Поэзия", callback_data="book_genre_poetry")
-            ],
-            [
-                InlineKeyboardButton("Случайная книга", callback_data="book_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(book_genres)
-        
-        await query.edit_message_text(
-            text="Выбери жанр книги или получи случайную рекомендацию:",
-            reply_markup=reply_markup
-        )
-        return GENRE_SELECTION
-    
-    elif callback_data == "help":
-        help_keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(help_keyboard)
-        
-        await query.edit_message_text(
-            text="🤖 *Справка по боту-рекомендателю* 🤖\n\n"
-            "*Доступные команды:*\n"
-            "/start - Начать взаимодействие с ботом\n"
-            "/help - Показать эту справку\n"
-            "/movies - Рекомендации фильмов\n"
-            "/music - Рекомендации музыки\n"
-            "/books - Рекомендации книг\n"
-            "/history - Показать историю рекомендаций\n\n"
-            "*Как пользоваться:*\n"
-            "1. Выберите интересующую категорию\n"
-            "2. Выберите жанр или получите случайную рекомендацию\n"
-            "3. Оцените рекомендацию для улучшения будущих предложений\n\n"
-            "Приятного использования! 😊",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-        return START_ROUTES
-    
-    elif callback_data == "back_to_main":
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-            reply_markup=reply_markup
-        )
-        return START_ROUTES
-    
-    elif callback_data == "start_over":
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-            reply_markup=reply_markup
-        )
-        return START_ROUTES
-    
-    return START_ROUTES
-
-async def handle_genre_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
-    
-    callback_data = query.data
-    user_id = update.effective_user.id
-    
-    if callback_data.startswith("movie_genre_"):
-        genre_id = callback_data.split("_")[-1]
-        
-        # Сообщаем пользователю о поиске
-        await query.edit_message_text(
-            text=f"🔍 Ищу фильм в жанре... Это может занять несколько секунд.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏱️ Отмена", callback_data="category_movies")]])
-        )
-        
-        try:
-            movie = await get_movie_recommendations(genre_id, user_id)
-            
-            if movie:
-                context.user_data['current_movie'] = movie
-                
-                # Подготовка сообщения о фильме
-                message_text = (
-                    f"🎬 *{movie['title']}*\n"
-                    f"({movie['original_title']}, {movie['year']})\n\n"
-                    f"⭐ Рейтинг: {movie['rating']}/10\n"
-                    f"🎭 Жанры: {movie['genres']}\n\n"
-                    f"📝 *Описание:*\n{movie['overview']}"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_movie_{movie['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_movie_{movie['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще фильм", callback_data="movie_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                if movie['poster_url']:
-                    await query.message.reply_photo(
-                        photo=movie['poster_url'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    await query.delete_message()
-                else:
-                    await query.edit_message_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return MOVIE_ACTIONS
-            else:
-                # Создаем клавиатуру с кнопкой "Назад"
-                keyboard = [
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text="К сожалению, не удалось получить рекомендации фильмов. Пожалуйста, попробуйте позже.",
-                    reply_markup=reply_markup
-                )
-                return GENRE_SELECTION
-        except Exception as e:
-            logger.error(f"Ошибка при получении рекомендации фильма: {e}")
-            # Создаем клавиатуру с кнопкой "Назад"
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=f"Произошла ошибка при поиске фильма. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
-                reply_markup=reply_markup
-            )
-            return GENRE_SELECTION
-    
-    elif callback_data == "movie_random":
-        # Сообщаем пользователю о поиске
-        await query.edit_message_text(
-            text=f"🔍 Ищу случайный фильм... Это может занять несколько секунд.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏱️ Отмена", callback_data="category_movies")]])
-        )
-        
-        try:
-            movie = await get_movie_recommendations(None, user_id)
-            
-            if movie:
-                context.user_data['current_movie'] = movie
-                
-                # Подготовка сообщения о фильме
-                message_text = (
-                    f"🎬 *{movie['title']}*\n"
-                    f"({movie['original_title']}, {movie['year']})\n\n"
-                    f"⭐ Рейтинг: {movie['rating']}/10\n"
-                    f"🎭 Жанры: {movie['genres']}\n\n"
-                    f"📝 *Описание:*\n{movie['overview']}"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_movie_{movie['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_movie_{movie['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще фильм", callback_data="movie_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                if movie['poster_url']:
-                    await query.message.reply_photo(
-                        photo=movie['poster_url'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    await query.delete_message()
-                else:
-                    await query.edit_message_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return MOVIE_ACTIONS
-            else:
-                # Создаем клавиатуру с кнопкой "Назад"
-                keyboard = [
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text="К сожалению, не удалось получить рекомендации фильмов. Пожалуйста, попробуйте позже.",
-                    reply_markup=reply_markup
-                )
-                return GENRE_SELECTION
-        except Exception as e:
-            logger.error(f"Ошибка при получении случайного фильма: {e}")
-            # Создаем клавиатуру с кнопкой "Назад"
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=f"Произошла ошибка при поиске фильма. Пожалуйста, попробуйте позже.",
-                reply_markup=reply_markup
-            )
-            return GENRE_SELECTION
-    
-    elif callback_data.startswith("music_genre_"):
-        genre = callback_data.split("_")[-1]
-        logger.info(f"Запрос рекомендации музыки жанра: {genre}, пользователь: {user_id}")
-        
-        # Сообщаем пользователю о поиске
-        await query.edit_message_text(
-            text=f"🔍 Ищу музыку в жанре {genre}... Это может занять несколько секунд.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏱️ Отмена", callback_data="category_music")]])
-        )
-        
-        try:
-            # Пробуем получить рекомендации
-            music = await get_music_recommendations(genre, user_id)
-            
-            if music:
-                context.user_data['current_music'] = music
-                
-                # Подготовка сообщения о музыке
-                message_text = (
-                    f"🎵 *{music['track_name']}*\n"
-                    f"👤 Исполнитель: {music['artists']}\n"
-                    f"💿 Альбом: {music['album_name']}\n\n"
-                )
-                
-                # Если в URL изображения есть "placeholder", предупреждаем о демо-режиме
-                if music['album_image'] and "placeholder" in music['album_image']:
-                    message_text += "_❗ Примечание: используются демо-данные из-за временной недоступности API._\n\n"
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_music_{music['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_music_{music['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще музыка", callback_data="music_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")]
-                ]
-                
-                # Добавляем кнопку для прослушивания, если есть ссылка
-                if music['spotify_url']:
-                    keyboard.insert(0, [InlineKeyboardButton("🎧 Слушать на Spotify", url=music['spotify_url'])])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                if music['album_image']:
-                    await query.message.reply_photo(
-                        photo=music['album_image'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    try:
-                        await query.message.delete()  # Удаляем сообщение о поиске
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить сообщение о поиске: {e}")
-                else:
-                    await query.edit_message_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return MUSIC_ACTIONS
-            else:
-                logger.warning(f"Не удалось получить рекомендации музыки для жанра: {genre}")
-                # Создаем клавиатуру с кнопкой "Назад"
-                keyboard = [
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text="К сожалению, не удалось получить рекомендации музыки. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
-                    reply_markup=reply_markup
-                )
-                return GENRE_SELECTION
-        except Exception as e:
-            logger.error(f"Ошибка при получении рекомендации музыки: {e}")
-            # Создаем клавиатуру с кнопкой "Назад"
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=f"Произошла ошибка при поиске музыки. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
-                reply_markup=reply_markup
-            )
-            return GENRE_SELECTION
-    
-    elif callback_data == "music_random":
-        # Сообщаем пользователю о поиске
-        await query.edit_message_text(
-            text=f"🔍 Ищу случайную музыку... Это может занять несколько секунд.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏱️ Отмена", callback_data="category_music")]])
-        )
-        
-        try:
-            # Выбираем случайный жанр
-            random_genre = random.choice(list(SPOTIFY_GENRE_MAPPING.keys()))
-            logger.info(f"Выбран случайный жанр для музыки: {random_genre}")
-            
-            # Получаем рекомендацию
-            music = await get_music_recommendations(random_genre, user_id)
-            
-            if music:
-                context.user_data['current_music'] = music
-                
-                # Подготовка сообщения о музыке
-                message_text = (
-                    f"🎵 *{music['track_name']}*\n"
-                    f"👤 Исполнитель: {music['artists']}\n"
-                    f"💿 Альбом: {music['album_name']}\n\n"
-                )
-                
-                # Если в URL изображения есть "placeholder", предупреждаем о демо-режиме
-                if music['album_image'] and "placeholder" in music['album_image']:
-                    message_text += "_❗ Примечание: используются демо-данные из-за временной недоступности API._\n\n"
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_music_{music['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_music_{music['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще музыка", callback_data="music_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")]
-                ]
-                
-                # Добавляем кнопку для прослушивания, если есть ссылка
-                if music['spotify_url']:
-                    keyboard.insert(0, [InlineKeyboardButton("🎧 Слушать на Spotify", url=music['spotify_url'])])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                if music['album_image']:
-                    await query.message.reply_photo(
-                        photo=music['album_image'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    try:
-                        await query.message.delete()  # Удаляем сообщение о поиске
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить сообщение о поиске: {e}")
-                else:
-                    await query.edit_message_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return MUSIC_ACTIONS
-            else:
-                logger.warning("Не удалось получить рекомендации случайной музыки")
-                # Создаем клавиатуру с кнопкой "Назад"
-                keyboard = [
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text="К сожалению, не удалось получить рекомендации музыки. Пожалуйста, попробуйте позже.",
-                    reply_markup=reply_markup
-                )
-                return GENRE_SELECTION
-        except Exception as e:
-            logger.error(f"Ошибка при получении случайной музыки: {e}")
-            # Создаем клавиатуру с кнопкой "Назад"
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=f"Произошла ошибка при поиске музыки. Пожалуйста, попробуйте позже.",
-                reply_markup=reply_markup
-            )
-            return GENRE_SELECTION
-    
-    elif callback_data.startswith("book_genre_"):
-        genre = callback_data.split("_")[-1]
-        logger.info(f"Запрос рекомендации книги жанра: {genre}, пользователь: {user_id}")
-        
-        # Сообщаем пользователю о поиске
-        await query.edit_message_text(
-            text=f"🔍 Ищу книгу в жанре {genre}... Это может занять несколько секунд.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏱️ Отмена", callback_data="category_books")]])
-        )
-        
-        try:
-            book = await get_book_recommendations(genre, user_id)
-            logger.info(f"Результат запроса книги: {'Успешно' if book else 'Не найдено'}")
-            
-            if book:
-                context.user_data['current_book'] = book
-                
-                # Подготовка сообщения о книге
-                message_text = (
-                    f"📚 *{book['title']}*\n"
-                    f"✍️ Автор: {book['authors']}\n"
-                    f"📅 Год: {book['published_date']}\n"
-                    f"🏷️ Категории: {book['categories']}\n\n"
-                    f"📝 *Описание:*\n{book['description']}"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_book_{book['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_book_{book['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще книга", callback_data="book_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")]
-                ]
-                
-                # Добавляем кнопку для предпросмотра, если есть ссылка
-                if book['preview_link']:
-                    keyboard.insert(0, [InlineKeyboardButton("👁️ Предпросмотр", url=book['preview_link'])])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                if book['image_url']:
-                    await query.message.reply_photo(
-                        photo=book['image_url'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    try:
-                        await query.message.delete()  # Удаляем сообщение о поиске
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить сообщение о поиске: {e}")
-                else:
-                    await query.edit_message_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return BOOK_ACTIONS
-            else:
-                logger.warning(f"Не удалось получить рекомендации книг для жанра: {genre}")
-                # Создаем клавиатуру с кнопкой "Назад"
-                keyboard = [
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text="К сожалению, не удалось получить рекомендации книг. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
-                    reply_markup=reply_markup
-                )
-                return GENRE_SELECTION
-        except Exception as e:
-            logger.error(f"Ошибка при получении рекомендации книги: {e}")
-            # Создаем клавиатуру с кнопкой "Назад"
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=f"Произошла ошибка при поиске книги. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
-                reply_markup=reply_markup
-            )
-            return GENRE_SELECTION
-    
-    elif callback_data == "book_random":
-        # Сообщаем пользователю о поиске
-        await query.edit_message_text(
-            text=f"🔍 Ищу случайную книгу... Это может занять несколько секунд.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⏱️ Отмена", callback_data="category_books")]])
-        )
-        
-        try:
-            book = await get_book_recommendations(None, user_id)
-            
-            if book:
-                context.user_data['current_book'] = book
-                
-                # Подготовка сообщения о книге
-                message_text = (
-                    f"📚 *{book['title']}*\n"
-                    f"✍️ Автор: {book['authors']}\n"
-                    f"📅 Год: {book['published_date']}\n"
-                    f"🏷️ Категории: {book['categories']}\n\n"
-                    f"📝 *Описание:*\n{book['description']}"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_book_{book['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_book_{book['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще книга", callback_data="book_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")]
-                ]
-                
-                # Добавляем кнопку для предпросмотра, если есть ссылка
-                if book['preview_link']:
-                    keyboard.insert(0, [InlineKeyboardButton("👁️ Предпросмотр", url=book['preview_link'])])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                # Формируем информацию о книге
+                result = normalize_google_book(book)
                 
-                if book['image_url']:
-                    await query.message.reply_photo(
-                        photo=book['image_url'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                    try:
-                        await query.message.delete()  # Удаляем сообщение о поиске
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить сообщение о поиске: {e}")
-                else:
-                    await query.edit_message_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
+                # Сохраняем рекомендацию в историю
+                try:
+                    await remember_recommendation(user_id, result)
+                    if user_id:
+                        logger.info("Рекомендация сохранена в историю для пользователя %s", user_id)
+                except Exception as e:
+                    logger.error("Ошибка при сохранении рекомендации в историю: %s", e)
                 
-                return BOOK_ACTIONS
+                logger.info("Сформирован результат для книги: %s", result.title)
+                return result
             else:
-                # Создаем клавиатуру с кнопкой "Назад"
-                keyboard = [
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    text="К сожалению, не удалось получить рекомендации книг. Пожалуйста, попробуйте позже.",
-                    reply_markup=reply_markup
-                )
-                return GENRE_SELECTION
-        except Exception as e:
-            logger.error(f"Ошибка при получении случайной книги: {e}")
-            # Создаем клавиатуру с кнопкой "Назад"
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(
-                text=f"Произошла ошибка при поиске книги. Пожалуйста, попробуйте позже.",
-                reply_markup=reply_markup
-            )
-            return GENRE_SELECTION
-    
-    elif callback_data == "back_to_main":
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+                logger.warning("API вернул пустой список книг или отсутствует ключ 'items'")
+                return await get_book_recommendations_fallback(genre, user_id)
+        except httpx.HTTPError as e:
+            logger.error("Ошибка запроса к Google Books API: %s", e)
+            return await get_book_recommendations_fallback(genre, user_id)
         
-        await query.edit_message_text(
-            text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-            reply_markup=reply_markup
-        )
-        return START_ROUTES
-    
-    return GENRE_SELECTION
+    except Exception as e:
+        logger.error("Общая ошибка при получении рекомендаций книг: %s", e)
+        return await get_book_recommendations_fallback(genre, user_id)
 
-async def handle_movie_actions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
+# Поиск по каталогу: сначала локальный FTS5-индекс, к провайдерам - только если
+# локально ничего не найдено. Найденное у провайдеров сохраняется в items, поэтому
+# следующие запросы (в том числе нажатия клавиш в inline-режиме) обслуживаются локально.
+SEARCH_RESULT_LIMIT = 10
+# Запросы короче этого не отправляются провайдерам: на первых буквах inline-запроса
+# ищем только в локальном индексе
+SEARCH_UPSTREAM_MIN_LENGTH = 3
+SEARCH_UPSTREAM_PER_PROVIDER = 5
+SEARCH_MAX_TERMS = 8
+SEARCH_TERM_PATTERN = re.compile(r"\w+")
+
+def build_search_match(text):
+    """
+    Строка MATCH для FTS5: все слова запроса обязательны, последнее (которое еще
+    набирается) ищется как префикс. Префиксы частых слов разворачиваются в длинные
+    списки документов, поэтому уже набранные слова ищутся точно.
+    Слова берутся в кавычки, поэтому синтаксис FTS5 во вводе пользователя не работает.
+    """
+    terms = SEARCH_TERM_PATTERN.findall(text.replace('ё', 'е').replace('Ё', 'Е'))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return ''
+    # Пробел в конце означает, что последнее слово набрано целиком
+    prefix = '' if text[-1:].isspace() else '*'
+    if prefix and len(terms[-1]) < 2:
+        # Префиксы из одного символа не индексируются (prefix='2 3') и совпадают почти
+        # со всем словарем: недонабранную букву пропускаем, а единственное слово
+        # или цифру («Елки 2») ищем точно
+        prefix = ''
+        if len(terms) > 1 and not terms[-1].isdigit():
+            terms.pop()
+    return ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"{prefix}'])
+
+async def search_local_items(text, category=None, limit=SEARCH_RESULT_LIMIT):
+    match = build_search_match(text)
+    if not match:
+        return []
+    try:
+        rows = await run_db(search_item_rows, match, category, limit)
+    except sqlite3.OperationalError as e:
+        logger.warning("Ошибка локального поиска: %s", e)
+        return []
+    records = []
+    for row in rows:
+        record = ItemRecord.from_row(tuple(row))
+        item_catalog.add(record)
+        records.append(record)
+    return records
+
+async def search_tmdb_movies(text):
+    data = await cached_get_json(
+        build_tmdb_url("/search/movie", query=text, page=1),
+        is_empty=lambda data: not data.get('results')
+    )
+    genre_names = await get_tmdb_genre_names()
+    return [
+        normalize_tmdb_movie(movie, ', '.join(
+            genre_names[genre_id] for genre_id in movie.get('genre_ids', []) if genre_id in genre_names
+        ))
+        for movie in data.get('results', [])[:SEARCH_UPSTREAM_PER_PROVIDER]
+    ]
+
+async def search_spotify_tracks(text):
+    url = "https://api.spotify.com/v1/search?" + urlencode(
+        {'q': text, 'type': 'track', 'limit': SEARCH_UPSTREAM_PER_PROVIDER}
+    )
+    data = await spotify_get_json(url, is_empty=lambda data: not data.get('tracks', {}).get('items'))
+    return [normalize_spotify_track(track) for track in data.get('tracks', {}).get('items', []) if track]
+
+async def search_google_books(text):
+    data = await load_google_books(text)
+    return [normalize_google_book(volume) for volume in data.get('items', [])[:SEARCH_UPSTREAM_PER_PROVIDER]]
+
+UPSTREAM_SEARCH = {
+    'movie': search_tmdb_movies,
+    'music': search_spotify_tracks,
+    'book': search_google_books,
+}
+
+async def search_upstream_items(text, category=None):
+    """Ищет у провайдеров параллельно и сохраняет найденное в каталог и индекс."""
+    categories = [category] if category else list(UPSTREAM_SEARCH)
+    results = await asyncio.gather(
+        *(UPSTREAM_SEARCH[name](text) for name in categories), return_exceptions=True
+    )
+    records = []
+    for name, result in zip(categories, results):
+        if isinstance(result, Exception):
+            logger.warning("Ошибка поиска (%s) у провайдера: %s", name, result)
+            continue
+        records.extend(result)
+
+    changed = [record for record in records if not item_catalog.is_current(record)]
+    if changed:
+        await run_db(upsert_items, changed)
+    for record in records:
+        item_catalog.add(record)
+    return records
+
+async def search_items(text, category=None, limit=SEARCH_RESULT_LIMIT, allow_upstream=True):
+    """Результаты поиска: локальные, а при промахе - от провайдеров (если разрешено)."""
+    records = await search_local_items(text, category, limit)
+    if records or not allow_upstream or len(text.strip()) < SEARCH_UPSTREAM_MIN_LENGTH:
+        return records
+    logger.info("Локальный поиск не дал результатов, запрос к провайдерам: %s", text)
+    return (await search_upstream_items(text, category))[:limit]
+
+# Кодирование callback_data кнопок.
+# Формат версии 1: "1:<действие>[:<поле>...]", например "1:g:m:28" - жанр фильма 28,
+# "1:r:b:5:3k:<ID книги>" - оценка книги 5 с кодом жанра 3k (base36),
+# "1:i:m:603" - открыть карточку фильма 603 (результат поиска).
+# ID элемента всегда последний, поэтому может содержать любые символы.
+# Кнопки старого формата ("rate_movie_123_5", "category_books") тоже разбираются.
+CALLBACK_VERSION = '1'
+CALLBACK_DATA_LIMIT = 64  # ограничение Telegram, байт
+CALLBACK_ACTION_CODES = {
+    'menu': 'h',
+    'help': 'q',
+    'category': 'c',
+    'genre': 'g',
+    'random': 'n',
+    'rate': 'r',
+    'item': 'i',
+    'trending': 't',
+}
+CALLBACK_ACTIONS = {code: action for action, code in CALLBACK_ACTION_CODES.items()}
+CATEGORY_CODES = {'movie': 'm', 'music': 's', 'book': 'b'}
+CATEGORY_BY_CODE = {code: category for category, code in CATEGORY_CODES.items()}
+LEGACY_CATEGORY_NAMES = {'movies': 'movie', 'music': 'music', 'books': 'book'}
+
+class CallbackData:
+    """Разобранные данные кнопки."""
     
-    callback_data = query.data
-    user_id = update.effective_user.id
+    __slots__ = ('action', 'category', 'genre', 'item_id', 'rating', 'genre_code')
     
-    if callback_data.startswith("rate_movie_"):
-        # Обработка оценки фильма
-        _, _, movie_id, rating = callback_data.split("_")
-        rating = int(rating)
+    def __init__(self, action, category=None, genre=None, item_id=None, rating=None, genre_code=None):
+        self.action = action
+        self.category = category
+        self.genre = genre
+        self.item_id = item_id
+        self.rating = rating
+        self.genre_code = genre_code
+
+def to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+        if not number:
+            return result
+
+def encode_callback(action, category=None, genre=None, item_id=None, rating=None, genre_code=None):
+    """Собирает callback_data; ValueError, если результат не помещается в лимит Telegram."""
+    parts = [CALLBACK_VERSION, CALLBACK_ACTION_CODES[action]]
+    if category:
+        parts.append(CATEGORY_CODES[category])
+    if action == 'genre':
+        parts.append(str(genre))
+    elif action == 'rate':
+        parts += [str(rating), to_base36(genre_code) if genre_code is not None else '', str(item_id)]
+    elif action == 'item':
+        parts.append(str(item_id))
+    data = ':'.join(parts)
+    if len(data.encode('utf-8')) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data}")
+    return data
+
+def decode_legacy_callback(data):
+    """Разбирает callback_data кнопок, отправленных до введения версии 1."""
+    if data in ('back_to_main', 'start_over'):
+        return CallbackData('menu')
+    if data == 'help':
+        return CallbackData('help')
+    if data.startswith('category_'):
+        category = LEGACY_CATEGORY_NAMES.get(data[len('category_'):])
+        return CallbackData('category', category) if category else None
+    if data.startswith('rate_'):
+        # rate_<категория>_<ID>_<оценка>; ID книги может содержать '_'
+        _, category, rest = data.split('_', 2)
+        item_id, rating = rest.rsplit('_', 1)
+        if category not in CATEGORY_CODES:
+            return None
+        return CallbackData('rate', category, item_id=item_id, rating=int(rating))
+    category, _, rest = data.partition('_')
+    if category not in CATEGORY_CODES:
+        return None
+    if rest == 'random':
+        return CallbackData('random', category)
+    if rest.startswith('genre_') and len(rest) > len('genre_'):
+        return CallbackData('genre', category, genre=rest[len('genre_'):])
+    return None
+
+@functools.lru_cache(maxsize=4096)
+def decode_callback(data):
+    """Разбирает callback_data кнопки; None для неизвестных данных."""
+    if not isinstance(data, str):
+        return None
+    try:
+        version, _, payload = data.partition(':')
+        if version != CALLBACK_VERSION:
+            return decode_legacy_callback(data)
         
-        # Получаем текущий фильм из контекста
-        movie = context.user_data.get('current_movie')
-        if movie:
-            # Сохраняем оценку в базу данных
-            save_preference(user_id, 'movie', movie.get('genres', ''), movie_id, rating)
-            
-            # Сообщаем об успешном сохранении оценки
-            await query.message.reply_text(
-                f"Спасибо за твою оценку! Я учту твои предпочтения в будущих рекомендациях."
+        code, _, rest = payload.partition(':')
+        action = CALLBACK_ACTIONS.get(code)
+        if action in ('menu', 'help', 'trending'):
+            return CallbackData(action)
+        if action in ('category', 'random'):
+            category = CATEGORY_BY_CODE.get(rest)
+            return CallbackData(action, category) if category else None
+        if action == 'genre':
+            category_code, _, genre = rest.partition(':')
+            category = CATEGORY_BY_CODE.get(category_code)
+            return CallbackData(action, category, genre=genre) if category and genre else None
+        if action == 'rate':
+            category_code, rating, genre_code, item_id = rest.split(':', 3)
+            category = CATEGORY_BY_CODE.get(category_code)
+            if not category or not item_id:
+                return None
+            return CallbackData(
+                action, category, item_id=item_id, rating=int(rating),
+                genre_code=int(genre_code, 36) if genre_code else None
             )
-        
-        # Возвращаемся к жанрам фильмов
-        keyboard = [
-            [InlineKeyboardButton("🔄 Еще фильм", callback_data="movie_random")],
-            [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.message.reply_text(
-            "Что дальше?",
-            reply_markup=reply_markup
-        )
-        return MOVIE_ACTIONS
+        if action == 'item':
+            category_code, _, item_id = rest.partition(':')
+            category = CATEGORY_BY_CODE.get(category_code)
+            return CallbackData(action, category, item_id=item_id) if category and item_id else None
+    except ValueError:
+        pass
+    return None
+
+# Экраны и клавиатуры.
+# Постоянные экраны собираются один раз при запуске: InlineKeyboardMarkup в PTB
+# неизменяемы, поэтому одни и те же объекты отдаются всем пользователям.
+# Тексты с разметкой отправляются в MarkdownV2; шаблоны экранируются заранее,
+# а подставляемые значения - при выводе.
+
+# Жанры в меню выбора: (подпись кнопки, жанр для поиска)
+GENRE_MENUS = {
+    'movie': {
+        'title': "Выбери жанр фильма или получи случайную рекомендацию:",
+        'random_label': "Случайный фильм",
+        'genres': [
+            ("Боевик", "28"), ("Комедия", "35"),
+            ("Драма", "18"), ("Фантастика", "878"),
+            ("Ужасы", "27"), ("Романтика", "10749"),
+        ],
+    },
+    'music': {
+        'title': "Выбери жанр музыки или получи случайную рекомендацию:",
+        'random_label': "Случайная музыка",
+        'genres': [
+            ("Поп", "pop"), ("Рок", "rock"),
+            ("Хип-хоп", "hip-hop"), ("Электронная", "electronic"),
+            ("Джаз", "jazz"), ("Классическая", "classical"),
+        ],
+    },
+    'book': {
+        'title': "Выбери жанр книги или получи случайную рекомендацию:",
+        'random_label': "Случайная книга",
+        'genres': [
+            ("Фантастика", "fiction"), ("Фэнтези", "fantasy"),
+            ("Наука", "science"), ("История", "history"),
+            ("Биография", "biography"), ("Поэзия", "poetry"),
+        ],
+    },
+}
+MAIN_MENU_CATEGORIES = [("🎬 Фильмы", 'movie'), ("🎵 Музыка", 'music'), ("📚 Книги", 'book')]
+MORE_BUTTON_LABELS = {'movie': "🔄 Еще фильм", 'music': "🔄 Еще музыка", 'book': "🔄 Еще книга"}
+LINK_BUTTON_LABELS = {'music': "🎧 Слушать на Spotify", 'book': "👁️ Предпросмотр"}
+
+HELP_TEXT = (
+    "🤖 *Справка по боту-рекомендателю* 🤖\n\n"
+    "*Доступные команды:*\n"
+    "/start - Начать взаимодействие с ботом\n"
+    "/help - Показать эту справку\n"
+    "/movies - Рекомендации фильмов\n"
+    "/music - Рекомендации музыки\n"
+    "/books - Рекомендации книг\n"
+    "/history - Показать историю рекомендаций\n"
+    "/search - Поиск фильмов, музыки и книг по названию или автору\n\n"
+    "*Как пользоваться:*\n"
+    "1. Выберите интересующую категорию\n"
+    "2. Выберите жанр или получите случайную рекомендацию\n"
+    "3. Оцените рекомендацию для улучшения будущих предложений\n\n"
+    "Приятного использования! 😊"
+)
+
+# Тексты экранов категорий; {genre} подставляется в сообщения о поиске
+CATEGORY_SCREEN_TEXTS = {
+    'movie': {
+        'search_genre': "🔍 Ищу фильм в жанре... Это может занять несколько секунд.",
+        'search_random': "🔍 Ищу случайный фильм... Это может занять несколько секунд.",
+        'search_more': "🔍 Ищу интересный фильм для вас... Это может занять несколько секунд.",
+        'not_found': "К сожалению, не удалось получить рекомендации фильмов. Пожалуйста, попробуйте позже.",
+        'fetch_error': "Произошла ошибка при поиске фильма. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
+    },
+    'music': {
+        'search_genre': "🔍 Ищу музыку в жанре {genre}... Это может занять несколько секунд.",
+        'search_random': "🔍 Ищу случайную музыку... Это может занять несколько секунд.",
+        'not_found': "К сожалению, не удалось получить рекомендации музыки. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
+        'fetch_error': "Произошла ошибка при поиске музыки. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
+    },
+    'book': {
+        'search_genre': "🔍 Ищу книгу в жанре {genre}... Это может занять несколько секунд.",
+        'search_random': "🔍 Ищу случайную книгу... Это может занять несколько секунд.",
+        'search_more': "🔍 Ищу интересную книгу для вас... Это может занять несколько секунд.",
+        'not_found': "К сожалению, не удалось получить рекомендации книг. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
+        'fetch_error': "Произошла ошибка при поиске книги. Пожалуйста, попробуйте другой жанр или вернитесь позже.",
+    },
+}
+
+# Шаблоны карточек: поля берутся из ItemRecord
+CARD_TEMPLATES = {
+    'movie': (
+        "🎬 *{title}*\n"
+        "({subtitle}, {year})\n\n"
+        "⭐ Рейтинг: {rating}/10\n"
+        "🎭 Жанры: {genres}\n\n"
+        "📝 *Описание:*\n{description}"
+    ),
+    'music': (
+        "🎵 *{title}*\n"
+        "👤 Исполнитель: {creator}\n"
+        "💿 Альбом: {subtitle}\n\n"
+    ),
+    'book': (
+        "📚 *{title}*\n"
+        "✍️ Автор: {creator}\n"
+        "📅 Год: {year}\n"
+        "🏷️ Категории: {genres}\n\n"
+        "📝 *Описание:*\n{description}"
+    ),
+}
+DEMO_DATA_NOTICE = "_❗ Примечание: используются демо-данные из-за временной недоступности API._\n\n"
+
+HISTORY_TITLE = "*Твоя история рекомендаций:*\n\n"
+HISTORY_LINE_TEMPLATES = {
+    'movie': "🎬 *Фильм:* {title} ({date})\n",
+    'music': "🎵 *Музыка:* {title} ({date})\n",
+    'book': "📚 *Книга:* {title} ({date})\n",
+}
+
+# Символы MarkdownV2, которые в тексте шаблона означают сами себя.
+# '*' и '_' в шаблонах используются только как разметка и не экранируются.
+MARKDOWN_TEMPLATE_LITERALS = re.compile(r"([\[\]()~`>#+\-=|.!\\])")
+
+def compile_markdown(template):
+    """
+    Готовит шаблон для MarkdownV2: экранирует текст шаблона, оставляя
+    разметку (* и _) и поля {name}. Возвращает строку для str.format.
+    """
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        literal = MARKDOWN_TEMPLATE_LITERALS.sub(r"\\\1", literal)
+        parts.append(literal.replace('{', '\\{{').replace('}', '\\}}'))
+        if field is not None:
+            parts.append('{' + field + '}')
+    return ''.join(parts)
+
+# Символы, которые экранирует telegram.helpers.escape_markdown(version=2).
+# Выражение компилируется один раз: карточка экранирует несколько полей на каждую отправку.
+MARKDOWN_VALUE_SPECIAL = re.compile(r"([\\_*\[\]()~`>#+\-=|{}.!])")
+
+def markdown_value(value):
+    """Экранирует подставляемое значение для MarkdownV2."""
+    return MARKDOWN_VALUE_SPECIAL.sub(r"\\\1", str(value))
+
+class Screen:
+    """Текст экрана (или шаблон текста), клавиатура и режим разметки."""
     
-    elif callback_data == "movie_random":
-        # Отображаем сообщение о поиске и напрямую вызываем функцию для получения случайного фильма
-        
-        # Создаем клавиатуру для отмены
-        cancel_keyboard = [[InlineKeyboardButton("⏱️ Отмена", callback_data="category_movies")]]
-        cancel_markup = InlineKeyboardMarkup(cancel_keyboard)
-        
-        # Отправляем сообщение о поиске
-        searching_message = await query.message.reply_text(
-            "🔍 Ищу интересный фильм для вас... Это может занять несколько секунд.",
-            reply_markup=cancel_markup
-        )
-        
-        try:
-            # Напрямую получаем случайный фильм
-            movie = await get_movie_recommendations(None, user_id)
-            
-            if movie:
-                context.user_data['current_movie'] = movie
-                
-                # Подготовка сообщения о фильме
-                message_text = (
-                    f"🎬 *{movie['title']}*\n"
-                    f"({movie['original_title']}, {movie['year']})\n\n"
-                    f"⭐ Рейтинг: {movie['rating']}/10\n"
-                    f"🎭 Жанры: {movie['genres']}\n\n"
-                    f"📝 *Описание:*\n{movie['overview']}"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_movie_{movie['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_movie_{movie['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще фильм", callback_data="movie_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_movies")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Удаляем сообщение о поиске
-                await searching_message.delete()
-                
-                if movie['poster_url']:
-                    await query.message.reply_photo(
-                        photo=movie['poster_url'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await query.message.reply_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return MOVIE_ACTIONS
-            else:
-                # Удаляем сообщение о поиске
-                await searching_message.delete()
-                
-                await query.message.reply_text(
-                    text="К сожалению, не удалось получить рекомендации фильмов. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="category_movies")]])
-                )
-                return MOVIE_ACTIONS
-        
-        except Exception as e:
-            # Логируем ошибку и показываем сообщение пользователю
-            logger.error(f"Ошибка при получении случайного фильма: {e}")
-            
-            # Удаляем сообщение о поиске, если оно еще существует
-            try:
-                await searching_message.delete()
-            except:
-                pass
-            
-            await query.message.reply_text(
-                text="Произошла ошибка при поиске фильма. Пожалуйста, попробуйте позже.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="category_movies")]])
-            )
-            return MOVIE_ACTIONS
-    
-    elif callback_data == "category_movies":
-        # Отправляем новое сообщение с выбором жанров фильмов
-        movie_genres = [
-            [
-                InlineKeyboardButton("Боевик", callback_data="movie_genre_28"),
-                InlineKeyboardButton("Комедия", callback_data="movie_genre_35")
-            ],
-            [
-                InlineKeyboardButton("Драма", callback_data="movie_genre_18"),
-                InlineKeyboardButton("Фантастика", callback_data="movie_genre_878")
-            ],
-            [
-                InlineKeyboardButton("Ужасы", callback_data="movie_genre_27"),
-                InlineKeyboardButton("Романтика", callback_data="movie_genre_10749")
-            ],
-            [
-                InlineKeyboardButton("Случайный фильм", callback_data="movie_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(movie_genres)
-        
-        # Отправляем новое сообщение
-        await query.message.reply_text(
-            text="Выбери жанр фильма или получи случайную рекомендацию:",
-            reply_markup=reply_markup
-        )
-        
-        # Пробуем удалить старое сообщение
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-        
-        return GENRE_SELECTION
-    
-    elif callback_data == "back_to_main":
-        # Отображаем главное меню
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Отправляем новое сообщение с главным меню
-        await query.message.reply_text(
-            text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-            reply_markup=reply_markup
-        )
-        
-        # Пробуем удалить старое сообщение
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-        
-        return START_ROUTES
+    __slots__ = ('text', 'reply_markup', 'parse_mode')
     
-    return MOVIE_ACTIONS
+    def __init__(self, text, reply_markup=None, parse_mode=None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
 
-async def handle_music_actions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
+def button(label, action, category=None, **fields):
+    return InlineKeyboardButton(label, callback_data=encode_callback(action, category, **fields))
+
+def build_screens():
+    """Собирает все постоянные экраны и клавиатуры."""
+    home_row = (button("🏠 Главное меню", 'menu'),)
+    home_markup = InlineKeyboardMarkup((home_row,))
+    main_menu_markup = InlineKeyboardMarkup(
+        tuple((button(label, 'category', category),) for label, category in MAIN_MENU_CATEGORIES)
+        + ((button("🔥 Популярное у нас", 'trending'),), (button("❓ Помощь", 'help'),))
+    )
+    help_text = compile_markdown(HELP_TEXT)
     
-    callback_data = query.data
-    user_id = update.effective_user.id
+    screens = {
+        'main_menu': Screen("Выбери категорию, и я предложу тебе что-нибудь интересное!", main_menu_markup),
+        'greeting': Screen(
+            "Привет, {name}! 👋\n\n"
+            "Я бот-рекомендатель фильмов, музыки и книг. Выбери категорию, и я предложу тебе что-нибудь интересное!",
+            main_menu_markup
+        ),
+        'help': Screen(help_text, InlineKeyboardMarkup(((button("◀️ Назад", 'menu'),),)), 'MarkdownV2'),
+        'help_command': Screen(help_text, None, 'MarkdownV2'),
+        'rated': Screen("Спасибо за твою оценку! Я учту твои предпочтения в будущих рекомендациях."),
+        'unknown_callback': Screen(
+            "Извините, произошла ошибка в обработке запроса. Пожалуйста, выберите категорию:",
+            main_menu_markup
+        ),
+        'error': Screen(
+            "😔 Произошла ошибка при обработке вашего запроса.\n\nПопробуйте начать сначала с помощью команды /start",
+            InlineKeyboardMarkup((home_row, (button("🔄 Начать заново", 'menu'),)))
+        ),
+        'history_empty': Screen("У тебя еще нет истории рекомендаций. Получи свою первую рекомендацию!", home_markup),
+        'history': Screen(compile_markdown(HISTORY_TITLE), home_markup, 'MarkdownV2'),
+        'search_usage': Screen(
+            "Напиши запрос после команды, например: /search Мастер и Маргарита\n\n"
+            "Искать можно и в любом чате: набери @ и имя бота, а затем запрос."
+        ),
+        'search_empty': Screen("По запросу «{query}» ничего не нашлось. Попробуй другие слова.", home_markup),
+        'search_results': Screen("🔎 Найдено по запросу «{query}»:"),
+        'search_item_missing': Screen("Этот элемент больше недоступен. Попробуй повторить поиск.", home_markup),
+        'trending': Screen("🔥 Популярное у пользователей бота за неделю:"),
+        'trending_genres': Screen("Популярные жанры:"),
+        'trending_empty': Screen(
+            "Пока слишком мало оценок, чтобы собрать подборку. Оценивай рекомендации 👍 и 👎, "
+            "и здесь появится то, что нравится пользователям бота.",
+            InlineKeyboardMarkup(((button("◀️ Назад", 'menu'),),))
+        ),
+    }
     
-    if callback_data.startswith("rate_music_"):
-        # Обработка оценки музыки
-        _, _, music_id, rating = callback_data.split("_")
-        rating = int(rating)
-        
-        # Получаем текущий трек из контекста
-        music = context.user_data.get('current_music')
-        if music:
-            # Сохраняем оценку в базу данных
-            save_preference(user_id, 'music', '', music_id, rating)
-            
-            # Сообщаем об успешном сохранении оценки
-            await query.message.reply_text(
-                f"Спасибо за твою оценку! Я учту твои предпочтения в будущих рекомендациях."
-            )
-        
-        # Возвращаемся к жанрам музыки
-        keyboard = [
-            [InlineKeyboardButton("🔄 Еще музыка", callback_data="music_random")],
-            [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_music")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.message.reply_text(
-            "Что дальше?",
-            reply_markup=reply_markup
-        )
-        return MUSIC_ACTIONS
-    
-    elif callback_data == "music_random":
-        # Отправляем новое сообщение с выбором жанров
-        music_genres = [
-            [
-                InlineKeyboardButton("Поп", callback_data="music_genre_pop"),
-                InlineKeyboardButton("Рок", callback_data="music_genre_rock")
-            ],
-            [
-                InlineKeyboardButton("Хип-хоп", callback_data="music_genre_hip-hop"),
-                InlineKeyboardButton("Электронная", callback_data="music_genre_electronic")
-            ],
-            [
-                InlineKeyboardButton("Джаз", callback_data="music_genre_jazz"),
-                InlineKeyboardButton("Классическая", callback_data="music_genre_classical")
-            ],
-            [
-                InlineKeyboardButton("Случайная музыка", callback_data="music_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(music_genres)
-        
-        # Отправляем новое сообщение вместо попытки редактировать существующее
-        await query.message.reply_text(
-            text="Выбери жанр музыки или получи случайную рекомендацию:",
-            reply_markup=reply_markup
-        )
-        
-        # Пробуем удалить старое сообщение (если это возможно)
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-        
-        return GENRE_SELECTION
-    
-    elif callback_data == "category_music":
-        # Отправляем новое сообщение с выбором жанров
-        music_genres = [
-            [
-                InlineKeyboardButton("Поп", callback_data="music_genre_pop"),
-                InlineKeyboardButton("Рок", callback_data="music_genre_rock")
-            ],
-            [
-                InlineKeyboardButton("Хип-хоп", callback_data="music_genre_hip-hop"),
-                InlineKeyboardButton("Электронная", callback_data="music_genre_electronic")
-            ],
-            [
-                InlineKeyboardButton("Джаз", callback_data="music_genre_jazz"),
-                InlineKeyboardButton("Классическая", callback_data="music_genre_classical")
-            ],
-            [
-                InlineKeyboardButton("Случайная музыка", callback_data="music_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(music_genres)
-        
-        # Отправляем новое сообщение вместо попытки редактировать существующее
-        await query.message.reply_text(
-            text="Выбери жанр музыки или получи случайную рекомендацию:",
-            reply_markup=reply_markup
+    for category, menu in GENRE_MENUS.items():
+        texts = CATEGORY_SCREEN_TEXTS[category]
+        genre_buttons = [button(label, 'genre', category, genre=genre) for label, genre in menu['genres']]
+        genre_markup = InlineKeyboardMarkup(
+            tuple(tuple(genre_buttons[i:i + 2]) for i in range(0, len(genre_buttons), 2))
+            + ((button(menu['random_label'], 'random', category), button("◀️ Назад", 'menu')),)
         )
+        back_to_genres = button("◀️ Назад к жанрам", 'category', category)
+        cancel_markup = InlineKeyboardMarkup(((button("⏱️ Отмена", 'category', category),),))
+        failure_markup = InlineKeyboardMarkup(((back_to_genres,), home_row))
         
-        # Пробуем удалить старое сообщение (если это возможно)
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-            
-        return GENRE_SELECTION
-    
-    elif callback_data == "back_to_main":
-        # Отображаем главное меню
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Отправляем новое сообщение вместо попытки редактировать существующее
-        await query.message.reply_text(
-            text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-            reply_markup=reply_markup
+        screens[('genre_menu', category)] = Screen(menu['title'], genre_markup)
+        screens[('next_actions', category)] = Screen("Что дальше?", InlineKeyboardMarkup((
+            (button(MORE_BUTTON_LABELS[category], 'random', category),), (back_to_genres,), home_row
+        )))
+        for key in ('search_genre', 'search_random', 'search_more'):
+            if key in texts:
+                screens[(key, category)] = Screen(texts[key], cancel_markup)
+        screens[('not_found', category)] = Screen(texts['not_found'], failure_markup)
+        screens[('fetch_error', category)] = Screen(texts['fetch_error'], failure_markup)
+        # Нижние строки карточки одинаковы для всех элементов категории
+        screens[('card_rows', category)] = (
+            (button(MORE_BUTTON_LABELS[category], 'random', category),),
+            (back_to_genres,),
         )
-        
-        # Пробуем удалить старое сообщение (если это возможно)
-        try:
-            await query.message.delete()
-        except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-            
-        return START_ROUTES
+    return screens
+
+SCREENS = build_screens()
+CARD_RENDERERS = {category: compile_markdown(template).format_map for category, template in CARD_TEMPLATES.items()}
+CARD_FIELDS = {
+    category: [field for _, field, _, _ in string.Formatter().parse(template) if field]
+    for category, template in CARD_TEMPLATES.items()
+}
+DEMO_DATA_NOTICE_MARKDOWN = compile_markdown(DEMO_DATA_NOTICE)
+HISTORY_LINE_RENDERERS = {
+    category: compile_markdown(template).format_map for category, template in HISTORY_LINE_TEMPLATES.items()
+}
+
+def render_card_text(record):
+    """Текст карточки элемента в MarkdownV2."""
+    category = record.category
+    text = CARD_RENDERERS[category]({field: markdown_value(getattr(record, field)) for field in CARD_FIELDS[category]})
+    # Если в URL изображения есть "placeholder", предупреждаем о демо-режиме
+    if category == 'music' and record.image_url and "placeholder" in record.image_url:
+        text += DEMO_DATA_NOTICE_MARKDOWN
+    return text
+
+def link_button(record):
+    """Кнопка прослушивания или предпросмотра; None, если ссылки нет."""
+    if record.link and record.category in LINK_BUTTON_LABELS:
+        return InlineKeyboardButton(LINK_BUTTON_LABELS[record.category], url=record.link)
+    return None
+
+def render_card(record):
+    """Текст (MarkdownV2), клавиатура и картинка карточки элемента."""
+    category = record.category
+    text = render_card_text(record)
     
-    return MUSIC_ACTIONS
+    genre_code = genre_codes.code_for(record.genres) if record.genres else None
+    rows = [
+        (
+            button("👍 Нравится", 'rate', category, item_id=record.id, rating=5, genre_code=genre_code),
+            button("👎 Не нравится", 'rate', category, item_id=record.id, rating=1, genre_code=genre_code),
+        ),
+        *SCREENS[('card_rows', category)],
+    ]
+    # Кнопка прослушивания или предпросмотра, если есть ссылка
+    link = link_button(record)
+    if link:
+        rows.insert(0, (link,))
+    return text, InlineKeyboardMarkup(rows), record.image_url
 
-async def handle_book_actions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query
-    await query.answer()
+# Функции-обработчики команд бота
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.effective_user
+    cancel_recommendation_fetch(user.id)
+    await run_db(register_user, user.id, user.username, user.first_name, user.last_name)
     
-    callback_data = query.data
-    user_id = update.effective_user.id
+    screen = SCREENS['greeting']
+    await update.message.reply_text(
+        screen.text.format(name=user.first_name),
+        reply_markup=screen.reply_markup
+    )
     
-    if callback_data.startswith("rate_book_"):
-        # Обработка оценки книги
-        _, _, book_id, rating = callback_data.split("_")
-        rating = int(rating)
-        
-        # Получаем текущую книгу из контекста
-        book = context.user_data.get('current_book')
-        if book:
-            # Сохраняем оценку в базу данных
-            save_preference(user_id, 'book', book.get('categories', ''), book_id, rating)
-            
-            # Сообщаем об успешном сохранении оценки
-            await query.message.reply_text(
-                f"Спасибо за твою оценку! Я учту твои предпочтения в будущих рекомендациях."
-            )
-        
-        # Возвращаемся к жанрам книг
-        keyboard = [
-            [InlineKeyboardButton("🔄 Еще книга", callback_data="book_random")],
-            [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.message.reply_text(
-            "Что дальше?",
-            reply_markup=reply_markup
-        )
-        return BOOK_ACTIONS
+    return START_ROUTES
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    screen = SCREENS['help_command']
+    await update.message.reply_text(screen.text, parse_mode=screen.parse_mode)
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    cancel_recommendation_fetch(update.effective_user.id)
+    await update.message.reply_text(
+        "Действие отменено. Чтобы начать заново, используйте команду /start"
+    )
+    return ConversationHandler.END
+
+# Отслеживание задач получения рекомендаций
+
+# Активные задачи поиска рекомендаций: user_id -> asyncio.Task.
+# У пользователя одновременно выполняется не больше одной такой задачи.
+ACTIVE_FETCHES = {}
+
+def cancel_recommendation_fetch(user_id):
+    """Отменяет незавершенный поиск рекомендации пользователя, если он есть."""
+    task = ACTIVE_FETCHES.pop(user_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+        logger.info("Поиск рекомендации для пользователя %s отменен", user_id)
+        return True
+    return False
+
+def start_recommendation_fetch(context, update, user_id, coroutine):
+    """
+    Запускает поиск и отправку рекомендации как отдельную задачу пользователя.
+    Предыдущая незавершенная задача этого пользователя отменяется, поэтому
+    отмена прерывает HTTP-запросы и запись в историю, а карточка не отправляется.
+    """
+    cancel_recommendation_fetch(user_id)
+    started = time.perf_counter()
+    # Задача копирует контекст при создании, поэтому ее спаны попадут в трассу обновления
+    span = start_span('recommendation_fetch')
+    token = current_span.set(span) if span is not None else None
+    try:
+        task = context.application.create_task(coroutine, update=update)
+    finally:
+        if token is not None:
+            current_span.reset(token)
+    if span is not None:
+        task.add_done_callback(lambda finished_task: span.finish(cancelled=finished_task.cancelled()))
+    ACTIVE_FETCHES[user_id] = task
     
-    elif callback_data == "book_random":
-        # Отображаем сообщение о поиске и напрямую вызываем функцию для получения случайной книги
-        
-        # Создаем клавиатуру для отмены
-        cancel_keyboard = [[InlineKeyboardButton("⏱️ Отмена", callback_data="category_books")]]
-        cancel_markup = InlineKeyboardMarkup(cancel_keyboard)
-        
-        # Отправляем сообщение о поиске
-        searching_message = await query.message.reply_text(
-            "🔍 Ищу интересную книгу для вас... Это может занять несколько секунд.",
-            reply_markup=cancel_markup
+    def forget(finished_task):
+        if ACTIVE_FETCHES.get(user_id) is finished_task:
+            del ACTIVE_FETCHES[user_id]
+        elapsed = time.perf_counter() - started
+        if SLOW_UPDATE_MS and elapsed * 1000 >= SLOW_UPDATE_MS and not finished_task.cancelled():
+            capture_slow_update('recommendation_fetch', update, started, elapsed, span)
+    
+    task.add_done_callback(forget)
+    return task
+
+async def show_search_placeholder(query, screen, text, as_new_message=False):
+    """Показывает сообщение о поиске с кнопкой отмены и возвращает его."""
+    if as_new_message:
+        return await query.message.reply_text(text, reply_markup=screen.reply_markup)
+    return await query.edit_message_text(text=text, reply_markup=screen.reply_markup)
+
+# Получение и хранение рекомендаций по категориям; тексты и клавиатуры - в SCREENS
+RECOMMENDATION_SETTINGS = {
+    'movie': {'fetch': get_movie_recommendations, 'user_data_key': 'current_movie'},
+    'music': {'fetch': get_music_recommendations, 'user_data_key': 'current_music'},
+    'book': {'fetch': get_book_recommendations, 'user_data_key': 'current_book'},
+}
+
+async def deliver_recommendation(placeholder, context, user_id, category, genre=None):
+    """
+    Получает рекомендацию и заменяет сообщение о поиске карточкой.
+    Выполняется в задаче, запущенной через start_recommendation_fetch.
+    """
+    settings = RECOMMENDATION_SETTINGS[category]
+    
+    try:
+        item = await settings['fetch'](genre, user_id)
+    except Exception as e:
+        logger.error("Ошибка при получении рекомендации (%s): %s", category, e)
+        screen = SCREENS[('fetch_error', category)]
+        await placeholder.edit_text(text=screen.text, reply_markup=screen.reply_markup)
+        return
+    
+    if not item:
+        logger.warning("Не удалось получить рекомендацию (%s) для жанра: %s", category, genre)
+        screen = SCREENS[('not_found', category)]
+        await placeholder.edit_text(text=screen.text, reply_markup=screen.reply_markup)
+        return
+    
+    # В user_data храним только ID: сама запись общая и лежит в каталоге
+    context.user_data[settings['user_data_key']] = item.id
+    try:
+        message_text, reply_markup, photo = render_card(item)
+    except ValueError as e:
+        # Например, ID элемента не помещается в callback_data кнопок оценки
+        logger.error("Не удалось отрисовать карточку (%s, %s): %s", category, item.id, e)
+        screen = SCREENS[('fetch_error', category)]
+        await placeholder.edit_text(text=screen.text, reply_markup=screen.reply_markup)
+        return
+    
+    if photo:
+        await placeholder.reply_photo(
+            photo=photo,
+            caption=message_text,
+            reply_markup=reply_markup,
+            parse_mode='MarkdownV2'
         )
-        
         try:
-            # Напрямую получаем случайную книгу
-            book = await get_book_recommendations(None, user_id)
-            
-            if book:
-                context.user_data['current_book'] = book
-                
-                # Подготовка сообщения о книге
-                message_text = (
-                    f"📚 *{book['title']}*\n"
-                    f"✍️ Автор: {book['authors']}\n"
-                    f"📅 Год: {book['published_date']}\n"
-                    f"🏷️ Категории: {book['categories']}\n\n"
-                    f"📝 *Описание:*\n{book['description']}"
-                )
-                
-                keyboard = [
-                    [
-                        InlineKeyboardButton("👍 Нравится", callback_data=f"rate_book_{book['id']}_5"),
-                        InlineKeyboardButton("👎 Не нравится", callback_data=f"rate_book_{book['id']}_1")
-                    ],
-                    [InlineKeyboardButton("🔄 Еще книга", callback_data="book_random")],
-                    [InlineKeyboardButton("◀️ Назад к жанрам", callback_data="category_books")]
-                ]
-                
-                # Добавляем кнопку для предпросмотра, если есть ссылка
-                if book['preview_link']:
-                    keyboard.insert(0, [InlineKeyboardButton("👁️ Предпросмотр", url=book['preview_link'])])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Удаляем сообщение о поиске
-                await searching_message.delete()
-                
-                if book['image_url']:
-                    await query.message.reply_photo(
-                        photo=book['image_url'],
-                        caption=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await query.message.reply_text(
-                        text=message_text,
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                
-                return BOOK_ACTIONS
-            else:
-                # Удаляем сообщение о поиске
-                await searching_message.delete()
-                
-                await query.message.reply_text(
-                    text="К сожалению, не удалось получить рекомендации книг. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="category_books")]])
-                )
-                return BOOK_ACTIONS
-        
+            await placeholder.delete()  # Удаляем сообщение о поиске
         except Exception as e:
-            # Логируем ошибку и показываем сообщение пользователю
-            logger.error(f"Ошибка при получении случайной книги: {e}")
-            
-            # Удаляем сообщение о поиске, если оно еще существует
-            try:
-                await searching_message.delete()
-            except:
-                pass
-            
-            await query.message.reply_text(
-                text="Произошла ошибка при поиске книги. Пожалуйста, попробуйте позже.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад", callback_data="category_books")]])
-            )
-            return BOOK_ACTIONS
-    
-    elif callback_data == "category_books":
-        # Отправляем новое сообщение с выбором жанров книг
-        book_genres = [
-            [
-                InlineKeyboardButton("Фантастика", callback_data="book_genre_fiction"),
-                InlineKeyboardButton("Фэнтези", callback_data="book_genre_fantasy")
-            ],
-            [
-                InlineKeyboardButton("Наука", callback_data="book_genre_science"),
-                InlineKeyboardButton("История", callback_data="book_genre_history")
-            ],
-            [
-                InlineKeyboardButton("Биография", callback_data="book_genre_biography"),
-                InlineKeyboardButton("Поэзия", callback_data="book_genre_poetry")
-            ],
-            [
-                InlineKeyboardButton("Случайная книга", callback_data="book_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(book_genres)
-        
-        # Отправляем новое сообщение
-        await query.message.reply_text(
-            text="Выбери жанр книги или получи случайную рекомендацию:",
-            reply_markup=reply_markup
+            logger.warning("Не удалось удалить сообщение о поиске: %s", e)
+    else:
+        await placeholder.edit_text(
+            text=message_text,
+            reply_markup=reply_markup,
+            parse_mode='MarkdownV2'
         )
-        
-        # Пробуем удалить старое сообщение
+
+# Обработка нажатий кнопок
+
+async def show_screen(query, text, reply_markup, mode, parse_mode=None):
+    """
+    Показывает экран в ответ на нажатие кнопки.
+    mode: 'edit' - заменить текст сообщения с кнопкой; 'replace' - отправить новое
+    сообщение и удалить старое (карточку с фото нельзя превратить в текст);
+    'edit_or_reply' - отредактировать, а если не получилось, отправить новое.
+    """
+    if mode == 'edit':
+        await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+    elif mode == 'replace':
+        await query.message.reply_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
         try:
             await query.message.delete()
         except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-        
-        return GENRE_SELECTION
-    
-    elif callback_data == "back_to_main":
-        # Отображаем главное меню
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Отправляем новое сообщение с главным меню
-        await query.message.reply_text(
-            text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-            reply_markup=reply_markup
-        )
-        
-        # Пробуем удалить старое сообщение
+            logger.warning("Не удалось удалить предыдущее сообщение: %s", e)
+    else:
         try:
-            await query.message.delete()
+            await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
         except Exception as e:
-            logger.warning(f"Не удалось удалить предыдущее сообщение: {e}")
-        
+            logger.error("Ошибка при редактировании сообщения: %s", e)
+            await query.message.reply_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+async def open_main_menu(update, context, callback, mode='edit'):
+    # Уход с экрана поиска отменяет незавершенный поиск
+    cancel_recommendation_fetch(update.effective_user.id)
+    screen = SCREENS['main_menu']
+    await show_screen(update.callback_query, screen.text, screen.reply_markup, mode)
+    return START_ROUTES
+
+async def open_genre_menu(update, context, callback, mode='edit'):
+    cancel_recommendation_fetch(update.effective_user.id)
+    screen = SCREENS[('genre_menu', callback.category)]
+    await show_screen(update.callback_query, screen.text, screen.reply_markup, mode)
+    return GENRE_SELECTION
+
+# Экран «Популярное у нас»: элементы и жанры из счетчиков популярности в памяти
+TRENDING_ITEMS_PER_CATEGORY = 3
+TRENDING_GENRES_PER_CATEGORY = 3
+
+async def open_trending(update, context, callback, mode='edit'):
+    cancel_recommendation_fetch(update.effective_user.id)
+    keyboard = []
+    genre_lines = []
+    for label, category in MAIN_MENU_CATEGORIES:
+        for item_id in trending.top('item', category, TRENDING_ITEMS_PER_CATEGORY):
+            record = await item_catalog.get(category, item_id)
+            if record is None:
+                continue
+            try:
+                callback_data = encode_callback('item', category, item_id=record.id)
+            except ValueError:
+                # ID не помещается в callback_data
+                continue
+            keyboard.append((InlineKeyboardButton(search_result_label(record), callback_data=callback_data),))
+        genres = trending.top('genre', category, TRENDING_GENRES_PER_CATEGORY)
+        if genres:
+            genre_lines.append(f"{label}: {', '.join(genres)}")
+    
+    if not keyboard:
+        screen = SCREENS['trending_empty']
+        await show_screen(update.callback_query, screen.text, screen.reply_markup, mode)
         return START_ROUTES
     
-    return BOOK_ACTIONS
+    text = SCREENS['trending'].text
+    if genre_lines:
+        text += f"\n\n{SCREENS['trending_genres'].text}\n" + '\n'.join(genre_lines)
+    keyboard.append((InlineKeyboardButton("◀️ Назад", callback_data=encode_callback('menu')),))
+    await show_screen(update.callback_query, text, InlineKeyboardMarkup(keyboard), mode)
+    return START_ROUTES
 
-async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def open_help(update, context, callback):
+    cancel_recommendation_fetch(update.effective_user.id)
+    screen = SCREENS['help']
+    await show_screen(update.callback_query, screen.text, screen.reply_markup, 'edit', parse_mode=screen.parse_mode)
+    return START_ROUTES
+
+async def start_search(update, context, category, genre, text_key, as_new_message=False):
+    """Показывает сообщение о поиске и запускает получение рекомендации."""
+    screen = SCREENS[(text_key, category)]
     user_id = update.effective_user.id
+    if genre:
+        logger.info("Запрос рекомендации (%s) жанра: %s, пользователь: %s", category, genre, user_id)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    placeholder = await show_search_placeholder(
+        update.callback_query, screen, screen.text.format(genre=genre), as_new_message=as_new_message
+    )
+    start_recommendation_fetch(
+        context, update, user_id,
+        deliver_recommendation(placeholder, context, user_id, category, genre)
+    )
+    return CATEGORY_STATES[category]
+
+async def search_by_genre(update, context, callback):
+    return await start_search(update, context, callback.category, callback.genre, 'search_genre')
+
+async def search_random(update, context, callback):
+    genre = None
+    if callback.category == 'music':
+        # Для музыки выбираем случайный жанр
+        genre = random.choice(list(SPOTIFY_GENRE_MAPPING.keys()))
+        logger.info("Выбран случайный жанр для музыки: %s", genre)
+    return await start_search(update, context, callback.category, genre, 'search_random')
+
+async def search_more(update, context, callback):
+    # Карточка остается в чате, поэтому сообщение о поиске отправляется новым
+    return await start_search(update, context, callback.category, None, 'search_more', as_new_message=True)
+
+async def rate_item(update, context, callback):
+    """
+    Сохраняет оценку из кнопки карточки. Все нужное (категория, ID, код жанра)
+    есть в callback_data, поэтому данные сессии пользователя не требуются.
+    """
+    query = update.callback_query
+    genre = await genre_codes.name_for(callback.genre_code) if callback.genre_code is not None else None
+    if genre is None:
+        # Кнопки старого формата не содержат кода жанра: берем жанр из каталога
+        record = await item_catalog.get(callback.category, callback.item_id)
+        genre = record.genres if record else None
     
-    # Получаем историю рекомендаций для пользователя
-    cursor.execute('''
+    await run_db(record_rating, update.effective_user.id, callback.category, genre or '',
+                 callback.item_id, callback.rating)
+    trending.record(callback.category, callback.item_id, genre, **rating_counts(callback.rating))
+    
+    # Сообщаем об успешном сохранении оценки
+    await query.message.reply_text(SCREENS['rated'].text)
+    screen = SCREENS[('next_actions', callback.category)]
+    await query.message.reply_text(screen.text, reply_markup=screen.reply_markup)
+    return CATEGORY_STATES[callback.category]
+
+async def open_item(update, context, callback):
+    """Отправляет карточку элемента из результатов поиска новым сообщением."""
+    query = update.callback_query
+    cancel_recommendation_fetch(update.effective_user.id)
+    record = await item_catalog.get(callback.category, callback.item_id)
+    if record is None:
+        screen = SCREENS['search_item_missing']
+        await query.message.reply_text(screen.text, reply_markup=screen.reply_markup)
+        return START_ROUTES
+    
+    context.user_data[RECOMMENDATION_SETTINGS[record.category]['user_data_key']] = record.id
+    message_text, reply_markup, photo = render_card(record)
+    if photo:
+        await query.message.reply_photo(
+            photo=photo, caption=message_text, reply_markup=reply_markup, parse_mode='MarkdownV2'
+        )
+    else:
+        await query.message.reply_text(message_text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+    return CATEGORY_STATES[record.category]
+
+# Состояние диалога с карточками каждой категории
+CATEGORY_STATES = {'movie': MOVIE_ACTIONS, 'music': MUSIC_ACTIONS, 'book': BOOK_ACTIONS}
+
+def card_actions_routes(category, more_action):
+    # С экрана карточки новые экраны отправляются отдельным сообщением
+    return {
+        ('random', category): more_action,
+        ('category', category): functools.partial(open_genre_menu, mode='replace'),
+        ('menu', None): functools.partial(open_main_menu, mode='replace'),
+    }
+
+# Таблица переходов: состояние -> (действие, категория или None для любой) -> обработчик
+CALLBACK_ROUTES = {
+    START_ROUTES: {
+        ('category', None): open_genre_menu,
+        ('help', None): open_help,
+        ('trending', None): open_trending,
+        ('menu', None): open_main_menu,
+    },
+    GENRE_SELECTION: {
+        ('genre', None): search_by_genre,
+        ('random', None): search_random,
+        ('menu', None): open_main_menu,
+    },
+    MOVIE_ACTIONS: card_actions_routes('movie', search_more),
+    # «Еще музыка» возвращает к выбору жанра
+    MUSIC_ACTIONS: card_actions_routes('music', functools.partial(open_genre_menu, mode='replace')),
+    BOOK_ACTIONS: card_actions_routes('book', search_more),
+}
+# Результаты поиска и карточки остаются в чате, поэтому их кнопки работают в любом
+# состоянии: оценка берет все нужное из callback_data, а не из сессии
+for routes in CALLBACK_ROUTES.values():
+    routes[('item', None)] = open_item
+    routes[('rate', None)] = rate_item
+
+def find_callback_route(state, callback):
+    routes = CALLBACK_ROUTES[state]
+    return routes.get((callback.action, callback.category)) or routes.get((callback.action, None))
+
+def callback_router(state):
+    """CallbackQueryHandler состояния: принимает только кнопки, для которых есть переход."""
+    def matches(data):
+        callback = decode_callback(data)
+        return callback is not None and find_callback_route(state, callback) is not None
+    
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        query = update.callback_query
+        await query.answer()
+        callback = decode_callback(query.data)
+        handler = find_callback_route(state, callback)
+        return await timed_call(handler_labels(handler), handler, update, context, callback)
+    
+    return CallbackQueryHandler(route, pattern=matches)
+
+def handler_labels(handler):
+    # Переходы с параметрами (functools.partial) учитываются под именем функции
+    return (('handler', getattr(handler, 'func', handler).__name__),)
+
+async def timed_call(labels, handler, *args):
+    """Вызывает обработчик, учитывает время обработки и исключения и начинает трассу обновления."""
+    user = getattr(args[0], 'effective_user', None)
+    started = time.perf_counter()
+    span = None
+    try:
+        with trace_span('handler', root=True, handler=labels[0][1], user_id=user.id if user else None) as span:
+            return await handler(*args)
+    except Exception:
+        metrics.inc('bot_handler_errors_total', labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('bot_handler_duration_seconds', labels, elapsed)
+        if SLOW_UPDATE_MS and elapsed * 1000 >= SLOW_UPDATE_MS:
+            capture_slow_update(labels[0][1], args[0], started, elapsed, span)
+
+def instrumented(handler):
+    """Обработчик команды или inline-запроса с учетом времени обработки."""
+    labels = handler_labels(handler)
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        return await timed_call(labels, handler, update, context)
+    
+    return wrapper
+
+# Последние рекомендации пользователя
+def fetch_recent_history(conn, user_id, limit=10):
+    cursor = conn.execute('''
     SELECT category, item_id, recommendation_date FROM recommendation_history
     WHERE user_id = ?
     ORDER BY recommendation_date DESC
-    LIMIT 10
-    ''', (user_id,))
+    LIMIT ?
+    ''', (user_id, limit))
+    return cursor.fetchall()
+
+async def fetch_history_title(category, item_id):
+    """Название фильма или книги у провайдера (через кэш ответов); None при ошибке."""
+    try:
+        if category == "movie":
+            data = await cached_get_json(build_tmdb_url(f"/movie/{item_id}"))
+            return data.get('title')
+        data = await cached_get_json(build_google_books_url(f"/{item_id}", fields=GOOGLE_BOOKS_TITLE_FIELDS))
+        return data.get('volumeInfo', {}).get('title')
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("Не удалось получить название для истории (%s, %s): %s", category, item_id, e)
+        return None
+
+async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    cancel_recommendation_fetch(user_id)
     
-    history = cursor.fetchall()
-    conn.close()
+    # Получаем историю рекомендаций для пользователя
+    history = await run_db(fetch_recent_history, user_id)
     
     if not history:
-        await update.message.reply_text(
-            "У тебя еще нет истории рекомендаций. Получи свою первую рекомендацию!",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-            ])
-        )
+        screen = SCREENS['history_empty']
+        await update.message.reply_text(screen.text, reply_markup=screen.reply_markup)
         return
     
+    # Названия берем из каталога (память, затем таблица items); к провайдерам
+    # обращаемся только за элементами, которых там нет
+    records = await asyncio.gather(*(
+        item_catalog.get(category, item_id) for category, item_id, _ in history
+    ))
+    missing = [
+        (category, item_id) for (category, item_id, _), record in zip(history, records)
+        if record is None and not item_id.startswith("fallback_")
+    ]
+    # Все недостающие треки получаем одним пакетным запросом к Spotify
+    track_ids = [item_id for category, item_id in missing if category == "music"]
+    tracks = await spotify_hydrator.get_tracks(track_ids) if track_ids else {}
+    other_missing = [(category, item_id) for category, item_id in missing if category in ("movie", "book")]
+    provider_titles = dict(zip(other_missing, await asyncio.gather(*(
+        fetch_history_title(category, item_id) for category, item_id in other_missing
+    ))))
+    
     # Формируем сообщение с историей
-    message_text = "*Твоя история рекомендаций:*\n\n"
+    screen = SCREENS['history']
+    message_text = screen.text
     
-    for item in history:
+    for item, record in zip(history, records):
         category, item_id, date = item
-        category_emoji = "🎬" if category == "movie" else "🎵" if category == "music" else "📚"
         date_formatted = datetime.strptime(date, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y %H:%M")
+        title = f"ID {item_id}"
         
-        if category == "movie":
-            # Получаем информацию о фильме по ID
-            try:
-                url = f"https://api.themoviedb.org/3/movie/{item_id}?api_key={TMDB_API_KEY}&language=ru"
-                response = requests.get(url, timeout=10)
-                movie_data = response.json()
-                title = movie_data.get('title', 'Название неизвестно')
-                message_text += f"{category_emoji} *Фильм:* {title} ({date_formatted})\n"
-            except:
-                message_text += f"{category_emoji} *Фильм:* ID {item_id} ({date_formatted})\n"
-        
+        if record is not None:
+            title = record.title or 'Название неизвестно'
+            if category == "music" and record.creator:
+                title = f"{title} — {record.creator}"
         elif category == "music":
-            # Для музыки мы не делаем дополнительный запрос, так как токен может быть устаревшим
-            message_text += f"{category_emoji} *Музыка:* ID {item_id} ({date_formatted})\n"
+            track = tracks.get(item_id)
+            if track:
+                artists = ', '.join([artist.get('name', 'Неизвестный артист') for artist in track.get('artists', [])])
+                title = f"{track.get('name', 'Название неизвестно')} — {artists}"
+        elif provider_titles.get((category, item_id)):
+            title = provider_titles[(category, item_id)]
         
-        elif category == "book":
-            # Получаем информацию о книге по ID
-            try:
-                url = f"https://www.googleapis.com/books/v1/volumes/{item_id}"
-                if GOOGLE_BOOKS_API_KEY:
-                    url += f"?key={GOOGLE_BOOKS_API_KEY}"
-                response = requests.get(url, timeout=10)
-                book_data = response.json()
-                title = book_data.get('volumeInfo', {}).get('title', 'Название неизвестно')
-                message_text += f"{category_emoji} *Книга:* {title} ({date_formatted})\n"
-            except:
-                message_text += f"{category_emoji} *Книга:* ID {item_id} ({date_formatted})\n"
+        if category in HISTORY_LINE_RENDERERS:
+            message_text += HISTORY_LINE_RENDERERS[category](
+                {'title': markdown_value(title), 'date': markdown_value(date_formatted)}
+            )
     
     await update.message.reply_text(
         message_text,
-        parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main")]
-        ])
+        parse_mode=screen.parse_mode,
+        reply_markup=screen.reply_markup
     )
 
-async def movies_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # Создаем клавиатуру с жанрами фильмов
-    movie_genres = [
-        [
-            InlineKeyboardButton("Боевик", callback_data="movie_genre_28"),
-            InlineKeyboardButton("Комедия", callback_data="movie_genre_35")
-        ],
-        [
-            InlineKeyboardButton("Драма", callback_data="movie_genre_18"),
-            InlineKeyboardButton("Фантастика", callback_data="movie_genre_878")
-        ],
-        [
-            InlineKeyboardButton("Ужасы", callback_data="movie_genre_27"),
-            InlineKeyboardButton("Романтика", callback_data="movie_genre_10749")
-        ],
-        [
-            InlineKeyboardButton("Случайный фильм", callback_data="movie_random"),
-            InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(movie_genres)
-    
-    await update.message.reply_text(
-        text="Выбери жанр фильма или получи случайную рекомендацию:",
-        reply_markup=reply_markup
-    )
-    
+async def send_genre_menu(update, category):
+    cancel_recommendation_fetch(update.effective_user.id)
+    screen = SCREENS[('genre_menu', category)]
+    await update.message.reply_text(text=screen.text, reply_markup=screen.reply_markup)
     return GENRE_SELECTION
 
+async def movies_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await send_genre_menu(update, 'movie')
+
 async def music_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # Создаем клавиатуру с жанрами музыки
-    music_genres = [
-        [
-            InlineKeyboardButton("Поп", callback_data="music_genre_pop"),
-            InlineKeyboardButton("Рок", callback_data="music_genre_rock")
-        ],
-        [
-            InlineKeyboardButton("Хип-хоп", callback_data="music_genre_hip-hop"),
-            InlineKeyboardButton("Электронная", callback_data="music_genre_electronic")
-        ],
-        [
-            InlineKeyboardButton("Джаз", callback_data="music_genre_jazz"),
-            InlineKeyboardButton("Классическая", callback_data="music_genre_classical")
-        ],
-        [
-            InlineKeyboardButton("Случайная музыка", callback_data="music_random"),
-            InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(music_genres)
+    return await send_genre_menu(update, 'music')
+
+async def books_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await send_genre_menu(update, 'book')
+
+# Поиск: команда /search и inline-режим (@имя_бота запрос в любом чате)
+SEARCH_RESULT_EMOJI = {'movie': "🎬", 'music': "🎵", 'book': "📚"}
+SEARCH_LABEL_LIMIT = 60
+INLINE_RESULT_LIMIT = 20
+# Сколько Telegram может отдавать ответ на тот же inline-запрос без обращения к боту, секунды
+INLINE_RESULT_CACHE_TIME = 300
+
+def search_result_details(record):
+    """Год или автор элемента для подписи результата поиска."""
+    if record.category == 'movie':
+        return record.year
+    return record.creator
+
+def search_result_label(record):
+    label = f"{SEARCH_RESULT_EMOJI[record.category]} {record.title}"
+    details = search_result_details(record)
+    if details:
+        label += f" ({details})" if record.category == 'movie' else f" — {details}"
+    return label if len(label) <= SEARCH_LABEL_LIMIT else label[:SEARCH_LABEL_LIMIT - 1] + "…"
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    cancel_recommendation_fetch(update.effective_user.id)
+    text = ' '.join(context.args).strip()
+    if not text:
+        await update.message.reply_text(SCREENS['search_usage'].text)
+        return START_ROUTES
+    
+    keyboard = []
+    for record in await search_items(text):
+        try:
+            callback_data = encode_callback('item', record.category, item_id=record.id)
+        except ValueError:
+            # ID не помещается в callback_data
+            continue
+        keyboard.append((InlineKeyboardButton(search_result_label(record), callback_data=callback_data),))
+    
+    if not keyboard:
+        screen = SCREENS['search_empty']
+        await update.message.reply_text(screen.text.format(query=text), reply_markup=screen.reply_markup)
+        return START_ROUTES
     
     await update.message.reply_text(
-        text="Выбери жанр музыки или получи случайную рекомендацию:",
-        reply_markup=reply_markup
+        SCREENS['search_results'].text.format(query=text),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return START_ROUTES
+
+def inline_search_result(record):
+    """Результат inline-режима: карточка без кнопок оценки (у inline-сообщений нет чата бота)."""
+    link = link_button(record)
+    return InlineQueryResultArticle(
+        id=f"{CATEGORY_CODES[record.category]}:{record.id}"[:64],
+        title=record.title,
+        description=search_result_details(record),
+        input_message_content=InputTextMessageContent(render_card_text(record), parse_mode='MarkdownV2'),
+        reply_markup=InlineKeyboardMarkup(((link,),)) if link else None,
+        thumbnail_url=record.image_url,
     )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    inline_query = update.inline_query
+    text = inline_query.query.strip()
+    records = await search_items(text, limit=INLINE_RESULT_LIMIT) if text else []
+    await inline_query.answer(
+        [inline_search_result(record) for record in records],
+        cache_time=INLINE_RESULT_CACHE_TIME
+    )
+
+# Команда /trace для администраторов: последние трассы из TRACE_BUFFER,
+# трассы пользователя (/trace <ID пользователя>) или шаги одной трассы (/trace <ID трассы>)
+TRACE_LIST_SIZE = 10
+TELEGRAM_TEXT_LIMIT = 4096
+
+def span_title(span):
+    details = ' '.join(
+        key if value is True else str(value)
+        for key, value in span['attrs'].items() if value not in (None, False) and key != 'user_id'
+    )
+    return f"{span['name']} {details}".strip()
+
+def format_trace_summary(record):
+    slowest = max(record['spans'][1:] or record['spans'], key=lambda span: span['duration_ms'])
+    return (
+        f"{record['time'][11:]} {record['trace_id']} {record['name']}: {record['duration_ms']:.0f} мс "
+        f"(дольше всего {span_title(slowest)}: {slowest['duration_ms']:.0f} мс)"
+    )
+
+def format_trace(record):
+    depths = {}
+    lines = [f"Трасса {record['trace_id']} ({record['name']}, {record['time']}), всего {record['duration_ms']:.0f} мс:"]
+    for span in record['spans']:
+        depth = depths[span['span_id']] = depths.get(span['parent_id'], -1) + 1
+        lines.append(f"{'  ' * depth}+{span['offset_ms']:.1f} мс {span_title(span)} — {span['duration_ms']:.1f} мс")
+    text = '\n'.join(lines)
+    return text if len(text) <= TELEGRAM_TEXT_LIMIT else text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Команда доступна только администраторам бота.")
+        return
     
-    return GENRE_SELECTION
+    records = list(TRACE_BUFFER)
+    argument = context.args[0] if context.args else None
+    if argument:
+        record = next((record for record in records if record['trace_id'] == argument), None)
+        if record is not None:
+            await update.message.reply_text(format_trace(record))
+            return
+        if not argument.isdigit():
+            await update.message.reply_text(f"Трасса {argument} не найдена (хранятся последние {TRACE_BUFFER_SIZE}).")
+            return
+        records = [record for record in records if record['spans'][0]['attrs'].get('user_id') == int(argument)]
+    
+    if not records:
+        await update.message.reply_text(
+            f"Трасс пока нет. Трассируется доля обновлений: {TRACE_SAMPLE_RATE:g} (TRACE_SAMPLE_RATE)."
+        )
+        return
+    text = '\n'.join(format_trace_summary(record) for record in reversed(records[-TRACE_LIST_SIZE:]))
+    await update.message.reply_text(text[:TELEGRAM_TEXT_LIMIT])
 
-async def books_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # Создаем клавиатуру с жанрами книг
-    book_genres = [
-        [
-            InlineKeyboardButton("Фантастика", callback_data="book_genre_fiction"),
-            InlineKeyboardButton("Фэнтези", callback_data="book_genre_fantasy")
-        ],
-        [
-            InlineKeyboardButton("Наука", callback_data="book_genre_science"),
-            InlineKeyboardButton("История", callback_data="book_genre_history")
-        ],
-        [
-            InlineKeyboardButton("Биография", callback_data="book_genre_biography"),
-            InlineKeyboardButton("Поэзия", callback_data="book_genre_poetry")
-        ],
-        [
-            InlineKeyboardButton("Случайная книга", callback_data="book_random"),
-            InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-        ]
+# Команда /profile для администраторов: снимки стека цикла событий за заданное время
+# (/profile <секунды>). Профиль снимается в отдельной задаче, обработка обновлений продолжается.
+PROFILE_TOP_SIZE = 10
+
+def format_profile(profile, path, seconds):
+    total = sum(profile.values())
+    if not total:
+        return "За время профилирования не получено ни одного снимка стека."
+    inclusive = Counter()
+    own = Counter()
+    idle = 0
+    # Общее начало всех стеков (запуск бота и цикла событий) в сводку не входит
+    common = os.path.commonprefix([stack.split(';') for stack in profile])
+    for stack, count in profile.items():
+        frames = stack.split(';')
+        if frames[-1] in IDLE_FRAMES:
+            idle += count
+            continue
+        own[frames[-1]] += count
+        for frame in set(frames[len(common):]):
+            if not frame.startswith(LOOP_FRAME_FILES):
+                inclusive[frame] += count
+    lines = [
+        f"Профиль за {seconds} с: снимков {total}, цикл событий ждал событий {idle / total:.0%} времени.",
+        f"Сохранен в {path}",
+        "",
+        "Больше всего времени в стеке:",
     ]
-    reply_markup = InlineKeyboardMarkup(book_genres)
+    lines += [f"{count / total:6.1%} {frame}" for frame, count in inclusive.most_common(PROFILE_TOP_SIZE)]
+    lines += ["", "Больше всего собственного времени:"]
+    lines += [f"{count / total:6.1%} {frame}" for frame, count in own.most_common(PROFILE_TOP_SIZE)]
+    return '\n'.join(lines)[:TELEGRAM_TEXT_LIMIT]
+
+async def run_profile(message, seconds):
+    loop_watchdog.start_profile()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile = loop_watchdog.stop_profile() or Counter()
+    file_name = f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded"
+    content = ''.join(f"{stack} {count}\n" for stack, count in profile.items())
+    await asyncio.to_thread(write_profile_artifact, file_name, content)
+    await message.reply_text(format_profile(profile, os.path.join(PROFILE_DIR, file_name), seconds))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Команда доступна только администраторам бота.")
+        return
+    if loop_watchdog is None:
+        await update.message.reply_text(
+            "Снимки стека отключены: задайте STACK_RING_INTERVAL_MS или LOOP_BLOCK_MS больше нуля."
+        )
+        return
+    if loop_watchdog.profile is not None:
+        await update.message.reply_text("Профилирование уже идет.")
+        return
     
+    argument = context.args[0] if context.args else None
+    seconds = int(argument) if argument and argument.isdigit() else PROFILE_DEFAULT_SECONDS
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
     await update.message.reply_text(
-        text="Выбери жанр книги или получи случайную рекомендацию:",
-        reply_markup=reply_markup
+        f"Снимаю стеки цикла событий {seconds} с (раз в {PROFILE_SAMPLE_INTERVAL_MS:g} мс), результат пришлю сюда."
     )
-    
-    return GENRE_SELECTION
+    context.application.create_task(run_profile(update.message, seconds), update=update)
+
+# Кнопки вне конечного автомата: переходы, которые можно выполнить из любого состояния
+FALLBACK_CALLBACK_ROUTES = {
+    'category': functools.partial(open_genre_menu, mode='edit_or_reply'),
+    'menu': functools.partial(open_main_menu, mode='edit_or_reply'),
+    'trending': functools.partial(open_trending, mode='edit_or_reply'),
+    'item': open_item,
+    # Оценка со старой карточки, когда сохраненное состояние диалога истекло или потеряно
+    'rate': rate_item,
+}
 
 async def handle_fallback_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает callback-запросы, которые выпали из конечного автомата."""
     query = update.callback_query
     await query.answer()
     
-    callback_data = query.data
-    logger.warning(f"Получен необработанный callback: {callback_data}")
-    
-    if callback_data == "category_books":
-        book_genres = [
-            [
-                InlineKeyboardButton("Фантастика", callback_data="book_genre_fiction"),
-                InlineKeyboardButton("Фэнтези", callback_data="book_genre_fantasy")
-            ],
-            [
-                InlineKeyboardButton("Наука", callback_data="book_genre_science"),
-                InlineKeyboardButton("История", callback_data="book_genre_history")
-            ],
-            [
-                InlineKeyboardButton("Биография", callback_data="book_genre_biography"),
-                InlineKeyboardButton("Поэзия", callback_data="book_genre_poetry")
-            ],
-            [
-                InlineKeyboardButton("Случайная книга", callback_data="book_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(book_genres)
-        
-        try:
-            await query.edit_message_text(
-                text="Выбери жанр книги или получи случайную рекомендацию:",
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при редактировании сообщения: {e}")
-            await query.message.reply_text(
-                text="Выбери жанр книги или получи случайную рекомендацию:",
-                reply_markup=reply_markup
-            )
-        
-        # Возвращаем пользователя в правильное состояние конечного автомата
-        return GENRE_SELECTION
-    
-    elif callback_data == "category_movies":
-        movie_genres = [
-            [
-                InlineKeyboardButton("Боевик", callback_data="movie_genre_28"),
-                InlineKeyboardButton("Комедия", callback_data="movie_genre_35")
-            ],
-            [
-                InlineKeyboardButton("Драма", callback_data="movie_genre_18"),
-                InlineKeyboardButton("Фантастика", callback_data="movie_genre_878")
-            ],
-            [
-                InlineKeyboardButton("Ужасы", callback_data="movie_genre_27"),
-                InlineKeyboardButton("Романтика", callback_data="movie_genre_10749")
-            ],
-            [
-                InlineKeyboardButton("Случайный фильм", callback_data="movie_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(movie_genres)
-        
+    logger.warning("Получен необработанный callback: %s", query.data)
+    
+    callback = decode_callback(query.data)
+    action = FALLBACK_CALLBACK_ROUTES.get(callback.action) if callback else None
+    if action:
+        # Переходы сами отменяют незавершенный поиск, оценка его не прерывает
+        return await action(update, context, callback)
+    
+    # Для неизвестных callback-запросов возвращаем в главное меню
+    cancel_recommendation_fetch(update.effective_user.id)
+    screen = SCREENS['unknown_callback']
+    await query.message.reply_text(text=screen.text, reply_markup=screen.reply_markup)
+    return START_ROUTES
+
+# Прогрев кэшей при запуске: жанры из клавиатур, токен Spotify и индексы
+# активных пользователей загружаются до начала обработки обновлений.
+WARMUP_BUDGET = float(os.getenv("WARMUP_BUDGET", "20"))
+WARMUP_HOT_USERS = 200
+MOVIE_KEYBOARD_GENRES = tuple(int(genre) for _, genre in GENRE_MENUS['movie']['genres'])
+
+warmup_status = {'ready': False, 'duration': None, 'done': 0, 'failed': 0, 'pending': 0}
+WARMUP_TASKS = set()
+# Фоновые задачи обслуживания, работающие все время жизни бота
+MAINTENANCE_TASKS = set()
+
+def load_hot_user_indexes(conn, limit=WARMUP_HOT_USERS):
+    """Читает историю недавно активных пользователей, чтобы страницы индекса оказались в кэше."""
+    user_ids = [row['user_id'] for row in conn.execute('''
+    SELECT user_id FROM recommendation_history
+    GROUP BY user_id
+    ORDER BY MAX(id) DESC
+    LIMIT ?
+    ''', (limit,))]
+    for user_id in user_ids:
+        for category in ('movie', 'music', 'book'):
+            fetch_recommended_ids(conn, user_id, category)
+    return len(user_ids)
+
+async def warm_spotify():
+    token = await get_spotify_token()
+    if not token:
+        logger.warning("Прогрев: токен Spotify не получен, жанры музыки пропущены")
+        return
+    await asyncio.gather(*(load_spotify_genre_tracks(search_genre) for search_genre in SPOTIFY_GENRE_MAPPING.values()))
+
+def warmup_jobs():
+    jobs = {
+        'tmdb_genres': get_tmdb_genre_names(),
+        'movies_popular': load_movie_list(),
+        'spotify': warm_spotify(),
+        'hot_users': run_db(load_hot_user_indexes),
+    }
+    for genre_id in MOVIE_KEYBOARD_GENRES:
+        jobs[f'movies_{genre_id}'] = load_movie_list(genre_id)
+    for genre in BOOK_GENRE_RUSSIAN:
+        jobs[f'books_{genre}'] = load_google_books(book_genre_query(genre))
+    return jobs
+
+async def warm_up_caches(budget=WARMUP_BUDGET):
+    """
+    Параллельно прогревает кэши и отмечает готовность, когда все задачи
+    завершены или истек бюджет времени. Незавершенные задачи продолжают
+    работу в фоне и заполнят кэш для следующих пользователей.
+    """
+    started = time.monotonic()
+    # Прогрев не должен расходовать резерв квоты интерактивных запросов;
+    # задачи копируют контекст при создании, поэтому приоритет сразу возвращаем
+    priority_token = request_priority.set('background')
+    try:
+        tasks = {asyncio.ensure_future(job): name for name, job in warmup_jobs().items()}
+    finally:
+        request_priority.reset(priority_token)
+    
+    done, pending = await asyncio.wait(tasks, timeout=budget)
+    
+    failed = []
+    for task in done:
+        if task.exception() is not None:
+            failed.append(tasks[task])
+            logger.warning("Прогрев '%s' завершился ошибкой: %s", tasks[task], task.exception())
+    for task in pending:
+        WARMUP_TASKS.add(task)
+        task.add_done_callback(WARMUP_TASKS.discard)
+    
+    warmup_status.update(
+        ready=True,
+        duration=round(time.monotonic() - started, 3),
+        done=len(done) - len(failed),
+        failed=len(failed),
+        pending=len(pending),
+    )
+    if pending:
+        logger.warning(
+            "Бюджет прогрева %s с исчерпан, в фоне осталось: %s",
+            budget, ', '.join(sorted(tasks[task] for task in pending))
+        )
+    logger.info(
+        "Кэши прогреты за %s с: готово %s, ошибок %s, в фоне %s",
+        warmup_status['duration'], warmup_status['done'], warmup_status['failed'], warmup_status['pending']
+    )
+
+async def evict_idle_user_data(application):
+    """Периодически выгружает user_data неактивных пользователей."""
+    while True:
+        await asyncio.sleep(USER_DATA_EVICTION_INTERVAL)
+        evicted = application.persistence.evict_idle_users(application)
+        if evicted:
+            logger.info("Выгружены данные неактивных пользователей: %s", evicted)
+
+async def prune_trending():
+    """Периодически удаляет из БД счетчики популярности, вышедшие из окна."""
+    while True:
+        await asyncio.sleep(TRENDING_PRUNE_INTERVAL)
         try:
-            await query.edit_message_text(
-                text="Выбери жанр фильма или получи случайную рекомендацию:",
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при редактировании сообщения: {e}")
-            await query.message.reply_text(
-                text="Выбери жанр фильма или получи случайную рекомендацию:",
-                reply_markup=reply_markup
-            )
-        
-        return GENRE_SELECTION
-    
-    elif callback_data == "category_music":
-        music_genres = [
-            [
-                InlineKeyboardButton("Поп", callback_data="music_genre_pop"),
-                InlineKeyboardButton("Рок", callback_data="music_genre_rock")
-            ],
-            [
-                InlineKeyboardButton("Хип-хоп", callback_data="music_genre_hip-hop"),
-                InlineKeyboardButton("Электронная", callback_data="music_genre_electronic")
-            ],
-            [
-                InlineKeyboardButton("Джаз", callback_data="music_genre_jazz"),
-                InlineKeyboardButton("Классическая", callback_data="music_genre_classical")
-            ],
-            [
-                InlineKeyboardButton("Случайная музыка", callback_data="music_random"),
-                InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(music_genres)
-        
+            pruned = await run_db(prune_trending_counts, trending.oldest_bucket())
+        except sqlite3.Error as e:
+            logger.error("Ошибка при очистке счетчиков популярности: %s", e)
+            continue
+        if pruned:
+            logger.info("Удалены устаревшие счетчики популярности: %s", pruned)
+
+# Хранение истории: запуск раз в HISTORY_RETENTION_INTERVAL, между пачками задача
+# уступает БД обработчикам обновлений
+HISTORY_RETENTION_INTERVAL = 6 * 60 * 60
+HISTORY_RETENTION_START_DELAY = 10 * 60
+RETENTION_BATCH_PAUSE = 0.2
+# Показы fallback_* уже проверены до этого id (просмотр продолжается с него)
+retention_state = {'fallback_checked_id': 0, 'vacuum_warned': False}
+
+async def run_history_retention():
+    """Один проход хранения истории; возвращает (архивировано, удалено fallback, освобождено страниц)."""
+    archived = purged = reclaimed = 0
+    if HISTORY_RETENTION_DAYS:
+        cutoff = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        while True:
+            count = await run_db(archive_history_batch, cutoff, HISTORY_ARCHIVE_DIR)
+            archived += count
+            if count < RETENTION_BATCH_SIZE:
+                break
+            await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    
+    while True:
+        last_id, deleted = await run_db(purge_fallback_history_batch, retention_state['fallback_checked_id'])
+        if last_id is None:
+            break
+        retention_state['fallback_checked_id'] = last_id
+        purged += deleted
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    
+    while True:
+        result = await run_db(incremental_vacuum_step)
+        if result is None:
+            if not retention_state['vacuum_warned']:
+                retention_state['vacuum_warned'] = True
+                logger.info("Инкрементальная очистка БД не включена: "
+                            "python db_maintenance.py enable-incremental-vacuum (при остановленном боте)")
+            break
+        freed, remaining = result
+        reclaimed += freed
+        if not remaining or not freed:
+            break
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+    return archived, purged, reclaimed
+
+async def retain_history():
+    """Периодически архивирует старую историю, удаляет показы fallback_* и освобождает место в БД."""
+    await asyncio.sleep(HISTORY_RETENTION_START_DELAY)
+    while True:
+        started = time.monotonic()
         try:
-            await query.edit_message_text(
-                text="Выбери жанр музыки или получи случайную рекомендацию:",
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при редактировании сообщения: {e}")
-            await query.message.reply_text(
-                text="Выбери жанр музыки или получи случайную рекомендацию:",
-                reply_markup=reply_markup
-            )
-        
-        return GENRE_SELECTION
-    
-    elif callback_data == "back_to_main":
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
+            archived, purged, reclaimed = await run_history_retention()
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Ошибка при обслуживании истории рекомендаций: %s", e)
+        else:
+            if archived or purged or reclaimed:
+                logger.info("История рекомендаций: архивировано %s, удалено fallback %s, "
+                            "освобождено страниц %s за %.1f с", archived, purged, reclaimed,
+                            time.monotonic() - started)
+        await asyncio.sleep(HISTORY_RETENTION_INTERVAL)
+
+# Резервное копирование: раз в BACKUP_INTERVAL_HOURS (0 - отключено); отсчет идет
+# от последней копии в BACKUP_DIR, чтобы перезапуски бота не плодили копии
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_START_DELAY = 5 * 60
+
+def seconds_until_backup():
+    latest = 0.0
+    if os.path.isdir(BACKUP_DIR):
+        latest = max((
+            os.path.getmtime(os.path.join(BACKUP_DIR, name)) for name in os.listdir(BACKUP_DIR)
+            if name.startswith(BACKUP_PREFIX) and name.endswith('.db.gz')
+        ), default=0.0)
+    return max(BACKUP_START_DELAY, latest + BACKUP_INTERVAL_HOURS * 3600 - time.time())
+
+async def backup_database():
+    """Периодически снимает сжатую резервную копию БД, не блокируя обработку обновлений."""
+    if not BACKUP_INTERVAL_HOURS:
+        return
+    while True:
+        await asyncio.sleep(seconds_until_backup())
+        started = time.monotonic()
         try:
-            await query.edit_message_text(
-                text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при редактировании сообщения: {e}")
-            await query.message.reply_text(
-                text="Выбери категорию, и я предложу тебе что-нибудь интересное!",
-                reply_markup=reply_markup
-            )
-        
-        return START_ROUTES
+            path, snapshot_size, size = await asyncio.to_thread(create_backup)
+        except (sqlite3.Error, OSError) as e:
+            metrics.inc('bot_db_backups_total', (('result', 'error'),))
+            logger.error("Ошибка резервного копирования БД: %s", e)
+            # Повтор не раньше чем через BACKUP_START_DELAY
+            continue
+        metrics.inc('bot_db_backups_total', (('result', 'ok'),))
+        logger.info("Резервная копия БД %s: %.1f МБ (сжато %.1f МБ) за %.1f с", path,
+                    snapshot_size / 2 ** 20, size / 2 ** 20, time.monotonic() - started)
+
+async def load_trending():
+    try:
+        rows = await run_db(load_trending_counts, trending.oldest_bucket())
+    except sqlite3.Error as e:
+        logger.error("Не удалось загрузить счетчики популярности: %s", e)
+        return
+    trending.load(rows)
+    logger.info("Загружены счетчики популярности: %s", len(rows))
+
+# Сервер метрик для Prometheus и проверок /healthz и /readyz. Включается переменной
+# среды METRICS_PORT; по умолчанию слушает только локальный интерфейс.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Сколько поток сервера ждет, пока цикл событий соберет метрики, секунды
+METRICS_RENDER_TIMEOUT = 5
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def state_metrics():
+    """Метрики из состояния квот, хеджирования и кэша провайдеров: (имя, тип, описание, [(метки, значение)])."""
+    quotas = get_quota_metrics()
+    return [
+        ('bot_quota_tokens', 'gauge', "Токены в корзине провайдера",
+         [((('provider', p),), q['tokens']) for p, q in quotas.items()]),
+        ('bot_quota_daily_used', 'gauge', "Запросов к провайдеру за текущие сутки",
+         [((('provider', p),), q['daily_used']) for p, q in quotas.items()]),
+        ('bot_quota_daily_remaining', 'gauge', "Остаток дневного бюджета провайдера",
+         [((('provider', p),), q['daily_remaining']) for p, q in quotas.items() if q['daily_remaining'] is not None]),
+        ('bot_quota_requests_total', 'counter', "Решения по квоте: разрешено, с ожиданием, отклонено",
+         [((('provider', p), ('outcome', outcome)), q[outcome])
+          for p, q in quotas.items() for outcome in ('allowed', 'waited', 'shed')]),
+        ('bot_hedge_requests_total', 'counter', "Запросы к провайдерам и дублирующие запросы",
+         [((('provider', p), ('kind', kind)), counter[p])
+          for kind, counter in (('request', hedging_policy.requests), ('hedge', hedging_policy.hedges),
+                                ('hedge_win', hedging_policy.hedge_wins))
+          for p in PROVIDER_QUOTAS]),
+        ('bot_provider_cache_events_total', 'counter', "События кэша провайдеров: hit, stale, miss и т.д.",
+         [((('event', event),), count) for event, count in sorted(provider_cache.stats.items())]),
+        ('bot_item_catalog_entries', 'gauge', "Элементов в каталоге в памяти",
+         [((), len(item_catalog.entries))]),
+    ]
+
+def render_metrics():
+    """Текст метрик в формате Prometheus; вызывается в цикле событий."""
+    lines = []
+    families = {}
+    for (name, labels), histogram in sorted(metrics.histograms.items()):
+        families.setdefault(name, []).append((labels, histogram))
+    for (name, labels), value in sorted(metrics.counters.items()):
+        families.setdefault(name, []).append((labels, value))
     
-    else:
-        # Для неизвестных callback-запросов возвращаем в главное меню
-        keyboard = [
-            [InlineKeyboardButton("🎬 Фильмы", callback_data="category_movies")],
-            [InlineKeyboardButton("🎵 Музыка", callback_data="category_music")],
-            [InlineKeyboardButton("📚 Книги", callback_data="category_books")],
-            [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.message.reply_text(
-            text="Извините, произошла ошибка в обработке запроса. Пожалуйста, выберите категорию:",
-            reply_markup=reply_markup
-        )
-        
-        return START_ROUTES
+    for name, series in families.items():
+        metric_type, description = METRIC_FAMILIES[name]
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in series:
+            if metric_type != 'histogram':
+                lines.append(f"{name}{metric_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS + ('+Inf',), value.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{metric_labels(labels)} {value.sum:.6f}")
+            lines.append(f"{name}_count{metric_labels(labels)} {cumulative}")
+    
+    for name, metric_type, description, series in state_metrics():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(f"{name}{metric_labels(labels)} {value}" for labels, value in series)
+    return '\n'.join(lines) + '\n'
 
-def main() -> None:
-    """Запуск бота."""
-    # Инициализация базы данных
-    init_db()
+metrics_app = Flask(__name__)
+metrics_server = None
+
+@metrics_app.route('/metrics')
+def metrics_endpoint():
+    async def render():
+        return render_metrics()
     
-    # Создание бота и получение токена из переменных среды
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
-        logger.error("Не указан токен бота в переменной TELEGRAM_BOT_TOKEN")
+    # Состояние бота меняется только в цикле событий, поэтому и читаем его там
+    text = asyncio.run_coroutine_threadsafe(render(), metrics_app.config['EVENT_LOOP']).result(
+        timeout=METRICS_RENDER_TIMEOUT
+    )
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+# Проверки для оркестратора на том же сервере.
+# /healthz (liveness) - цикл событий отвечает; /readyz (readiness) - кэши прогреты,
+# задержка цикла событий в норме, БД доступна для записи и очередь обновлений не
+# растет. Обе проверки выполняются в потоке сервера и не ждут цикл событий, поэтому
+# отвечают и тогда, когда он заблокирован, и их можно опрашивать каждую секунду.
+# Состояние провайдеров и очереди отправки сообщаются, но на готовность не влияют:
+# без провайдеров бот отвечает запасными рекомендациями.
+HEALTH_LOOP_STALL_SECONDS = float(os.getenv("HEALTH_LOOP_STALL_SECONDS", "10"))
+HEALTH_MAX_LOOP_LAG_MS = float(os.getenv("HEALTH_MAX_LOOP_LAG_MS", "1000"))
+HEALTH_MAX_UPDATE_BACKLOG = int(os.getenv("HEALTH_MAX_UPDATE_BACKLOG", "500"))
+HEALTH_DB_TIMEOUT = 0.5
+
+def event_loop_lag():
+    """Сколько цикл событий не отвечает, секунды; без сторожа - время отклика на вызов из потока."""
+    watchdog = loop_watchdog
+    if watchdog is not None:
+        return max(0.0, time.perf_counter() - watchdog.heartbeat - LOOP_HEARTBEAT_INTERVAL)
+    answered = threading.Event()
+    started = time.perf_counter()
+    metrics_app.config['EVENT_LOOP'].call_soon_threadsafe(answered.set)
+    answered.wait(HEALTH_LOOP_STALL_SECONDS)
+    return time.perf_counter() - started
+
+def check_db_writable():
+    """Берет блокировку записи и сразу откатывает транзакцию: на диск ничего не пишется."""
+    try:
+        conn = get_db_connection(timeout=HEALTH_DB_TIMEOUT)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.rollback()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return str(e)
+    return None
+
+def provider_states():
+    now = time.time()
+    states = {}
+    for provider, health in provider_health.items():
+        if time.monotonic() < quota_manager.blocked_until[provider]:
+            state = 'rate_limited'
+        elif quota_manager.daily_remaining(provider) == 0:
+            state = 'exhausted'
+        elif health['consecutive_failures'] >= PROVIDER_FAILING_AFTER:
+            state = 'failing'
+        else:
+            state = 'ok'
+        states[provider] = {
+            'state': state,
+            'consecutive_failures': health['consecutive_failures'],
+            'last_success_age': round(now - health['last_success'], 1) if health['last_success'] else None,
+        }
+    return states
+
+def readiness_report():
+    lag = event_loop_lag()
+    db_error = check_db_writable()
+    application = metrics_app.config.get('APPLICATION')
+    update_backlog = application.update_queue.qsize() if application is not None else 0
+    checks = {
+        'warmed_up': warmup_status['ready'],
+        'event_loop': lag * 1000 <= HEALTH_MAX_LOOP_LAG_MS,
+        'db_writable': db_error is None,
+        'update_backlog': update_backlog <= HEALTH_MAX_UPDATE_BACKLOG,
+    }
+    return all(checks.values()), {
+        'ready': all(checks.values()),
+        'checks': checks,
+        'event_loop_lag_ms': round(lag * 1000, 1),
+        'db_error': db_error,
+        'cache': {
+            'warmup': warmup_status,
+            'provider_cache_entries': len(provider_cache.entries),
+            'item_catalog_entries': len(item_catalog.entries),
+        },
+        'providers': provider_states(),
+        'queues': {
+            'updates': update_backlog,
+            'telegram_requests_in_flight': TracedHTTPXRequest.in_flight,
+            'telegram_pool_size': TELEGRAM_POOL_SIZE,
+            'recommendation_fetches': len(ACTIVE_FETCHES),
+        },
+    }
+
+def health_response(healthy, report):
+    return Response(json.dumps(report, ensure_ascii=False), status=200 if healthy else 503,
+                    mimetype='application/json')
+
+@metrics_app.route('/healthz')
+def healthz_endpoint():
+    lag = event_loop_lag()
+    healthy = lag < HEALTH_LOOP_STALL_SECONDS
+    return health_response(healthy, {'alive': healthy, 'event_loop_lag_ms': round(lag * 1000, 1)})
+
+@metrics_app.route('/readyz')
+def readyz_endpoint():
+    return health_response(*readiness_report())
+
+def start_metrics_server(application=None):
+    """Запускает HTTP-сервер метрик и проверок в отдельном потоке, если задан METRICS_PORT."""
+    global metrics_server
+    if not METRICS_PORT:
         return
-    
-    # Создание приложения
-    application = Application.builder().token(token).build()
+    metrics_app.config['EVENT_LOOP'] = asyncio.get_running_loop()
+    metrics_app.config['APPLICATION'] = application
+    try:
+        metrics_server = make_server(METRICS_HOST, METRICS_PORT, metrics_app, threaded=True)
+    except OSError as e:
+        logger.error("Не удалось запустить сервер метрик на %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        return
+    threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        await asyncio.to_thread(metrics_server.shutdown)
+        metrics_server = None
+
+def start_maintenance_task(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    MAINTENANCE_TASKS.add(task)
+    task.add_done_callback(MAINTENANCE_TASKS.discard)
+
+async def on_startup(application: Application) -> None:
+    """Прогревает кэши до начала обработки обновлений и запускает фоновые задачи."""
+    if isinstance(application.persistence, SQLitePersistence):
+        start_maintenance_task(evict_idle_user_data(application))
+    start_metrics_server(application)
+    start_loop_watchdog()
+    await load_trending()
+    start_maintenance_task(prune_trending())
+    start_maintenance_task(retain_history())
+    start_maintenance_task(backup_database())
+    await warm_up_caches()
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождает ресурсы при остановке бота."""
+    for user_id in list(ACTIVE_FETCHES):
+        cancel_recommendation_fetch(user_id)
+    for task in list(WARMUP_TASKS) + list(MAINTENANCE_TASKS):
+        task.cancel()
+    stop_loop_watchdog()
+    await stop_metrics_server()
+    await close_http_client()
+
+def build_application(token, base_url=None, concurrent_updates=False):
+    """
+    Создает приложение со всеми обработчиками. base_url - адрес Bot API
+    (нагрузочный стенд benchmarks/load_harness.py подставляет заглушку);
+    concurrent_updates - параметр ApplicationBuilder.concurrent_updates.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .persistence(SQLitePersistence())
+        .request(TracedHTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(concurrent_updates)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     
     # Определение конечного автомата для диалога
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            START_ROUTES: [
-                CallbackQueryHandler(handle_category_selection, pattern="^category_.*|^help$|^back_to_main$|^start_over$")
-            ],
-            GENRE_SELECTION: [
-                CallbackQueryHandler(handle_genre_selection, pattern="^(movie|music|book)_.*|^back_to_main$")
-            ],
-            MOVIE_ACTIONS: [
-                CallbackQueryHandler(handle_movie_actions, pattern="^rate_movie_.*|^movie_.*|^category_movies$|^back_to_main$")
-            ],
-            MUSIC_ACTIONS: [
-                CallbackQueryHandler(handle_music_actions, pattern="^rate_music_.*|^music_.*|^category_music$|^back_to_main$")
-            ],
-            BOOK_ACTIONS: [
-                CallbackQueryHandler(handle_book_actions, pattern="^rate_book_.*|^book_.*|^category_books$|^back_to_main$")
-            ],
-        },
-        fallbacks=[CommandHandler("cancel", cancel)],
+        # /search тоже входит в диалог: кнопки результатов открывают карточки с оценкой
+        entry_points=[
+            CommandHandler("start", instrumented(start)),
+            CommandHandler("search", instrumented(search_command)),
+        ],
+        # Переходы каждого состояния описаны в CALLBACK_ROUTES
+        states={state: [callback_router(state)] for state in CALLBACK_ROUTES},
+        fallbacks=[CommandHandler("cancel", instrumented(cancel))],
         # Добавляем это для отладки
         name="main_conversation",
-        persistent=False,
+        persistent=True,
         allow_reentry=True,
     )
     
     # Регистрация обработчиков
     application.add_handler(conv_handler)
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("history", show_history))
-    application.add_handler(CommandHandler("movies", movies_command))
-    application.add_handler(CommandHandler("music", music_command))
-    application.add_handler(CommandHandler("books", books_command))
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CommandHandler("history", instrumented(show_history)))
+    application.add_handler(CommandHandler("movies", instrumented(movies_command)))
+    application.add_handler(CommandHandler("music", instrumented(music_command)))
+    application.add_handler(CommandHandler("books", instrumented(books_command)))
+    application.add_handler(CommandHandler("trace", instrumented(trace_command)))
+    application.add_handler(CommandHandler("profile", instrumented(profile_command)))
+    # Inline-режим нужно включить у @BotFather (/setinline)
+    application.add_handler(InlineQueryHandler(instrumented(inline_search)))
     
     # Глобальный обработчик для всех callback-запросов, не обработанных ConversationHandler
-    application.add_handler(CallbackQueryHandler(handle_fallback_callback))
+    application.add_handler(CallbackQueryHandler(instrumented(handle_fallback_callback)))
     
     # Регистрируем обработчик ошибок
     application.add_error_handler(error_handler)
+    return application
+
+def main() -> None:
+    """Запуск бота."""
+    # Инициализация базы данных
+    init_db()
+    
+    # Создание бота и получение токена из переменных среды
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        logger.error("Не указан токен бота в переменной TELEGRAM_BOT_TOKEN")
+        return
     
     # Запуск бота
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    build_application(token).run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def fields(callback):
+    return (callback.action, callback.category, callback.genre, callback.item_id, callback.rating)
+
+
+@pytest.mark.parametrize('args, expected', [
+    (('menu',), ('menu', None, None, None, None)),
+    (('category', 'book'), ('category', 'book', None, None, None)),
+    (('genre', 'movie', '28'), ('genre', 'movie', '28', None, None)),
+    (('random', 'music'), ('random', 'music', None, None, None)),
+])
+def test_round_trip(args, expected):
+    assert fields(main.decode_callback(main.encode_callback(*args))) == expected
+
+
+def test_rate_round_trip_with_genre_code():
+    data = main.encode_callback('rate', 'book', item_id='a:b_c', rating=1, genre_code=1295)
+    callback = main.decode_callback(data)
+    assert fields(callback) == ('rate', 'book', None, 'a:b_c', 1)
+    assert callback.genre_code == 1295
+
+
+def test_too_long_callback_is_rejected():
+    with pytest.raises(ValueError):
+        main.encode_callback('rate', 'book', item_id='x' * 60, rating=5)
+
+
+@pytest.mark.parametrize('data, expected', [
+    ('back_to_main', ('menu', None, None, None, None)),
+    ('start_over', ('menu', None, None, None, None)),
+    ('help', ('help', None, None, None, None)),
+    ('category_movies', ('category', 'movie', None, None, None)),
+    ('movie_genre_28', ('genre', 'movie', '28', None, None)),
+    ('book_random', ('random', 'book', None, None, None)),
+    ('rate_movie_603_5', ('rate', 'movie', None, '603', 5)),
+    # ID книги может содержать '_'
+    ('rate_book_ab_cd_1', ('rate', 'book', None, 'ab_cd', 1)),
+])
+def test_legacy_callbacks(data, expected):
+    assert fields(main.decode_callback(data)) == expected
+
+
+@pytest.mark.parametrize('data', [
+    None, '', 'garbage', 'book_genre_', 'category_unknown', 'film_random',
+    'rate_film_1_5', 'rate_movie_603_x', 'rate_movie',
+    '1:', '1:zz', '1:g:m:', '1:g:x:28', '1:c:', '2:g:m:28',
+])
+def test_malformed_callbacks(data):
+    assert main.decode_callback(data) is None
+
+
+@pytest.mark.parametrize('state', list(main.CALLBACK_ROUTES))
+def test_rating_is_routed_in_every_state(state):
+    callback = main.decode_callback(main.encode_callback('rate', 'music', item_id='t1', rating=5))
+    assert main.find_callback_route(state, callback) is main.rate_item
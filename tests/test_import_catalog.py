@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import import_catalog  # noqa: E402
+import main  # noqa: E402
+
+
+def import_rows(tmp_path, monkeypatch, lines, category):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'dump.csv'
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return import_catalog.import_catalog(str(path), category, report=lambda message: None)
+
+
+def imported_record(category, item_id):
+    conn = main.get_db_connection()
+    try:
+        row = main.load_item_row(conn, category, item_id)
+    finally:
+        conn.close()
+    return main.ItemRecord.from_row(row)
+
+
+def test_sparse_rows_render_without_none(tmp_path, monkeypatch):
+    lines = ['category,id,title', 'movie,1,Фильм', 'music,2,Трек', 'book,3,Книга']
+    assert import_rows(tmp_path, monkeypatch, lines, None) == (3, 0)
+    for category, item_id in (('movie', '1'), ('music', '2'), ('book', '3')):
+        text, _, _ = main.render_card(imported_record(category, item_id))
+        assert 'None' not in text
+
+
+def test_long_id_is_skipped(tmp_path, monkeypatch):
+    lines = ['id,title', 'x' * 60 + ',Книга', 'short,Книга']
+    assert import_rows(tmp_path, monkeypatch, lines, 'book') == (1, 1)
+    main.render_card(imported_record('book', 'short'))
+
+
+def test_shelf_category_column_keeps_cli_category(tmp_path, monkeypatch):
+    lines = ['category,id,title', 'Fiction,1,Книга', 'movie,2,Фильм']
+    assert import_rows(tmp_path, monkeypatch, lines, 'book') == (2, 0)
+    assert imported_record('book', '1').title == 'Книга'
+    assert imported_record('movie', '2').title == 'Фильм'
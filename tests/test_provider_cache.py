@@ -0,0 +1,142 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+FRESH_TTL, STALE_TTL = main.PROVIDER_CACHE_TTL['tmdb']
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Upstream:
+    """fetch для ProviderCache: отдает заданные ответы по очереди и считает вызовы."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def status_error(status):
+    request = httpx.Request('GET', 'https://api.themoviedb.org/3/movie/1')
+    return httpx.HTTPStatusError('error', request=request, response=httpx.Response(status, request=request))
+
+
+def run_with_cache(scenario):
+    async def wrapper():
+        clock = FakeClock()
+        cache = main.ProviderCache(clock=clock)
+        await scenario(cache, clock)
+        await asyncio.gather(*cache.tasks)
+        return cache
+
+    return asyncio.run(wrapper())
+
+
+def test_fresh_entry_is_served_without_fetch():
+    async def scenario(cache, clock):
+        upstream = Upstream('v1')
+        assert await cache.get('k', upstream, 'tmdb') == 'v1'
+        clock.now += FRESH_TTL - 1
+        assert await cache.get('k', upstream, 'tmdb') == 'v1'
+        assert upstream.calls == 1
+
+    cache = run_with_cache(scenario)
+    assert cache.stats['hit'] == 1
+
+
+def test_stale_entry_is_served_and_refreshed_in_background():
+    async def scenario(cache, clock):
+        upstream = Upstream('v1', 'v2')
+        await cache.get('k', upstream, 'tmdb')
+        clock.now += FRESH_TTL + 1
+        # Устаревшая запись отдается сразу, обновление идет в фоне
+        assert await cache.get('k', upstream, 'tmdb') == 'v1'
+        await asyncio.gather(*cache.tasks)
+        assert upstream.calls == 2
+        assert await cache.get('k', upstream, 'tmdb') == 'v2'
+
+    cache = run_with_cache(scenario)
+    assert cache.stats['stale'] == 1
+    assert cache.stats['refreshed'] == 1
+
+
+def test_last_good_version_is_served_when_provider_fails():
+    async def scenario(cache, clock):
+        upstream = Upstream('v1', status_error(503))
+        await cache.get('k', upstream, 'tmdb')
+        clock.now += FRESH_TTL + STALE_TTL + 1
+        assert await cache.get('k', upstream, 'tmdb') == 'v1'
+
+    cache = run_with_cache(scenario)
+    assert cache.stats['stale_on_error'] == 1
+
+
+def test_upstream_failure_is_negatively_cached_until_expiry():
+    async def scenario(cache, clock):
+        upstream = Upstream(status_error(503), 'v1')
+        with pytest.raises(httpx.HTTPStatusError):
+            await cache.get('k', upstream, 'tmdb')
+        clock.now += main.NEGATIVE_CACHE_TTL - 1
+        with pytest.raises(main.CachedFailure):
+            await cache.get('k', upstream, 'tmdb')
+        assert upstream.calls == 1
+        clock.now += 2
+        assert await cache.get('k', upstream, 'tmdb') == 'v1'
+        assert upstream.calls == 2
+
+    run_with_cache(scenario)
+
+
+def test_empty_result_is_negatively_cached_until_expiry():
+    async def scenario(cache, clock):
+        upstream = Upstream({'results': []}, {'results': [1]})
+        is_empty = lambda data: not data['results']  # noqa: E731
+        assert await cache.get('k', upstream, 'tmdb', is_empty) == {'results': []}
+        assert await cache.get('k', upstream, 'tmdb', is_empty) == {'results': []}
+        assert upstream.calls == 1
+        clock.now += main.NEGATIVE_CACHE_TTL + 1
+        assert await cache.get('k', upstream, 'tmdb', is_empty) == {'results': [1]}
+
+    cache = run_with_cache(scenario)
+    assert cache.stats['negative'] == 1
+
+
+@pytest.mark.parametrize('error', [status_error(401), status_error(429), main.QuotaExceeded('quota')])
+def test_auth_and_rate_limit_errors_are_not_cached(error):
+    async def scenario(cache, clock):
+        upstream = Upstream(error, 'v1')
+        with pytest.raises(type(error)):
+            await cache.get('k', upstream, 'tmdb')
+        assert await cache.get('k', upstream, 'tmdb') == 'v1'
+        assert upstream.calls == 2
+
+    run_with_cache(scenario)
+
+
+def test_concurrent_requests_are_coalesced():
+    async def scenario(cache, clock):
+        upstream = Upstream('v1')
+        results = await asyncio.gather(*(cache.get('k', upstream, 'tmdb') for _ in range(5)))
+        assert results == ['v1'] * 5
+        assert upstream.calls == 1
+
+    cache = run_with_cache(scenario)
+    assert cache.stats['coalesced'] == 4
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def make_manager(rate=1, burst=1, daily=None):
+    return main.QuotaManager({'p': {'rate': rate, 'burst': burst, 'daily': daily}})
+
+
+def test_cancelled_waiter_returns_reserved_token():
+    async def scenario():
+        quota = make_manager()
+        await quota.acquire('p')
+        for _ in range(5):
+            waiter = asyncio.ensure_future(quota.acquire('p'))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        return quota
+
+    quota = asyncio.run(scenario())
+    bucket = quota.buckets['p']
+    bucket.refill()
+    # Без возврата в корзине было бы около -5 токенов
+    assert bucket.tokens > -0.5
+    assert quota.counters['p']['waited'] == 5
+    assert quota.counters['p']['allowed'] == 1
+    assert quota.daily_used['p'] == 1
+
+
+def test_interactive_waiter_gets_token_after_wait():
+    async def scenario():
+        quota = make_manager(rate=20)
+        await quota.acquire('p')
+        await quota.acquire('p')
+        return quota
+
+    quota = asyncio.run(scenario())
+    assert quota.counters['p'] == {'allowed': 2, 'waited': 1, 'shed': 0}
+
+
+def test_background_requests_keep_reserve():
+    async def scenario():
+        quota = make_manager(rate=0.001, burst=10)
+        for _ in range(8):
+            await quota.acquire('p', 'background')
+        with pytest.raises(main.QuotaExceeded):
+            await quota.acquire('p', 'background')
+        # Интерактивный запрос может взять резерв
+        await quota.acquire('p')
+        return quota
+
+    quota = asyncio.run(scenario())
+    assert quota.counters['p']['shed'] == 1
+
+
+def test_daily_budget_is_shed():
+    async def scenario():
+        quota = make_manager(rate=100, burst=100, daily=2)
+        await quota.acquire('p')
+        await quota.acquire('p')
+        with pytest.raises(main.QuotaExceeded):
+            await quota.acquire('p')
+
+    asyncio.run(scenario())
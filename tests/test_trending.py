@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def use_bucket(monkeypatch, state):
+    monkeypatch.setattr(main, 'trending_bucket', lambda timestamp=None: state['bucket'])
+
+
+def window_scores(events, bucket, window):
+    """Очки элементов, пересчитанные заново по всем событиям окна."""
+    scores = Counter()
+    for event_bucket, item_id, counts in events:
+        if bucket - window < event_bucket <= bucket:
+            scores[item_id] += main.trending_score(*counts)
+    return scores
+
+
+def top_scores(scores, k):
+    # Очки сравниваются с округлением: суммы одинаковых событий в другом порядке
+    # отличаются в последних битах, и при равенстве порядок ключей может отличаться
+    return sorted((round(score, 6) for score in scores.values() if round(score, 6) > 0), reverse=True)[:k]
+
+
+def test_top_matches_recomputation(monkeypatch):
+    state = {'bucket': 100}
+    use_bucket(monkeypatch, state)
+    trending = main.TrendingAggregates(window_buckets=3, top_size=5)
+    rng = random.Random(7)
+    events = []
+    for step in range(400):
+        if step % 50 == 49:
+            state['bucket'] += 1
+        item_id = str(rng.randrange(15))
+        counts = rng.choice([(1, 0, 0), (0, 1, 0), (0, 0, 1)])
+        trending.record('movie', item_id, None, *counts)
+        events.append((state['bucket'], item_id, counts))
+        scores = window_scores(events, state['bucket'], 3)
+        top = trending.top('item', 'movie', 5)
+        assert [round(scores[key], 6) for key in top] == top_scores(scores, 5)
+
+
+def test_old_buckets_leave_the_window(monkeypatch):
+    state = {'bucket': 10}
+    use_bucket(monkeypatch, state)
+    trending = main.TrendingAggregates(window_buckets=2, top_size=5)
+    trending.record('book', 'old', 'роман', likes=3)
+    state['bucket'] += 1
+    trending.record('book', 'new', 'роман', impressions=1)
+    assert trending.top('item', 'book', 2) == ['old', 'new']
+    assert trending.top('genre', 'book', 1) == ['роман']
+    state['bucket'] += 1
+    assert trending.top('item', 'book', 2) == ['new']
+    state['bucket'] += 5
+    assert trending.top('item', 'book', 2) == []
+    assert trending.top('genre', 'book', 1) == []